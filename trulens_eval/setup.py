@@ -14,6 +14,7 @@ setup(
         'python-dotenv>=1.0.0',
         'kaggle>=1.5.13',
         # 'langchain>=0.0.170', optional
+        # 'duckdb>=0.8.0', optional
         'merkle-json>=1.0.0',
         'millify>=0.1.1',
         'openai>=0.27.6',
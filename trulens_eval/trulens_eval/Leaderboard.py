@@ -5,11 +5,10 @@ import numpy as np
 import streamlit as st
 from streamlit_extras.switch_page_button import switch_page
 
-st.runtime.legacy_caching.clear_cache()
-
 from trulens_eval import Tru
 from trulens_eval import tru_db
 from trulens_eval.tru_feedback import default_pass_fail_color_threshold
+from trulens_eval.ux import cache
 from trulens_eval.ux import styles
 
 st.set_page_config(page_title="Leaderboard", layout="wide")
@@ -28,50 +27,39 @@ def streamlit_app():
     st.write(
         'Average feedback values displayed in the range from 0 (worst) to 1 (best).'
     )
-    df, feedback_col_names = lms.get_records_and_feedback([])
+    df, feedback_col_names = cache.get_app_summaries(lms)
 
     if df.empty:
         st.write("No records yet...")
         return
 
-    df = df.sort_values(by="app_id")
-
-    if df.empty:
-        st.write("No records yet...")
-
-    apps = list(df.app_id.unique())
     st.markdown("""---""")
 
-    for app in apps:
+    for _, summary in df.iterrows():
+        app = summary.app_id
         st.header(app)
-        col1, col2, col3, col4, *feedback_cols, col99 = st.columns(
-            5 + len(feedback_col_names)
+        col1, col2, col3, col4, col5, *feedback_cols, col99 = st.columns(
+            6 + len(feedback_col_names)
         )
-        app_df = df.loc[df.app_id == app]
-        latency_mean = app_df['latency'].apply(lambda td: td.seconds).mean()
-        #app_df_feedback = df.loc[df.app_id == app]
 
-        col1.metric("Records", len(app_df))
+        col1.metric("Records", summary.records)
         col2.metric(
             "Average Latency (Seconds)",
-            f"{millify(round(latency_mean, 5), precision=2)}"
+            f"{millify(round(summary.latency, 5), precision=2)}"
         )
         col3.metric(
-            "Total Cost (USD)",
-            f"${millify(round(sum(cost for cost in app_df.total_cost if cost is not None), 5), precision = 2)}"
+            "Latency p50 / p95 / p99 (Seconds)", " / ".join(
+                millify(round(summary[f"latency_p{q}"], 5), precision=2)
+                for q in [50, 95, 99]
+            )
         )
         col4.metric(
-            "Total Tokens",
-            millify(
-                sum(
-                    tokens for tokens in app_df.total_tokens
-                    if tokens is not None
-                ),
-                precision=2
-            )
+            "Total Cost (USD)",
+            f"${millify(round(summary.total_cost, 5), precision = 2)}"
         )
+        col5.metric("Total Tokens", millify(summary.total_tokens, precision=2))
         for i, col_name in enumerate(feedback_col_names):
-            mean = app_df[col_name].mean()
+            mean = summary[col_name]
 
             st.write(
                 styles.stmetricdelta_hidearrow,
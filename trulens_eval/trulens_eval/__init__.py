@@ -16,10 +16,14 @@ otherwise you might get circular import errors.
 
     - `tru.py`
 
-    - `tru_feedback.py`
+    - `evaluator.py`
+
+    - `tru_feedback.py` `db_writer.py`
 
     - `tru_model.py`
 
+    - `tru_db_duckdb.py`
+
     - `tru_db.py`
 
     - `instruments.py`
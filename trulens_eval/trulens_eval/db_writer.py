@@ -0,0 +1,734 @@
+"""
+Write-behind logging of records and feedback results.
+
+`DBWriter` takes records and feedback results off the request path: they are
+put on a bounded queue and written to a `TruDB` in batches by a background
+thread.
+
+`WriterServer` is the single writer of a sqlite database shared by several
+processes, such as the workers of a web server and a feedback evaluator.
+Processes using a `FunneledSQLite` send it their records and feedback results
+over a local socket instead of competing for the database's write lock. Start
+one next to the database with:
+
+    python -m trulens_eval.db_writer --sqlite default.sqlite
+
+and open the database in the other processes with
+`Tru(database_url="sqlite+writer:///default.sqlite")`.
+
+Clients must authenticate with the writer's key, which it stores next to its
+socket readable only by the user running it (see `writer_authkey_file`), so
+only processes of that user can send it writes.
+"""
+
+import argparse
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+from multiprocessing.connection import Connection
+from multiprocessing.connection import Listener
+import logging
+import os
+from pathlib import Path
+from queue import Empty
+from queue import Full
+from queue import Queue
+import sqlite3
+import threading
+from time import monotonic
+from time import sleep
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import pydantic
+
+from trulens_eval.schema import FeedbackResult
+from trulens_eval.schema import FeedbackResultID
+from trulens_eval.schema import FeedbackResultStatus
+from trulens_eval.schema import Record
+from trulens_eval.schema import RecordID
+from trulens_eval.tru_db import LocalSQLite
+from trulens_eval.tru_db import TruDB
+
+logger = logging.getLogger(__name__)
+
+# Queue items are records, optionally paired with their pending feedback
+# results, or feedback results on their own.
+WriteItem = Union[Record, FeedbackResult]
+
+
+class DBWriter():
+    """
+    Background writer that flushes queued records and feedback results to `db`
+    in batches of up to `batch_size` items or every `flush_interval` seconds,
+    whichever comes first. If given, `on_pending` is called after each batch that
+    wrote feedback results still to be computed, for example to wake up a
+    deferred feedback evaluator.
+
+    Each record is written in the same transaction as the feedback results
+    queued with it. A batch that fails to write is retried up to `max_retries`
+    times, waiting `retry_delay` seconds (doubling with each retry) in
+    between; if it still fails its entries are written one at a time and only
+    those failing again are given up on (and counted).
+
+    The queue holds at most `max_queue` entries where an entry is a record
+    with its feedback results or a group of feedback results. When it is full,
+    new entries are dropped (and counted) unless `block` is set in which case
+    the caller waits for space.
+
+    Writes are asynchronous: what was queued is only visible in `db` once
+    written, which `flush` waits for.
+    """
+
+    def __init__(
+        self,
+        db: TruDB,
+        max_queue: int = 10000,
+        batch_size: int = 256,
+        flush_interval: float = 0.5,
+        block: bool = False,
+        on_pending: Optional[Callable[[], None]] = None,
+        max_retries: int = 3,
+        retry_delay: float = 0.5
+    ):
+        self.db = db
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = block
+        self.on_pending = on_pending
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.retried = 0
+
+        self._start()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._queue: Queue = Queue(maxsize=self.max_queue)
+        self._stop = threading.Event()
+
+        # Numbers of entries queued and of those written or given up on, for
+        # `flush` to wait on.
+        self._done = threading.Condition()
+        self._queued = 0
+        self._processed = 0
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _ensure_started(self):
+        # The writer thread does not survive a fork; start a fresh one (with an
+        # empty queue) in the child.
+        if self._pid != os.getpid():
+            self._start()
+
+    def put_record(
+        self, record: Record, feedback_results: Sequence[FeedbackResult] = ()
+    ) -> None:
+        """
+        Queue `record` and the (possibly pending) `feedback_results` on it for
+        writing. They will be written in the same transaction.
+        """
+
+        self._put([record] + list(feedback_results))
+
+    def put_feedbacks(self, feedback_results: Sequence[FeedbackResult]) -> None:
+        """
+        Queue feedback results for writing.
+        """
+
+        if len(feedback_results) > 0:
+            self._put(list(feedback_results))
+
+    def _put(self, items: List[WriteItem]) -> None:
+        self._ensure_started()
+
+        if self._stop.is_set():
+            raise RuntimeError("Writer has been stopped.")
+
+        try:
+            self._queue.put(items, block=self.block)
+
+        except Full:
+            self.dropped += len(items)
+            logger.warning(
+                f"Write queue full, dropped {len(items)} item(s) "
+                f"({self.dropped} so far)."
+            )
+            return
+
+        with self._done:
+            self._queued += 1
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except Empty:
+                continue
+
+            size = len(batch[0])
+            deadline = monotonic() + self.flush_interval
+            while size < self.batch_size:
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    items = self._queue.get(timeout=timeout)
+                except Empty:
+                    break
+                batch.append(items)
+                size += len(items)
+
+            self._write(batch)
+
+            with self._done:
+                self._processed += len(batch)
+                self._done.notify_all()
+
+    def _write(self, batch: List[List[WriteItem]]) -> None:
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._write_entries(batch)
+                return
+
+            except Exception as e:
+                error = e
+
+            if attempt < self.max_retries:
+                self.retried += 1
+                delay = self.retry_delay * 2**attempt
+                logger.warning(
+                    f"Failed to write a batch of {len(batch)} entries "
+                    f"({error}), retrying in {delay:.1f}s."
+                )
+                sleep(delay)
+
+        logger.error(
+            f"Failed to write a batch of {len(batch)} entries "
+            f"{self.max_retries + 1} times ({error}), writing them one by one."
+        )
+
+        # Give up only on the entries that still fail on their own.
+        for items in batch:
+            try:
+                self._write_entries([items])
+
+            except Exception as e:
+                self.failed += len(items)
+                logger.error(
+                    f"Dropped {len(items)} item(s) that failed to write "
+                    f"({self.failed} so far): {e}"
+                )
+
+    def _write_entries(self, batch: List[List[WriteItem]]) -> None:
+        # Records without feedback results and groups of feedback results are
+        # written with the bulk inserts; records with feedback results each
+        # in a transaction of their own.
+        records = []
+        records_with_feedbacks = []
+        feedback_results = []
+
+        for items in batch:
+            if isinstance(items[0], Record):
+                if len(items) > 1:
+                    records_with_feedbacks.append(items)
+                else:
+                    records.append(items[0])
+            else:
+                feedback_results.extend(items)
+
+        # Records first as feedback results refer to them. Later updates to
+        # the same feedback result come later in the list and win. Writes are
+        # upserts, so retrying a partially written batch is harmless.
+        if len(records) > 0:
+            self.db.insert_records(records=records)
+        for record, *pending in records_with_feedbacks:
+            self.db.insert_record_with_pending_feedbacks(
+                record=record, feedback_results=pending
+            )
+        if len(feedback_results) > 0:
+            self.db.insert_feedbacks(feedback_results=feedback_results)
+
+        self.written += sum(len(items) for items in batch)
+
+        if self.on_pending is not None and any(
+                isinstance(item, FeedbackResult) and
+                item.status == FeedbackResultStatus.NONE
+                for items in batch for item in items):
+            try:
+                self.on_pending()
+            except Exception as e:
+                logger.error(f"Pending feedback callback failed: {e}")
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until everything queued so far has been written (or given up on).
+        Returns False if `timeout` seconds passed first.
+        """
+
+        with self._done:
+            queued = self._queued
+            return self._done.wait_for(
+                lambda: self._processed >= queued, timeout=timeout
+            )
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop accepting new items, write out everything queued, and stop the
+        writer thread.
+        """
+
+        if self._pid != os.getpid():
+            return
+
+        self._stop.set()
+        self._thread.join(timeout=timeout)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Queue depth (in entries) and counts of items written, failed to write
+        and dropped, and of batches retried.
+        """
+
+        return dict(
+            queued=self._queue.qsize(),
+            written=self.written,
+            failed=self.failed,
+            dropped=self.dropped,
+            retried=self.retried
+        )
+
+
+def writer_address(filename: Path) -> str:
+    """
+    Default address of the `WriterServer` of the sqlite database `filename`: a
+    unix socket next to it.
+    """
+
+    return f"{filename}.writer"
+
+
+def writer_authkey_file(address: str) -> str:
+    """
+    File holding the key clients of the `WriterServer` at `address`
+    authenticate with: next to its socket.
+    """
+
+    return f"{address}.key"
+
+
+def read_authkey(address: str) -> bytes:
+    """
+    Key of the `WriterServer` at `address` as stored by it.
+    """
+
+    with open(writer_authkey_file(address)) as f:
+        return bytes.fromhex(f.read().strip())
+
+
+def _write_authkey(address: str, authkey: bytes) -> None:
+    # Created afresh so that it is only ever readable by this user.
+    path = writer_authkey_file(address)
+    if os.path.exists(path):
+        os.unlink(path)
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(authkey.hex())
+
+
+class WriterServer():
+    """
+    Writer of the records and feedback results sent by `FunneledSQLite`
+    clients to `db` over the unix socket `address`. Whatever arrived while the
+    previous batch was being written is written as the next batch, up to
+    `batch_size` records and feedback results, so that concurrent clients
+    share transactions. The records and feedback results sent together are
+    written or rolled back together, and each client waits until its writes
+    are committed and is only told of its own errors.
+
+    Clients authenticate with `authkey`, a random one unless given, which is
+    stored in `writer_authkey_file(address)` while the server runs. Both that
+    file and the socket are only accessible to the user running the server.
+    """
+
+    def __init__(
+        self,
+        db: LocalSQLite,
+        address: Optional[str] = None,
+        authkey: Optional[bytes] = None,
+        batch_size: int = 256
+    ):
+        self.db = db
+        self.address = address or writer_address(db.filename)
+        self.authkey = authkey or os.urandom(32)
+        self.batch_size = batch_size
+
+        self.written = 0
+        self.failed = 0
+
+        # Writes with the event to set and the list to put the error in, if
+        # any, once they are done. Nothing is queued after the None put there
+        # by `stop` so that every write queued is also written.
+        self._queue: Queue = Queue()
+        self._queue_lock = threading.Lock()
+
+        self._listener: Optional[Listener] = None
+        self._writer_thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        """
+        Start accepting clients and writing in background threads.
+        """
+
+        self._remove_stale_socket()
+        self._listener = Listener(
+            self.address, family="AF_UNIX", authkey=self.authkey
+        )
+        os.chmod(self.address, 0o600)
+        _write_authkey(self.address, self.authkey)
+
+        self._writer_thread = threading.Thread(
+            target=self._write_loop, daemon=True
+        )
+        self._writer_thread.start()
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+        logger.info(f"Writing {self.db} for clients at {self.address}.")
+
+    def serve_forever(self) -> None:
+        """
+        Start and wait until stopped.
+        """
+
+        self.start()
+        self._stop.wait()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop accepting clients and wait for the writes already received to be
+        written.
+        """
+
+        with self._queue_lock:
+            self._stop.set()
+            self._queue.put(None)
+
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+            try:
+                os.unlink(writer_authkey_file(self.address))
+            except FileNotFoundError:
+                pass
+
+        if self._writer_thread is not None:
+            self._writer_thread.join(timeout=timeout)
+
+    def _remove_stale_socket(self) -> None:
+        # A server that did not shut down cleanly leaves its socket behind,
+        # which would make binding fail. Only removed if nobody answers.
+        if not os.path.exists(self.address):
+            return
+
+        try:
+            Client(self.address, family="AF_UNIX", authkey=self.authkey).close()
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(self.address)
+            return
+        except AuthenticationError:
+            # Someone is answering, with another key.
+            pass
+
+        raise RuntimeError(f"Another writer is already serving {self.address}.")
+
+    def _accept_loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                conn = self._listener.accept()
+            except (OSError, AttributeError):
+                # Closed by `stop`.
+                break
+            except Exception as e:
+                logger.warning(f"Rejected writer client: {e}")
+                continue
+
+            threading.Thread(
+                target=self._serve_client, args=(conn,), daemon=True
+            ).start()
+
+    def _serve_client(self, conn: Connection) -> None:
+        with conn:
+            while True:
+                try:
+                    records, feedback_results = conn.recv()
+                except (EOFError, OSError):
+                    break
+
+                # Once stopped, clients are disconnected without a reply and
+                # write directly instead.
+                done = threading.Event()
+                errors = []
+                with self._queue_lock:
+                    if self._stop.is_set():
+                        break
+                    self._queue.put((records, feedback_results, done, errors))
+                done.wait()
+
+                try:
+                    conn.send(errors[0] if len(errors) > 0 else None)
+                except OSError:
+                    break
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            size = len(item[0]) + len(item[1])
+            while size < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+                size += len(item[0]) + len(item[1])
+
+            self._write(batch)
+
+    def _write(
+        self, batch: List[Tuple[List[Record], List[FeedbackResult],
+                                threading.Event, List[str]]]
+    ) -> None:
+        # One transaction for the batch, with the records and feedback results
+        # of each write under a savepoint of their own, so that a write that
+        # fails is rolled back alone and only its client is told.
+
+        def write(c: sqlite3.Cursor) -> List[Optional[str]]:
+            c.execute("BEGIN IMMEDIATE")
+
+            results = []
+            for records, feedback_results, _, _ in batch:
+                c.execute("SAVEPOINT client_write")
+                try:
+                    # Records first as feedback results refer to them.
+                    self.db._insert_records(c, records)
+                    self.db._upsert_feedbacks(c, feedback_results)
+
+                except Exception as e:
+                    if isinstance(e, sqlite3.OperationalError
+                                 ) and self.db._is_locked(e):
+                        # The whole batch is retried by `LocalSQLite._write`.
+                        raise
+                    c.execute("ROLLBACK TO client_write")
+                    results.append(f"{type(e).__name__}: {e}")
+
+                else:
+                    results.append(None)
+
+                c.execute("RELEASE client_write")
+
+            return results
+
+        try:
+            results = self.db._write(write)
+        except Exception as e:
+            results = [f"{type(e).__name__}: {e}"] * len(batch)
+
+        for (records, feedback_results, done, errors), error in zip(batch,
+                                                                   results):
+            size = len(records) + len(feedback_results)
+            if error is None:
+                self.written += size
+            else:
+                self.failed += size
+                errors.append(error)
+                logger.error(
+                    f"Failed to write {len(records)} record(s) and "
+                    f"{len(feedback_results)} feedback result(s): {error}"
+                )
+            done.set()
+
+
+class FunneledSQLite(LocalSQLite):
+    """
+    `LocalSQLite` whose records and feedback results are written by the
+    `WriterServer` at `writer_address` (by default next to the database file)
+    rather than by this process. Everything else, including reads and claims
+    of pending feedback, uses the database directly. If the writer cannot be
+    reached, writes fall back to the database as well; they are upserts, so a
+    write that is retried directly after the writer already did it is
+    harmless.
+
+    Connections authenticate with `writer_authkey` if given and otherwise
+    with the key the writer stored next to its socket, read on each connect.
+    """
+
+    writer_address: Optional[str] = None
+    writer_authkey: Optional[bytes] = None
+
+    # Connection to the writer, one per process, used by one thread at a time.
+    _writer_conn: Optional[Connection] = pydantic.PrivateAttr(None)
+    _writer_lock: threading.Lock = pydantic.PrivateAttr(
+        default_factory=threading.Lock
+    )
+    _writer_pid: Optional[int] = pydantic.PrivateAttr(None)
+
+    def __init__(self, filename: Path, **kwargs):
+        super().__init__(filename=filename, **kwargs)
+
+        if self.writer_address is None:
+            self.writer_address = writer_address(self.filename)
+
+    def __str__(self) -> str:
+        return f"SQLite({self.filename}, writer at {self.writer_address})"
+
+    def _send(
+        self, records: Sequence[Record],
+        feedback_results: Sequence[FeedbackResult]
+    ) -> bool:
+        """
+        Have the writer write `records` and `feedback_results`, waiting until
+        it did. Returns False if the writer could not be reached, in which case
+        nothing or some of them may have been written.
+        """
+
+        with self._writer_lock:
+            if self._writer_pid != os.getpid():
+                # Connections inherited over a fork are abandoned as the
+                # parent may still be using them.
+                self._writer_conn = None
+                self._writer_pid = os.getpid()
+
+            try:
+                if self._writer_conn is None:
+                    self._writer_conn = Client(
+                        self.writer_address,
+                        family="AF_UNIX",
+                        authkey=self.writer_authkey or
+                        read_authkey(self.writer_address)
+                    )
+
+                self._writer_conn.send((list(records), list(feedback_results)))
+                error = self._writer_conn.recv()
+
+            except (OSError, EOFError, AuthenticationError) as e:
+                logger.warning(
+                    f"Writer at {self.writer_address} is not available ({e!r}), "
+                    "writing directly."
+                )
+                if self._writer_conn is not None:
+                    self._writer_conn.close()
+                    self._writer_conn = None
+                return False
+
+        if error is not None:
+            raise RuntimeError(
+                f"Writer at {self.writer_address} failed: {error}"
+            )
+
+        return True
+
+    def close(self) -> None:
+        with self._writer_lock:
+            if self._writer_conn is not None and self._writer_pid == os.getpid(
+            ):
+                self._writer_conn.close()
+            self._writer_conn = None
+
+        super().close()
+
+    # TruDB requirement
+    def insert_record(self, record: Record) -> RecordID:
+        if self._send([record], []):
+            return record.record_id
+
+        return super().insert_record(record)
+
+    def insert_records(self, records: Sequence[Record]) -> List[RecordID]:
+        if self._send(records, []):
+            return [record.record_id for record in records]
+
+        return super().insert_records(records)
+
+    def insert_feedback(
+        self, feedback_result: FeedbackResult
+    ) -> FeedbackResultID:
+        if self._send([], [feedback_result]):
+            return feedback_result.feedback_result_id
+
+        return super().insert_feedback(feedback_result)
+
+    def insert_feedbacks(
+        self, feedback_results: Sequence[FeedbackResult]
+    ) -> List[FeedbackResultID]:
+        if self._send([], feedback_results):
+            return [
+                feedback_result.feedback_result_id
+                for feedback_result in feedback_results
+            ]
+
+        return super().insert_feedbacks(feedback_results)
+
+    def insert_record_with_pending_feedbacks(
+        self, record: Record, feedback_results: Sequence[FeedbackResult]
+    ) -> RecordID:
+        if self._send([record], feedback_results):
+            return record.record_id
+
+        return super().insert_record_with_pending_feedbacks(
+            record, feedback_results
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write a sqlite trulens_eval database for other processes."
+    )
+    parser.add_argument(
+        "--sqlite", default="default.sqlite", help="sqlite database to write"
+    )
+    parser.add_argument(
+        "--address",
+        default=None,
+        help="unix socket to listen on, next to the database by default"
+    )
+    parser.add_argument(
+        "--authkey-file",
+        default=None,
+        help="file with the hex key clients authenticate with; a random key "
+        "is stored next to the socket by default"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    authkey = None
+    if args.authkey_file is not None:
+        with open(args.authkey_file) as f:
+            authkey = bytes.fromhex(f.read().strip())
+
+    db = LocalSQLite(filename=Path(args.sqlite))
+    server = WriterServer(db=db, address=args.address, authkey=authkey)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""
+Deferred feedback evaluation in worker processes.
+
+An `Evaluator` runs a number of worker processes, each of which claims batches
+of pending feedback results from the database, computes them and writes the
+results back. A supervising thread restarts workers that exit unexpectedly.
+Results claimed by a worker that crashed are picked up by another once their
+lease runs out.
+
+Evaluators can also be run on their own, for example on a dedicated machine
+sharing the database file:
+
+    python -m trulens_eval.evaluator --database default.sqlite --workers 4
+
+or, with a database url as taken by `Tru`, for a database written through a
+`db_writer.WriterServer`:
+
+    python -m trulens_eval.evaluator --database-url sqlite+writer:///default.sqlite
+"""
+
+import argparse
+import logging
+import multiprocessing
+from multiprocessing.synchronize import Event
+import os
+from pathlib import Path
+import random
+import signal
+from socket import gethostname
+import sys
+from threading import Thread
+from time import monotonic
+from time import time
+from typing import Any, Dict, Optional, Type
+
+import pandas as pd
+
+from trulens_eval.schema import Record
+from trulens_eval.tru_db import db_of_url
+from trulens_eval.tru_db import InMemoryDB
+from trulens_eval.tru_db import LocalSQLite
+from trulens_eval.tru_db import TruDB
+from trulens_eval.tru_feedback import Feedback
+from trulens_eval.util import TP
+
+logger = logging.getLogger(__name__)
+
+
+def _evaluate(db: TruDB, row: pd.Series) -> None:
+    try:
+        record = Record(**row.record_json)
+        feedback = Feedback(**row.feedback_json)
+
+        feedback.run_and_log(
+            record=record,
+            app=row.app_json,
+            db=db,
+            feedback_result_id=row.feedback_result_id
+        )
+
+    except Exception as e:
+        # Left as claimed; it will be retried once the lease runs out, until
+        # it was claimed MAX_ATTEMPTS times.
+        logger.error(
+            f"Could not evaluate feedback result {row.feedback_result_id}: {e}"
+        )
+
+
+def _wait_for_work(
+    db: LocalSQLite, stop: Event, timeout: float, debounce: float
+) -> None:
+    # Wait until some feedback result is due to be claimed, a stop is
+    # requested or `timeout` seconds passed. Due times are only read again
+    # when another connection committed, and most of those commits, such as
+    # other workers writing their results, leave nothing new to claim, so
+    # they do not wake this worker. Once there is work, waits a random part
+    # of `debounce` seconds so that idle workers do not all try to claim it at
+    # once. Without data versions this is plain polling.
+
+    version = db.get_data_version()
+    if version is None:
+        stop.wait(timeout)
+        return
+
+    deadline = monotonic() + timeout
+    due = db.next_claim_ts()
+
+    while due is None or due > time():
+        wait = min(0.1, deadline - monotonic())
+        if due is not None:
+            wait = min(wait, due - time())
+
+        if stop.wait(max(0, wait)) or monotonic() >= deadline:
+            return
+
+        new_version = db.get_data_version()
+        if new_version != version:
+            version = new_version
+            due = db.next_claim_ts()
+
+    stop.wait(random.uniform(0, debounce))
+
+
+def _run_worker(
+    db_class: Type[LocalSQLite], db_settings: Dict[str, Any], stop: Event,
+    batch_size: int, lease_seconds: float, poll_interval: float
+) -> None:
+    # Interrupts are handled by the supervising process which then asks the
+    # workers to stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    db = db_class(**db_settings)
+    worker_id = f"{gethostname()}:{os.getpid()}"
+
+    while not stop.is_set():
+        feedbacks = db.claim_pending_feedback(
+            limit=batch_size, worker_id=worker_id, lease_seconds=lease_seconds
+        )
+
+        if len(feedbacks) == 0:
+            _wait_for_work(db, stop, poll_interval, debounce=0.2)
+            continue
+
+        promises = [
+            TP().promise(_evaluate, db, row) for _, row in feedbacks.iterrows()
+        ]
+        for promise in promises:
+            promise.get()
+
+    db.close()
+
+
+class Evaluator():
+    """
+    Supervisor of `workers` processes evaluating deferred feedback stored in
+    the sqlite database `filename` or, if given, in `db`. Workers open a
+    database of the same type and with the same settings as `db`, such as its
+    codec or the writer it sends its writes to, rather than `db` itself.
+
+    Each worker claims up to `batch_size` results at a time, holding them for
+    `lease_seconds`, and computes them concurrently. Idle workers wake up as
+    soon as another process writes feedback results to be computed, or those
+    to be retried are due, and otherwise look for new work every
+    `poll_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        filename: Optional[Path] = None,
+        workers: int = 2,
+        batch_size: int = 16,
+        lease_seconds: float = 300.0,
+        poll_interval: float = 10.0,
+        db: Optional[LocalSQLite] = None
+    ):
+        if (filename is None) == (db is None):
+            raise ValueError("Give either `filename` or `db`, not both.")
+
+        if isinstance(db, InMemoryDB):
+            raise ValueError(
+                f"Evaluator processes cannot share {db}. Use a sqlite file."
+            )
+
+        # Recreated by each worker. Settings are the fields of the database
+        # without its connections and caches, which are private.
+        if db is None:
+            self._db_class = LocalSQLite
+            self._db_settings = dict(filename=Path(filename))
+        else:
+            self._db_class = type(db)
+            self._db_settings = {
+                name: getattr(db, name) for name in db.__fields__
+            }
+
+        self.filename = self._db_settings['filename']
+
+        self.workers = workers
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+
+        # Number of times a worker had to be restarted.
+        self.restarts = 0
+
+        # Workers are spawned rather than forked so that they do not inherit
+        # the threads and database connections of this process.
+        self._ctx = multiprocessing.get_context("spawn")
+        self._stop = self._ctx.Event()
+        self._procs: Dict[int, multiprocessing.Process] = dict()
+        self._supervisor: Optional[Thread] = None
+
+    def _spawn(self, i: int) -> None:
+        proc = self._ctx.Process(
+            target=_run_worker,
+            args=(
+                self._db_class, self._db_settings, self._stop,
+                self.batch_size, self.lease_seconds, self.poll_interval
+            ),
+            daemon=True
+        )
+        proc.start()
+
+        self._procs[i] = proc
+
+    def _supervise(self) -> None:
+        while not self._stop.wait(1.0):
+            for i, proc in list(self._procs.items()):
+                if not proc.is_alive():
+                    logger.warning(
+                        f"Evaluator worker {i} exited with code {proc.exitcode}. Restarting it."
+                    )
+                    self.restarts += 1
+                    self._spawn(i)
+
+    def start(self) -> 'Evaluator':
+        """
+        Start the workers and their supervisor.
+        """
+
+        if self._supervisor is not None:
+            raise RuntimeError("Evaluator already started.")
+
+        for i in range(self.workers):
+            self._spawn(i)
+
+        self._supervisor = Thread(target=self._supervise, daemon=True)
+        self._supervisor.start()
+
+        return self
+
+    def is_alive(self) -> bool:
+        return self._supervisor is not None and self._supervisor.is_alive()
+
+    def wait(self) -> None:
+        """
+        Block until the evaluator is asked to stop.
+        """
+
+        while not self._stop.wait(1.0):
+            pass
+
+    def stop(self, timeout: Optional[float] = 30.0) -> None:
+        """
+        Ask the workers to stop once they have finished their current batch,
+        waiting up to `timeout` seconds for each before terminating it.
+        """
+
+        self._stop.set()
+
+        if self._supervisor is not None:
+            self._supervisor.join()
+
+        for proc in self._procs.values():
+            proc.join(timeout=timeout)
+            if proc.is_alive():
+                logger.warning(
+                    f"Evaluator worker {proc.pid} did not stop in time. Terminating it."
+                )
+                proc.terminate()
+                proc.join()
+
+        self._procs = dict()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Evaluate deferred feedback functions."
+    )
+    parser.add_argument(
+        "--database",
+        default="default.sqlite",
+        help="sqlite database file shared with the apps being evaluated"
+    )
+    parser.add_argument(
+        "--database-url",
+        default=None,
+        help="database url as taken by Tru, used instead of --database if given"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=2, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=16,
+        help="feedback results claimed by a worker at a time"
+    )
+    parser.add_argument(
+        "--lease-seconds",
+        type=float,
+        default=300.0,
+        help="seconds after which results claimed by a worker can be retried"
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=10.0,
+        help="seconds between looks for new work by idle workers"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.database_url is not None:
+        db = db_of_url(args.database_url)
+        if not isinstance(db, LocalSQLite):
+            raise ValueError(f"Evaluator processes cannot share {db}.")
+    else:
+        db = LocalSQLite(filename=Path(args.database))
+
+    # Only its type and settings are passed on to the workers.
+    db.close()
+
+    evaluator = Evaluator(
+        db=db,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        lease_seconds=args.lease_seconds,
+        poll_interval=args.poll_interval
+    ).start()
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        evaluator.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        evaluator.stop()
+
+
+if __name__ == "__main__":
+    main()
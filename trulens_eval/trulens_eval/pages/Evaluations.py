@@ -14,11 +14,13 @@ from ux.styles import default_pass_fail_color_threshold
 
 from trulens_eval import Tru
 from trulens_eval.schema import Record
+from trulens_eval.tru_db import RecordsQuery
 from trulens_eval.util import Class
 from trulens_eval.util import GetItemOrAttribute
 from trulens_eval.util import instrumented_classes
 from trulens_eval.util import JSONPath
 from trulens_eval.utils.langchain import Is
+from trulens_eval.ux import cache
 from trulens_eval.ux.components import draw_call
 from trulens_eval.ux.components import draw_llm_info
 from trulens_eval.ux.components import draw_prompt_info
@@ -28,20 +30,20 @@ st.set_page_config(page_title="Evaluations", layout="wide")
 
 st.title("Evaluations")
 
-st.runtime.legacy_caching.clear_cache()
-
 add_logo()
 
 tru = Tru()
 lms = tru.db
 
-df_results, feedback_cols = lms.get_records_and_feedback([])
+# Apps with records and the names of their feedback functions, from their
+# summaries rather than from all the records.
+df_apps, feedback_names = cache.get_app_summaries(lms)
 
-if df_results.empty:
+if df_apps.empty:
     st.write("No records yet...")
 
 else:
-    apps = list(df_results.app_id.unique())
+    apps = list(df_apps.app_id)
     if 'app' in st.session_state:
         app = st.session_state.app
     else:
@@ -51,32 +53,90 @@ else:
 
     if (len(options) == 0):
         st.header("All Applications")
-        app_df = df_results
 
     elif (len(options) == 1):
         st.header(options[0])
 
-        app_df = df_results[df_results.app_id.isin(options)]
-
     else:
         st.header("Multiple Applications Selected")
 
-        app_df = df_results[df_results.app_id.isin(options)]
+    search = st.text_input(
+        "Search Records", placeholder="Words in the user input or response"
+    )
+
+    # Records are read a page at a time, filtered and ordered by the database.
+    # Record and app json are only loaded for the selected record below. Pages
+    # are cached until the database changes, so selecting a row does not read
+    # the records again.
+    sort_columns = {
+        "Time Stamp": "ts",
+        "Latency": "latency",
+        "Total Cost": "total_cost",
+        "Total Tokens": "total_tokens",
+        **{
+            name: name for name in feedback_names
+        }
+    }
+
+    col1, col2, col3, col4, col5 = st.columns(5)
+    sort_by = col1.selectbox("Sort By", list(sort_columns))
+    descending = col2.checkbox("Descending", value=True)
+    filter_name = col3.selectbox("Filter Feedback", ["None"] + feedback_names)
+    filter_op = col4.selectbox(
+        "Operator", RecordsQuery.OPS, index=RecordsQuery.OPS.index(">=")
+    )
+    filter_value = col5.number_input("Value", value=0.5, step=0.1)
+
+    feedback_filters = dict()
+    if filter_name != "None":
+        feedback_filters[filter_name] = (filter_op, filter_value)
+
+    record_ids = None
+    if search.strip():
+        df_found, _ = cache.search_records(
+            lms, search, app_ids=options, limit=500
+        )
+        record_ids = list(df_found.record_id)
+
+    n_records = cache.count_records(
+        lms,
+        app_ids=options,
+        record_ids=record_ids,
+        feedback_filters=feedback_filters
+    )
+
+    if n_records == 0:
+        st.write("No matching records...")
+        st.stop()
+
+    col1, col2, _ = st.columns([1, 1, 3])
+    page_size = col1.selectbox("Records per Page", [25, 50, 100, 250])
+    n_pages = (n_records - 1) // page_size + 1
+    page = col2.number_input(
+        f"Page (of {n_pages})", min_value=1, max_value=n_pages, value=1
+    )
+
+    app_df, feedback_cols = cache.query_records(
+        lms,
+        app_ids=options,
+        record_ids=record_ids,
+        feedback_filters=feedback_filters,
+        order_by=("-" if descending else "") + sort_columns[sort_by],
+        limit=page_size,
+        offset=(page - 1) * page_size
+    )
 
     tab1, tab2 = st.tabs(["Records", "Feedback Functions"])
 
     with tab1:
 
         gridOptions = {'alwaysShowHorizontalScroll': True}
-        evaluations_df = app_df
+        # Only what is shown is sent to the browser.
+        evaluations_df = app_df.drop(columns=['cost_json', 'perf_json'])
         gb = GridOptionsBuilder.from_dataframe(evaluations_df)
 
         cellstyle_jscode = JsCode(cellstyle_jscode)
         gb.configure_column('type', header_name='App Type')
-        gb.configure_column('record_json', header_name='Record JSON', hide=True)
-        gb.configure_column('app_json', header_name='App JSON', hide=True)
-        gb.configure_column('cost_json', header_name='Cost JSON', hide=True)
-        gb.configure_column('perf_json', header_name='Perf. JSON', hide=True)
 
         gb.configure_column('record_id', header_name='Record ID', hide=True)
         gb.configure_column('app_id', header_name='App ID')
@@ -91,21 +151,10 @@ else:
         gb.configure_column('total_cost', header_name='Total Cost (USD)')
         gb.configure_column('latency', header_name='Latency (Seconds)')
         gb.configure_column('tags', header_name='Tags')
-        gb.configure_column('ts', header_name='Time Stamp', sort="desc")
-
-        non_feedback_cols = [
-            'app_id', 'type', 'ts', 'total_tokens', 'total_cost', 'record_json',
-            'latency', 'record_id', 'app_id', 'cost_json', 'app_json', 'input',
-            'output', 'perf_json'
-        ]
-
-        for feedback_col in evaluations_df.columns.drop(non_feedback_cols):
-            gb.configure_column(
-                feedback_col,
-                cellStyle=cellstyle_jscode,
-                hide=feedback_col.endswith("_calls")
-            )
-        gb.configure_pagination()
+        gb.configure_column('ts', header_name='Time Stamp')
+
+        for feedback_col in feedback_cols:
+            gb.configure_column(feedback_col, cellStyle=cellstyle_jscode)
         gb.configure_side_bar()
         gb.configure_selection(selection_mode="single", use_checkbox=False)
         #gb.configure_default_column(groupable=True, value=True, enableRowGroup=True, aggFunc="sum", editable=True)
@@ -138,11 +187,20 @@ else:
 
             row = selected_rows.head().iloc[0]
 
+            record_id = selected_rows['record_id'][0]
+
+            # Calls of each feedback function of the selected record, first
+            # one by name as in the table.
+            df_feedback = lms.get_feedback(
+                record_id=record_id, include_json=False
+            )
+            calls_of_name = df_feedback.groupby("name")['calls_json'].first()
+
             st.header("Feedback")
             for fcol in feedback_cols:
                 feedback_name = fcol
                 feedback_result = row[fcol]
-                feedback_calls = row[f"{fcol}_calls"]
+                feedback_calls = calls_of_name.get(fcol)
 
                 def display_feedback_call(call):
 
@@ -171,14 +229,11 @@ else:
                                  expanded=True):
                     display_feedback_call(feedback_calls)
 
-            record_str = selected_rows['record_json'][0]
-            record_json = json.loads(record_str)
+            record_json = lms.get_record_json(record_id)
             record = Record(**record_json)
 
-            details = selected_rows['app_json'][0]
-            app_json = json.loads(
-                details
-            )  # apps may not be deserializable, don't try to, keep it json.
+            # apps may not be deserializable, don't try to, keep it json.
+            app_json = lms.get_app(selected_rows['app_id'][0])
 
             classes: Iterable[Tuple[JSONPath, Class,
                                     Any]] = instrumented_classes(app_json)
@@ -244,7 +299,10 @@ else:
                 st.write(record_json)
 
     with tab2:
-        feedback = feedback_cols
+        # Counted by the database over all records of the selected apps.
+        bins = [0, 0.2, 0.4, 0.6, 0.8, 1.0]  # Quintile buckets
+        histograms = cache.get_feedback_histograms(lms, options, bins=bins)
+        feedback = list(histograms.index)
         cols = 4
         rows = len(feedback) // cols + 1
 
@@ -257,12 +315,10 @@ else:
                         if ind < len(feedback):
                             # Generate histogram
                             fig, ax = plt.subplots()
-                            bins = [
-                                0, 0.2, 0.4, 0.6, 0.8, 1.0
-                            ]  # Quintile buckets
                             ax.hist(
-                                app_df[feedback[ind]],
+                                bins[:-1],
                                 bins=bins,
+                                weights=histograms.loc[feedback[ind]],
                                 edgecolor='black',
                                 color='#2D736D'
                             )
@@ -20,13 +20,12 @@ from trulens_eval.tru_feedback import Feedback
 from trulens_eval.util import is_empty
 from trulens_eval.util import is_noserio
 from trulens_eval.util import TP
+from trulens_eval.ux import cache
 
 st.set_page_config(page_title="Feedback Progress", layout="wide")
 
 st.title("Feedback Progress")
 
-st.runtime.legacy_caching.clear_cache()
-
 add_logo()
 
 tru = Tru()
@@ -41,11 +40,13 @@ endpoints = [e_openai, e_hugs, e_cohere]
 tab1, tab2, tab3 = st.tabs(["Progress", "Endpoints", "Feedback Functions"])
 
 with tab1:
-    feedbacks = lms.get_feedback(
+    feedbacks = cache.get_feedback(
+        lms,
         status=[
             FeedbackResultStatus.NONE, FeedbackResultStatus.RUNNING,
             FeedbackResultStatus.FAILED
-        ]
+        ],
+        include_json=False
     )
     data = AgGrid(feedbacks, allow_unsafe_jscode=True)
 
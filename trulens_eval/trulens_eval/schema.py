@@ -281,6 +281,10 @@ class FeedbackDefinition(SerialModel):
 
 
 class FeedbackMode(str, Enum):
+    # Except with NONE, records and feedback results are written to the
+    # database in the background after the app returns; `Tru.flush` waits for
+    # them to be written.
+
     # No evaluation will happen even if feedback functions are specified.
     NONE = "none"
 
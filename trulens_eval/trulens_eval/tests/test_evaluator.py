@@ -0,0 +1,210 @@
+"""
+Tests for the multi-process deferred feedback evaluator.
+"""
+
+from datetime import datetime
+import os
+from pathlib import Path
+import signal
+import tempfile
+import threading
+from time import sleep
+from time import time
+
+from trulens_eval.db_writer import FunneledSQLite
+from trulens_eval.db_writer import WriterServer
+from trulens_eval.evaluator import _wait_for_work
+from trulens_eval.evaluator import Evaluator
+from trulens_eval.schema import App
+from trulens_eval.schema import Cost
+from trulens_eval.schema import FeedbackResult
+from trulens_eval.schema import FeedbackResultStatus
+from trulens_eval.schema import Perf
+from trulens_eval.schema import Record
+from trulens_eval.tru_db import LocalSQLite
+from trulens_eval.tru_db import ZlibCodec
+from trulens_eval.tru_feedback import Feedback
+from trulens_eval.util import Class
+
+
+def prompt_length(text: str) -> float:
+    return float(len(text))
+
+
+def wait_for(condition, timeout: float = 60.0) -> bool:
+    deadline = time() + timeout
+    while time() < deadline:
+        if condition():
+            return True
+        sleep(0.2)
+    return False
+
+
+class TestEvaluator():
+
+    def setup_method(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = LocalSQLite(filename=Path(self.tmp.name) / "test.sqlite")
+
+        self.feedback = Feedback(prompt_length).on_prompt()
+        self.db.insert_feedback_definition(self.feedback)
+        self.db.insert_app(App(app_id="app", root_class=Class.of_class(dict)))
+
+    def teardown_method(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def add_pending(self, n: int):
+        for i in range(n):
+            now = datetime.now()
+            record = Record(
+                app_id="app",
+                main_input="x" * i,
+                main_output="",
+                cost=Cost(),
+                perf=Perf(start_time=now, end_time=now)
+            )
+            self.db.insert_record_with_pending_feedbacks(
+                record, [
+                    FeedbackResult(
+                        record_id=record.record_id,
+                        feedback_definition_id=self.feedback.
+                        feedback_definition_id,
+                        name=self.feedback.name
+                    )
+                ]
+            )
+
+    def count_done(self) -> int:
+        return len(self.db.get_feedback(status=[FeedbackResultStatus.DONE]))
+
+    def test_evaluate(self):
+        self.add_pending(10)
+
+        evaluator = Evaluator(
+            filename=self.db.filename, workers=2, poll_interval=0.2
+        ).start()
+
+        try:
+            assert wait_for(lambda: self.count_done() == 10)
+
+            # Work added later is picked up as well.
+            self.add_pending(15)
+            assert wait_for(lambda: self.count_done() == 25)
+
+        finally:
+            evaluator.stop()
+
+        df = self.db.get_feedback()
+        assert set(df.status) == {FeedbackResultStatus.DONE}
+        assert set(df.result) == set(float(i) for i in range(15))
+        assert not evaluator.is_alive()
+
+    def test_wakeup(self):
+        # Idle workers notice new work well before their next poll.
+        evaluator = Evaluator(
+            filename=self.db.filename, workers=1, poll_interval=600
+        ).start()
+
+        try:
+            sleep(5)
+            start = time()
+            self.add_pending(1)
+            assert wait_for(lambda: self.count_done() == 1, timeout=30)
+            assert time() - start < 10
+
+        finally:
+            evaluator.stop()
+
+    def test_wait_for_work(self):
+        # Commits that leave nothing to claim, such as results written by
+        # other workers, do not end the wait; new pending feedback does.
+        self.add_pending(1)
+        assert len(self.db.claim_pending_feedback()) == 1
+
+        db = LocalSQLite(filename=self.db.filename)
+        stop = threading.Event()
+        waiter = threading.Thread(
+            target=_wait_for_work, args=(db, stop, 60, 0), daemon=True
+        )
+        waiter.start()
+
+        try:
+            sleep(0.5)
+            done = self.db.get_feedback().iloc[0]
+            self.db.insert_feedback(
+                FeedbackResult(
+                    feedback_result_id=done.feedback_result_id,
+                    record_id=done.record_id,
+                    feedback_definition_id=done.feedback_definition_id,
+                    name=done['name'],
+                    status=FeedbackResultStatus.DONE,
+                    result=1.0
+                )
+            )
+            sleep(0.5)
+            assert waiter.is_alive()
+
+            self.add_pending(1)
+            waiter.join(timeout=5)
+            assert not waiter.is_alive()
+
+        finally:
+            stop.set()
+            db.close()
+
+    def test_restart_crashed_worker(self):
+        evaluator = Evaluator(
+            filename=self.db.filename, workers=1, poll_interval=0.2
+        ).start()
+
+        try:
+            os.kill(evaluator._procs[0].pid, signal.SIGKILL)
+            assert wait_for(lambda: evaluator.restarts == 1)
+
+            self.add_pending(3)
+            assert wait_for(lambda: self.count_done() == 3)
+
+        finally:
+            evaluator.stop()
+
+    def test_db_settings(self):
+        # Workers open the database with the settings of the one given, here
+        # compressing what they write.
+        self.add_pending(3)
+        db = LocalSQLite(filename=self.db.filename, codec=ZlibCodec())
+
+        evaluator = Evaluator(db=db, workers=1, poll_interval=0.2).start()
+
+        try:
+            assert wait_for(lambda: self.count_done() == 3)
+
+        finally:
+            evaluator.stop()
+            db.close()
+
+        with self.db._transaction() as c:
+            c.execute(
+                "SELECT typeof(calls_json) FROM feedbacks WHERE status='done'"
+            )
+            assert {row[0] for row in c.fetchall()} == {"blob"}
+
+    def test_funneled_db(self):
+        # Workers of a database written by a WriterServer write through it.
+        self.add_pending(3)
+
+        server = WriterServer(db=self.db)
+        server.start()
+        db = FunneledSQLite(filename=self.db.filename)
+
+        evaluator = Evaluator(db=db, workers=1, poll_interval=0.2).start()
+
+        try:
+            assert wait_for(lambda: self.count_done() == 3)
+
+        finally:
+            evaluator.stop()
+            db.close()
+            server.stop()
+
+        assert server.written >= 3
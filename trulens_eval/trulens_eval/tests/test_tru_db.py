@@ -0,0 +1,2218 @@
+"""
+Tests and benchmarks for the database layer. The benchmarks are marked `slow`
+and print their measurements; run them with `pytest -s -m slow`. Set
+`TRULENS_BENCH_RECORDS` to change the size of the synthetic databases used by
+the query benchmarks.
+"""
+
+from datetime import datetime
+from datetime import timedelta
+import json
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+import os
+from pathlib import Path
+import multiprocessing
+import sqlite3
+import stat
+import tempfile
+import threading
+from time import perf_counter
+from time import sleep
+from typing import Any
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from trulens_eval.db_writer import DBWriter
+from trulens_eval.db_writer import FunneledSQLite
+from trulens_eval.db_writer import writer_authkey_file
+from trulens_eval.db_writer import WriterServer
+from trulens_eval.schema import App
+from trulens_eval.schema import Cost
+from trulens_eval.schema import FeedbackDefinition
+from trulens_eval.schema import FeedbackResult
+from trulens_eval.schema import FeedbackResultStatus
+from trulens_eval.schema import Perf
+from trulens_eval.schema import Record
+from trulens_eval.schema import RecordAppCall
+from trulens_eval.tru_db import db_of_url
+from trulens_eval.tru_db import InMemoryDB
+from trulens_eval.tru_db import LocalSQLite
+from trulens_eval.tru_db import RetentionPolicy
+from trulens_eval.tru_db import SQLiteSnapshot
+from trulens_eval.tru_db import TruDB
+from trulens_eval.tru_db import ZlibCodec
+from trulens_eval.util import Class
+from trulens_eval.util import json_str_of_obj
+from trulens_eval.util import TP
+
+
+def make_app(app_id: str = "app") -> App:
+    return App(app_id=app_id, root_class=Class.of_class(dict))
+
+
+def make_record(
+    app_id: str = "app", i: int = 0, latency: float = 1.0
+) -> Record:
+    start = datetime(2023, 6, 1) + timedelta(seconds=i)
+    return Record(
+        app_id=app_id,
+        main_input=f"question {i}",
+        main_output=f"answer {i}",
+        cost=Cost(n_tokens=10 + i, cost=0.01 * i),
+        perf=Perf(
+            start_time=start, end_time=start + timedelta(seconds=latency)
+        ),
+        ts=start
+    )
+
+
+def make_call(rets: Any) -> RecordAppCall:
+    now = datetime(2023, 6, 1)
+    return RecordAppCall(
+        stack=[],
+        args=dict(query="question"),
+        rets=rets,
+        perf=Perf(start_time=now, end_time=now),
+        pid=0,
+        tid=0
+    )
+
+
+def make_feedback(
+    record: Record,
+    name: str = "relevance",
+    result: float = 0.5
+) -> FeedbackResult:
+    return FeedbackResult(
+        record_id=record.record_id,
+        feedback_definition_id="feedback_definition",
+        name=name,
+        result=result,
+        status=FeedbackResultStatus.DONE
+    )
+
+
+def _claim_all(filename: Path, worker_id: str, queue: multiprocessing.Queue):
+    db = LocalSQLite(filename=filename)
+
+    claims = []
+    while True:
+        claimed = db.claim_pending_feedback(limit=7, worker_id=worker_id)
+        if len(claimed) == 0:
+            break
+        claims.extend(claimed.feedback_result_id)
+
+    db.close()
+    queue.put(claims)
+
+
+def _write_all(
+    db_class: type, filename: Path, worker: int, n: int,
+    queue: multiprocessing.Queue, **kwargs
+):
+    # Writes n records, each with a feedback result, one at a time and
+    # reports how many of them failed.
+    db = db_class(filename=filename, **kwargs)
+
+    failed = 0
+    for i in range(n):
+        record = make_record(i=i)
+        record.record_id = f"record_{worker}_{i}"
+        try:
+            db.insert_record_with_pending_feedbacks(
+                record, [make_feedback(record)]
+            )
+        except Exception:
+            failed += 1
+
+    db.close()
+    queue.put(failed)
+
+
+def _run_writers(
+    db_class: type, filename: Path, workers: int, n: int, **kwargs
+) -> int:
+    # Runs `workers` processes writing with `_write_all` at the same time and
+    # returns the total number of failed writes.
+    queue = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=_write_all,
+            args=(db_class, filename, worker, n, queue),
+            kwargs=kwargs
+        ) for worker in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    failed = sum(queue.get() for _ in processes)
+    for process in processes:
+        process.join()
+
+    return failed
+
+
+class TestLocalSQLite():
+
+    def setup_method(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = LocalSQLite(filename=Path(self.tmp.name) / "test.sqlite")
+        self.db.insert_feedback_definition(
+            FeedbackDefinition(feedback_definition_id="feedback_definition")
+        )
+
+    def teardown_method(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_wal_mode(self):
+        conn, c = self.db._connect()
+        c.execute("PRAGMA journal_mode")
+        assert c.fetchone()[0] == "wal"
+
+    def test_migration(self):
+        with self.db._transaction() as c:
+            # Written by a release that did not track schema versions, whatever
+            # its version number.
+            c.execute("DROP INDEX feedbacks_status")
+            c.execute("DELETE FROM meta WHERE key='schema_version'")
+            c.execute(
+                "UPDATE meta SET value='0.2.9' WHERE key='trulens_version'"
+            )
+        self.db.close()
+
+        db = LocalSQLite(filename=self.db.filename)
+        assert db.get_meta().schema_version == db.MIGRATIONS[-1][0]
+
+        with db._transaction() as c:
+            c.execute("SELECT name FROM sqlite_master WHERE type='index'")
+            indexes = {row[0] for row in c.fetchall()}
+
+        assert "feedbacks_status" in indexes
+        assert "records_app_id_ts" in indexes
+
+        db.close()
+
+    def test_migration_retries(self):
+        # A database from before attempts were counted.
+        self.db.insert_app(make_app())
+        record = make_record()
+        self.db.insert_record(record)
+        with self.db._transaction() as c:
+            c.execute("DROP INDEX feedbacks_next_retry_ts")
+            c.execute("ALTER TABLE feedbacks DROP COLUMN next_retry_ts")
+            c.execute("ALTER TABLE feedbacks DROP COLUMN attempts")
+            c.execute(
+                "UPDATE meta SET value='1' WHERE key='schema_version'"
+            )
+            c.execute(
+                """INSERT INTO feedbacks (feedback_result_id, record_id,
+                    feedback_definition_id, last_ts, status, calls_json, name,
+                    cost_json)
+                VALUES ('old', ?, 'feedback_definition', 0, 'none',
+                    '{"calls": []}', 'relevance',
+                    '{"n_tokens": 0, "cost": 0.0}')""", (record.record_id,)
+            )
+        self.db.close()
+
+        db = LocalSQLite(filename=self.db.filename)
+        claimed = db.claim_pending_feedback()
+        assert list(claimed.feedback_result_id) == ["old"]
+        db.close()
+
+    def test_records_and_feedback(self):
+        self.db.insert_app(make_app("app1"))
+        self.db.insert_app(make_app("app2"))
+
+        records = [make_record("app1", i) for i in range(3)]
+        records.append(make_record("app2", 3))
+        for record in records:
+            self.db.insert_record(record)
+
+        self.db.insert_feedback(make_feedback(records[0], "relevance", 0.1))
+        self.db.insert_feedback(make_feedback(records[0], "toxicity", 0.2))
+        self.db.insert_feedback(make_feedback(records[1], "relevance", 0.3))
+
+        # A pending result next to a finished one of the same name.
+        pending = make_feedback(records[1], "relevance", None)
+        pending.update(status=FeedbackResultStatus.NONE)
+        self.db.insert_feedback(pending)
+
+        df, feedback_cols = self.db.get_records_and_feedback([])
+
+        assert set(feedback_cols) == {"relevance", "toxicity"}
+        assert len(df) == 4
+        assert list(df.columns[-4:]) == [
+            col for name in feedback_cols for col in [name, name + "_calls"]
+        ]
+
+        df = df.set_index("record_id")
+        assert df.loc[records[0].record_id, "relevance"] == 0.1
+        assert df.loc[records[0].record_id, "toxicity"] == 0.2
+        assert df.loc[records[0].record_id, "toxicity_calls"] == []
+        assert df.loc[records[1].record_id, "relevance"] == 0.3
+        assert np.isnan(df.loc[records[1].record_id, "toxicity"])
+        assert np.isnan(df.loc[records[2].record_id, "relevance"])
+        assert df.loc[records[3].record_id, "app_id"] == "app2"
+        assert df.loc[records[3].record_id, "type"] == "dict(builtins)"
+        assert df.loc[records[3].record_id, "latency"] == timedelta(seconds=1)
+
+        df, feedback_cols = self.db.get_records_and_feedback(["app2"])
+        assert list(df.record_id) == [records[3].record_id]
+        assert feedback_cols == []
+
+        assert self.db.get_app("app1")['app_id'] == "app1"
+        assert self.db.get_app("missing") is None
+
+        df = self.db.get_feedback(record_id=records[0].record_id)
+        assert set(df.name) == {"relevance", "toxicity"}
+
+    def test_records_and_feedback_without_json(self):
+        self.db.insert_app(make_app("app1"))
+        records = [make_record("app1", i) for i in range(2)]
+        self.db.insert_records(records)
+        self.db.insert_feedback(make_feedback(records[0], "relevance", 0.1))
+
+        df, feedback_cols = self.db.get_records_and_feedback(
+            [], include_json=False
+        )
+
+        assert feedback_cols == ["relevance"]
+        assert "record_json" not in df.columns
+        assert "app_json" not in df.columns
+        assert "relevance_calls" not in df.columns
+        assert set(df.type) == {"dict(builtins)"}
+
+        df = df.set_index("record_id")
+        assert df.loc[records[0].record_id, "relevance"] == 0.1
+
+        df = self.db.get_feedback(
+            record_id=records[0].record_id, include_json=False
+        )
+        assert "record_json" not in df.columns
+        assert list(df.calls_json) == [[]]
+
+        record_json = self.db.get_record_json(records[1].record_id)
+        assert Record(**record_json) == records[1]
+        assert self.db.get_record_json("missing") is None
+
+    def test_query_records(self):
+        for app_id in ["app0", "app1"]:
+            self.db.insert_app(make_app(app_id))
+
+        records = [
+            make_record(f"app{i % 2}", i, latency=10 - i) for i in range(10)
+        ]
+        for record in records[7:]:
+            record.tags = "slow"
+        self.db.insert_records(records)
+        self.db.insert_feedbacks(
+            [
+                make_feedback(record, "relevance", i / 10)
+                for i, record in enumerate(records)
+            ] + [make_feedback(records[4], "toxicity", 0.9)]
+        )
+
+        def ids(df):
+            return [int(text[-1]) for text in df.input]
+
+        df, feedback_cols = self.db.query_records(
+            app_ids=["app0"], order_by="-relevance"
+        )
+        assert ids(df) == [8, 6, 4, 2, 0]
+        assert set(feedback_cols) == {"relevance", "toxicity"}
+
+        df, _ = self.db.query_records(
+            feedback_filters={"relevance": (">=", 0.3)},
+            order_by="latency",
+            limit=3,
+            offset=1
+        )
+        assert ids(df) == [8, 7, 6]
+        assert list(df.relevance) == [0.8, 0.7, 0.6]
+
+        df, _ = self.db.query_records(tags=["slow"], order_by="-ts", offset=1)
+        assert ids(df) == [8, 7]
+
+        df, feedback_cols = self.db.query_records(
+            ts_range=(datetime(2023, 6, 1, 0, 0, 2), None),
+            feedback_filters={"toxicity": ("=", 0.9)},
+            include_json=False
+        )
+        assert ids(df) == [4]
+        assert df.toxicity[0] == 0.9
+        assert "record_json" not in df.columns
+
+        df, _ = self.db.query_records(
+            ts_range=(None, datetime(2023, 6, 1, 0, 0, 2)), order_by="ts"
+        )
+        assert ids(df) == [0, 1]
+
+        # The same as filtering all records in pandas.
+        for query in [dict(order_by="-total_cost", limit=4),
+                      dict(feedback_filters={"relevance": ("<", 0.5)},
+                           order_by="ts"), dict(app_ids=["app1"], tags=["slow"],
+                                                order_by="relevance")]:
+            df, _ = self.db.query_records(**query)
+            expected, _ = TruDB.query_records(self.db, **query)
+            assert ids(df) == ids(expected)
+
+        with pytest.raises(ValueError):
+            self.db.query_records(feedback_filters={"relevance": ("~", 0.5)})
+
+    def test_count_records(self):
+        for app_id in ["app0", "app1"]:
+            self.db.insert_app(make_app(app_id))
+
+        records = [make_record(f"app{i % 2}", i) for i in range(10)]
+        self.db.insert_records(records + [make_record("missing", 10)])
+        self.db.insert_feedbacks(
+            [
+                make_feedback(record, "relevance", i / 10)
+                for i, record in enumerate(records)
+            ]
+        )
+
+        # Records of apps not in the db are not counted, as by query_records.
+        for query in [dict(), dict(app_ids=["app1"]),
+                      dict(feedback_filters={"relevance": (">", 0.25)}),
+                      dict(record_ids=[r.record_id for r in records[:3]],
+                           ts_range=(datetime(2023, 6, 1, 0, 0, 1), None))]:
+            expected = TruDB.count_records(self.db, **query)
+            assert self.db.count_records(**query) == expected
+
+        assert self.db.count_records() == 10
+        assert self.db.count_records(record_ids=[]) == 0
+
+    def test_feedback_histograms(self):
+        for app_id in ["app0", "app1"]:
+            self.db.insert_app(make_app(app_id))
+
+        records = [make_record(f"app{i % 2}", i) for i in range(10)]
+        self.db.insert_records(records)
+        self.db.insert_feedbacks(
+            [
+                make_feedback(record, "relevance", i / 9)
+                for i, record in enumerate(records)
+            ] + [make_feedback(records[1], "toxicity", 0.2)] +
+            [make_feedback(records[2], "toxicity", None)]
+        )
+
+        df = self.db.get_feedback_histograms()
+        assert list(df.index) == ["relevance", "toxicity"]
+        assert df.loc["relevance"].tolist() == [2, 2, 2, 2, 2]
+        assert df.loc["toxicity"].tolist() == [0, 1, 0, 0, 0]
+
+        bins = [0.0, 0.5, 1.0]
+        df = self.db.get_feedback_histograms(["app1"], bins=bins)
+        expected = TruDB.get_feedback_histograms(self.db, ["app1"], bins=bins)
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+        assert df.loc["relevance"].tolist() == [2, 3]
+
+        assert len(self.db.get_feedback_histograms(["missing"])) == 0
+
+    def test_app_cache(self):
+        self.db.insert_app(make_app("app1"))
+        records = [make_record("app1", i) for i in range(3)]
+        self.db.insert_records(records)
+        self.db.insert_feedbacks([make_feedback(record) for record in records])
+
+        df, _ = self.db.get_records_and_feedback([])
+        assert set(df.type) == {"dict(builtins)"}
+        assert len(self.db._app_cache) == 1
+
+        df = self.db.get_feedback()
+        assert len(self.db._app_cache) == 1
+        assert df.app_json[0]['app_id'] == "app1"
+
+        app = App(app_id="app1", root_class=Class.of_class(list))
+        self.db.insert_app(app)
+        assert len(self.db._app_cache) == 0
+
+        df, _ = self.db.get_records_and_feedback([], include_json=False)
+        assert set(df.type) == {"list(builtins)"}
+
+        df = self.db.get_feedback(include_json=False)
+        assert set(map(str, df.type)) == {"list(builtins)"}
+
+    def test_data_version(self):
+        version = self.db.get_data_version()
+
+        # Unchanged by writes through the same connection.
+        with self.db._transaction() as c:
+            c.execute("UPDATE meta SET value=value")
+        assert self.db.get_data_version() == version
+
+        other = LocalSQLite(filename=self.db.filename)
+        other.insert_app(make_app())
+        other.close()
+
+        assert self.db.get_data_version() != version
+
+    def test_data_stamp(self):
+        stamp = self.db.get_data_stamp()
+        assert self.db.get_data_stamp() == stamp
+
+        # Changed by writes of this process, through any thread, and of
+        # others, and the same for all threads.
+        TP().promise(self.db.insert_app, make_app()).get()
+        assert self.db.get_data_stamp() != stamp
+        stamp = self.db.get_data_stamp()
+        assert TP().promise(self.db.get_data_stamp).get() == stamp
+
+        other = LocalSQLite(filename=self.db.filename)
+        other.insert_record(make_record())
+        other.close()
+
+        assert self.db.get_data_stamp() != stamp
+
+    def test_claim_pending_feedback(self):
+        self.db.insert_app(make_app())
+        records = [make_record(i=i) for i in range(4)]
+        self.db.insert_records(records)
+
+        now = datetime.now()
+        pending = [
+            FeedbackResult(
+                record_id=record.record_id,
+                feedback_definition_id="feedback_definition",
+                name="relevance",
+                last_ts=now
+            ) for record in records
+        ]
+        pending[1].update(
+            status=FeedbackResultStatus.FAILED,
+            last_ts=now - timedelta(hours=1)
+        )
+        pending[2].update(status=FeedbackResultStatus.FAILED)
+        pending[3].update(status=FeedbackResultStatus.DONE, result=1.0)
+        self.db.insert_feedbacks(pending)
+
+        # Not started and failed long enough ago.
+        claimed = self.db.claim_pending_feedback(limit=10, worker_id="w1")
+        assert set(claimed.feedback_result_id) == {
+            pending[0].feedback_result_id, pending[1].feedback_result_id
+        }
+        assert set(claimed.status) == {FeedbackResultStatus.RUNNING}
+        assert claimed.record_json[0]['record_id'] in {
+            records[0].record_id, records[1].record_id
+        }
+        assert claimed.app_json[0]['app_id'] == "app"
+
+        # Claimed results are leased, including across updates of their
+        # status by the worker running them.
+        self.db.insert_feedback(
+            pending[0].update(status=FeedbackResultStatus.RUNNING)
+        )
+        assert len(self.db.claim_pending_feedback(worker_id="w2")) == 0
+
+        with self.db._transaction() as c:
+            c.execute(
+                "SELECT worker_id FROM feedbacks WHERE feedback_result_id=?",
+                (pending[0].feedback_result_id,)
+            )
+            assert c.fetchone()[0] == "w1"
+
+        # Expired leases can be claimed again.
+        with self.db._transaction() as c:
+            c.execute(
+                "UPDATE feedbacks SET lease_until=0, next_retry_ts=0 WHERE status='running'"
+            )
+        claimed = self.db.claim_pending_feedback(worker_id="w2")
+        assert len(claimed) == 2
+        assert len(self.db.claim_pending_feedback(worker_id="w3")) == 0
+
+    def test_default_claim_and_record_json(self):
+        # Databases that do not implement claims and single record reads still
+        # work, through the defaults in TruDB.
+        self.db.insert_app(make_app())
+        records = [make_record(i=i) for i in range(3)]
+        self.db.insert_records(records)
+
+        pending = [
+            FeedbackResult(
+                record_id=record.record_id,
+                feedback_definition_id="feedback_definition",
+                name="relevance"
+            ) for record in records
+        ]
+        pending[1].update(status=FeedbackResultStatus.FAILED)
+        pending[2].update(status=FeedbackResultStatus.DONE, result=1.0)
+        self.db.insert_feedbacks(pending)
+
+        claimed = TruDB.claim_pending_feedback(self.db)
+        assert list(claimed.feedback_result_id) == [
+            pending[0].feedback_result_id
+        ]
+        assert claimed.record_json[0]['record_id'] == records[0].record_id
+
+        assert TruDB.get_record_json(
+            self.db, records[1].record_id
+        ) == self.db.get_record_json(records[1].record_id)
+        assert TruDB.get_record_json(self.db, "missing") is None
+
+        class MinimalDB(TruDB):
+
+            def reset_database(self):
+                pass
+
+            def insert_record(self, record):
+                return record.record_id
+
+            def insert_app(self, app):
+                return app.app_id
+
+            def insert_feedback_definition(self, feedback_definition):
+                return feedback_definition.feedback_definition_id
+
+            def insert_feedback(self, feedback_result):
+                return feedback_result.feedback_result_id
+
+            def get_records_and_feedback(self, app_ids, include_json=True):
+                return pd.DataFrame(), []
+
+        MinimalDB()
+
+    def test_retry_backoff(self):
+        self.db.insert_app(make_app())
+        record = make_record()
+        self.db.insert_record(record)
+        result = FeedbackResult(
+            record_id=record.record_id,
+            feedback_definition_id="feedback_definition",
+            name="relevance"
+        )
+        self.db.insert_feedback(result)
+
+        def due():
+            with self.db._transaction() as c:
+                c.execute(
+                    "SELECT attempts, next_retry_ts - last_ts FROM feedbacks"
+                )
+                return c.fetchone()
+
+        delays = []
+        for attempt in range(1, self.db.MAX_ATTEMPTS + 1):
+            claimed = self.db.claim_pending_feedback(lease_seconds=60)
+            assert len(claimed) == 1
+            assert due() == (attempt, 60)
+
+            self.db.insert_feedback(
+                result.update(
+                    status=FeedbackResultStatus.FAILED, last_ts=datetime.now()
+                )
+            )
+            attempts, delay = due()
+            assert attempts == attempt
+            delays.append(delay)
+
+            # Not due until its retry delay has passed.
+            assert len(self.db.claim_pending_feedback()) == 0
+            with self.db._transaction() as c:
+                c.execute(
+                    "UPDATE feedbacks SET next_retry_ts=0 WHERE next_retry_ts IS NOT NULL"
+                )
+
+        assert delays == [
+            self.db.FAILED_RETRY_DELAY * 2**i
+            for i in range(self.db.MAX_ATTEMPTS - 1)
+        ] + [None]
+
+        # Completed results are never due.
+        self.db.insert_feedback(result.update(status=FeedbackResultStatus.DONE))
+        assert due()[1] is None
+
+    def test_claim_unclaimable_feedback(self):
+        self.db.insert_app(make_app())
+        record = make_record()
+        result = FeedbackResult(
+            record_id=record.record_id,
+            feedback_definition_id="feedback_definition",
+            name="relevance"
+        )
+
+        def row():
+            with self.db._transaction() as c:
+                c.execute(
+                    "SELECT status, attempts, next_retry_ts, error "
+                    "FROM feedbacks"
+                )
+                return c.fetchone()
+
+        def expire():
+            with self.db._transaction() as c:
+                c.execute(
+                    "UPDATE feedbacks SET next_retry_ts=0 "
+                    "WHERE next_retry_ts IS NOT NULL"
+                )
+
+        # Results written before their record wait for it without counting
+        # as attempts.
+        self.db.insert_feedback(result)
+        assert len(self.db.claim_pending_feedback(lease_seconds=60)) == 0
+        status, attempts, next_retry_ts, _ = row()
+        assert (status, attempts) == (FeedbackResultStatus.NONE.value, 0)
+        assert next_retry_ts > datetime.now().timestamp() + 50
+        assert self.db.next_claim_ts() == next_retry_ts
+
+        self.db.insert_record(record)
+        expire()
+
+        # Results never computed, such as by workers crashing on them, are
+        # given up on after MAX_ATTEMPTS claims.
+        for _ in range(self.db.MAX_ATTEMPTS):
+            assert len(self.db.claim_pending_feedback()) == 1
+            expire()
+
+        assert len(self.db.claim_pending_feedback()) == 0
+        status, attempts, next_retry_ts, error = row()
+        assert status == FeedbackResultStatus.FAILED.value
+        assert attempts == self.db.MAX_ATTEMPTS
+        assert next_retry_ts is None and error is not None
+        assert self.db.next_claim_ts() is None
+
+    def test_claim_pending_feedback_concurrently(self):
+        # Several processes claiming from the same db never get the same
+        # result.
+
+        self.db.insert_app(make_app())
+        records = [make_record(i=i) for i in range(100)]
+        self.db.insert_records(records)
+        self.db.insert_feedbacks(
+            [
+                FeedbackResult(
+                    record_id=record.record_id,
+                    feedback_definition_id="feedback_definition",
+                    name="relevance"
+                ) for record in records
+            ]
+        )
+
+        queue = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(
+                target=_claim_all, args=(self.db.filename, f"w{i}", queue)
+            ) for i in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        claims = [
+            feedback_result_id for _ in workers
+            for feedback_result_id in queue.get()
+        ]
+        for worker in workers:
+            worker.join()
+
+        assert len(claims) == 100
+        assert len(set(claims)) == 100
+
+    def test_locked_retries(self):
+        self.db.insert_app(make_app())
+        db = LocalSQLite(
+            filename=self.db.filename, busy_timeout=0.01, retry_delay=0.05
+        )
+
+        def hold_lock(seconds):
+            conn = sqlite3.connect(self.db.filename)
+            conn.execute("BEGIN IMMEDIATE")
+            locked.set()
+            sleep(seconds)
+            conn.rollback()
+            conn.close()
+
+        # Written once the lock is released.
+        locked = threading.Event()
+        holder = threading.Thread(target=hold_lock, args=(0.2,))
+        holder.start()
+        locked.wait()
+        db.insert_record(make_record(i=0))
+        holder.join()
+        assert len(db.get_records_and_feedback([])[0]) == 1
+
+        # Not retried forever.
+        db.max_retries = 1
+        locked = threading.Event()
+        holder = threading.Thread(target=hold_lock, args=(1.0,))
+        holder.start()
+        locked.wait()
+        with pytest.raises(sqlite3.OperationalError):
+            db.insert_record(make_record(i=1))
+        holder.join()
+
+        db.close()
+
+    def test_concurrent_writers(self):
+        self.db.insert_app(make_app())
+
+        failed = _run_writers(LocalSQLite, self.db.filename, workers=4, n=50)
+
+        assert failed == 0
+        df, feedback_cols = self.db.get_records_and_feedback([])
+        assert len(df) == 200
+
+    def test_funneled_writers(self):
+        self.db.insert_app(make_app())
+        server = WriterServer(db=self.db)
+        server.start()
+
+        failed = _run_writers(FunneledSQLite, self.db.filename, workers=4, n=50)
+        server.stop()
+
+        assert failed == 0
+        assert server.written == 400
+        df, feedback_cols = self.db.get_records_and_feedback([])
+        assert len(df) == 200
+        assert len(self.db.get_feedback()) == 200
+
+        # Writes go to the database directly while the writer is down.
+        db = FunneledSQLite(filename=self.db.filename)
+        db.insert_record(make_record(i=100))
+        assert len(self.db.get_records_and_feedback([])[0]) == 201
+
+        # And to the writer again once it is back.
+        server = WriterServer(db=self.db)
+        server.start()
+        db.insert_records([make_record(i=101), make_record(i=102)])
+        server.stop()
+        assert server.written == 2
+        db.close()
+
+    def test_funneled_writer_errors(self):
+        self.db.insert_app(make_app())
+        server = WriterServer(db=self.db)
+
+        # A batch shared by a client writing a record with its result and one
+        # whose second result cannot be written.
+        good, bad = make_record(i=0), make_record(i=1)
+        batch = [
+            ([good], [make_feedback(good)], threading.Event(), []),
+            ([bad], [make_feedback(bad), None], threading.Event(), []),
+        ]
+        server._write(batch)
+
+        assert all(done.is_set() for _, _, done, _ in batch)
+        assert batch[0][3] == []
+        assert len(batch[1][3]) == 1
+        assert server.written == 2 and server.failed == 3
+
+        # Nothing of the failed write is kept, not even its record.
+        df, feedback_cols = self.db.get_records_and_feedback([])
+        assert list(df.record_id) == [good.record_id]
+        assert list(self.db.get_feedback().record_id) == [good.record_id]
+
+    def test_funneled_writers_authkey(self):
+        self.db.insert_app(make_app())
+        server = WriterServer(db=self.db)
+        server.start()
+
+        try:
+            # Only the user running the writer can reach it or read its key.
+            key_file = writer_authkey_file(server.address)
+            assert stat.S_IMODE(os.stat(server.address).st_mode) == 0o600
+            assert stat.S_IMODE(os.stat(key_file).st_mode) == 0o600
+
+            with pytest.raises(AuthenticationError):
+                Client(server.address, family="AF_UNIX", authkey=b"wrong")
+
+            # Clients with the wrong key write directly instead.
+            db = FunneledSQLite(
+                filename=self.db.filename, writer_authkey=b"wrong"
+            )
+            db.insert_record(make_record(i=0))
+            db.close()
+            assert server.written == 0
+            assert len(self.db.get_records_and_feedback([])[0]) == 1
+
+            db = FunneledSQLite(filename=self.db.filename)
+            db.insert_record(make_record(i=1))
+            db.close()
+            assert server.written == 1
+
+        finally:
+            server.stop()
+
+        assert not os.path.exists(key_file)
+
+    def test_bulk_inserts(self):
+        self.db.insert_app(make_app())
+
+        records = [make_record(i=i) for i in range(3)]
+        self.db.insert_records(records[:2])
+
+        pending = [
+            FeedbackResult(
+                record_id=records[2].record_id,
+                feedback_definition_id="feedback_definition",
+                name=f"feedback{i}"
+            ) for i in range(3)
+        ]
+        self.db.insert_record_with_pending_feedbacks(records[2], pending)
+        self.db.insert_feedbacks([make_feedback(records[0])])
+
+        df, feedback_cols = self.db.get_records_and_feedback([])
+        assert len(df) == 3
+
+        df = self.db.get_feedback(status=[FeedbackResultStatus.NONE])
+        assert set(df.name) == {"feedback0", "feedback1", "feedback2"}
+        assert set(df.record_id) == {records[2].record_id}
+
+    def test_writer(self):
+        self.db.insert_app(make_app())
+        pending_batches = []
+        writer = DBWriter(
+            db=self.db,
+            flush_interval=0.05,
+            on_pending=lambda: pending_batches.append(True)
+        )
+
+        records = [make_record(i=i) for i in range(5)]
+        for record in records[:4]:
+            writer.put_record(record)
+        writer.put_record(
+            records[4], feedback_results=[make_feedback(records[4])]
+        )
+        writer.put_feedbacks([make_feedback(records[0], result=0.9)])
+
+        assert writer.flush(timeout=5)
+        writer.stop()
+
+        assert writer.stats() == dict(
+            queued=0, written=7, failed=0, dropped=0, retried=0
+        )
+        assert len(pending_batches) == 0
+
+        df, feedback_cols = self.db.get_records_and_feedback([])
+        assert len(df) == 5
+        df = df.set_index("record_id")
+        assert df.loc[records[0].record_id, "relevance"] == 0.9
+
+        with pytest.raises(RuntimeError):
+            writer.put_record(make_record(i=5))
+
+        # Batches with feedback still to be computed are signalled.
+        writer = DBWriter(
+            db=self.db,
+            flush_interval=0.05,
+            on_pending=lambda: pending_batches.append(True)
+        )
+        record = make_record(i=6)
+        writer.put_record(
+            record,
+            feedback_results=[
+                FeedbackResult(
+                    record_id=record.record_id,
+                    feedback_definition_id="feedback_definition",
+                    name="relevance"
+                )
+            ]
+        )
+        assert writer.flush(timeout=5)
+        writer.stop()
+        assert len(pending_batches) == 1
+
+    def test_writer_failures(self):
+        self.db.insert_app(make_app())
+
+        # Fails the first two writes of records with feedback results, and
+        # every write of the feedback results named "bad".
+        failures = [RuntimeError("disk I/O error")] * 2
+        insert = self.db.insert_record_with_pending_feedbacks
+        insert_feedbacks = self.db.insert_feedbacks
+
+        def flaky_insert(record, feedback_results):
+            if len(failures) > 0:
+                raise failures.pop()
+            return insert(record=record, feedback_results=feedback_results)
+
+        def poisoned_insert_feedbacks(feedback_results):
+            if any(f.name == "bad" for f in feedback_results):
+                raise ValueError("bad feedback")
+            return insert_feedbacks(feedback_results=feedback_results)
+
+        object.__setattr__(
+            self.db, "insert_record_with_pending_feedbacks", flaky_insert
+        )
+        object.__setattr__(
+            self.db, "insert_feedbacks", poisoned_insert_feedbacks
+        )
+
+        writer = DBWriter(
+            db=self.db, flush_interval=0.05, max_retries=3, retry_delay=0.01
+        )
+        records = [make_record(i=i) for i in range(3)]
+        writer.put_record(records[0], [make_feedback(records[0])])
+        writer.put_record(records[1])
+        writer.put_feedbacks([make_feedback(records[1], name="bad")])
+        writer.put_feedbacks([make_feedback(records[2], name="harm")])
+        writer.put_record(records[2])
+
+        assert writer.flush(timeout=5)
+        writer.stop()
+
+        object.__delattr__(self.db, "insert_record_with_pending_feedbacks")
+        object.__delattr__(self.db, "insert_feedbacks")
+
+        # Retried until written, except for the bad result.
+        stats = writer.stats()
+        assert stats['failed'] == 1 and stats['written'] == 5
+        assert stats['retried'] >= 2
+
+        df, feedback_cols = self.db.get_records_and_feedback([])
+        assert len(df) == 3 and sorted(feedback_cols) == ["harm", "relevance"]
+
+    def test_writer_record_with_feedbacks(self):
+        # Records are written together with the feedback results queued with
+        # them.
+        self.db.insert_app(make_app())
+        written = []
+        insert = self.db.insert_record_with_pending_feedbacks
+
+        def recorded_insert(record, feedback_results):
+            written.append((record.record_id, len(feedback_results)))
+            return insert(record=record, feedback_results=feedback_results)
+
+        object.__setattr__(
+            self.db, "insert_record_with_pending_feedbacks", recorded_insert
+        )
+
+        writer = DBWriter(db=self.db, flush_interval=0.05)
+        record = make_record()
+        writer.put_record(
+            record, [make_feedback(record),
+                     make_feedback(record, name="harm")]
+        )
+        assert writer.flush(timeout=5)
+        writer.stop()
+
+        object.__delattr__(self.db, "insert_record_with_pending_feedbacks")
+
+        assert written == [(record.record_id, 2)]
+
+    def test_writer_flush_timeout(self):
+        self.db.insert_app(make_app())
+        release = threading.Event()
+        insert_records = self.db.insert_records
+
+        def slow_insert_records(records):
+            release.wait()
+            return insert_records(records=records)
+
+        object.__setattr__(self.db, "insert_records", slow_insert_records)
+
+        writer = DBWriter(db=self.db, flush_interval=0.01)
+        threads = threading.active_count()
+        writer.put_record(make_record())
+
+        # Timing out leaves nothing running behind.
+        assert not writer.flush(timeout=0.1)
+        assert threading.active_count() == threads
+
+        release.set()
+        assert writer.flush(timeout=5)
+        writer.stop()
+
+        object.__delattr__(self.db, "insert_records")
+        assert len(self.db.get_records_and_feedback([])[0]) == 1
+
+    def test_app_summaries(self):
+        for app_id in ["app0", "app1"]:
+            self.db.insert_app(make_app(app_id))
+
+        records = [
+            make_record(app_id=f"app{i % 2}", i=i, latency=i) for i in range(6)
+        ]
+        self.db.insert_records(records[:4])
+        for record in records[4:]:
+            self.db.insert_record_with_pending_feedbacks(
+                record, [
+                    FeedbackResult(
+                        record_id=record.record_id,
+                        feedback_definition_id="feedback_definition",
+                        name="relevance"
+                    )
+                ]
+            )
+        results = [
+            make_feedback(record, result=i / 10)
+            for i, record in enumerate(records[:4])
+        ]
+        self.db.insert_feedbacks(results)
+
+        # Replaced records and results are only counted once.
+        self.db.insert_record(records[0])
+        results[0].result = 0.0
+        self.db.insert_feedback(results[0])
+
+        # Pending results only count once done.
+        claimed = self.db.claim_pending_feedback()
+        assert len(claimed) == 2
+        done = make_feedback(records[4], result=0.4)
+        done.feedback_result_id = claimed.set_index("record_id").loc[
+            records[4].record_id, "feedback_result_id"]
+        self.db.insert_feedback(done)
+
+        df, feedback_cols = self.db.get_app_summaries()
+        expected, expected_cols = TruDB.get_app_summaries(self.db)
+        assert feedback_cols == expected_cols == ["relevance"]
+
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+
+        df = df.set_index("app_id")
+        assert list(df.records) == [3, 3]
+        assert list(df.latency) == pytest.approx([2.0, 3.0])
+        assert list(df.total_tokens) == [10 + 12 + 14, 11 + 13 + 15]
+        assert list(df.relevance) == pytest.approx([0.2, 0.2])
+
+        df, feedback_cols = self.db.get_app_summaries(["app1"])
+        assert list(df.app_id) == ["app1"]
+
+    def test_app_summary_percentiles(self):
+        self.db.insert_app(make_app("app0"))
+        self.db.insert_app(make_app("app1"))
+
+        # All the same, and spread out well beyond a minute.
+        self.db.insert_records(
+            [make_record("app0", i=i, latency=12.0) for i in range(100)]
+        )
+        latencies = [(i * 37) % 200 + 0.5 for i in range(200)]
+        records = [
+            make_record("app1", i=i, latency=latency)
+            for i, latency in enumerate(latencies)
+        ]
+        self.db.insert_records(records)
+
+        # And some exactly on the bounds of the latency bins.
+        bounds = self.db.LATENCY_SUMMARY_BINS[40:60]
+        self.db.insert_records(
+            [
+                make_record("app2", i=i, latency=latency)
+                for i, latency in enumerate(bounds * 3)
+            ]
+        )
+
+        def check():
+            df, _ = self.db.get_app_summaries()
+            df = df.set_index("app_id")
+
+            for q in [50, 95, 99]:
+                assert df.loc["app0", f"latency_p{q}"] == pytest.approx(12.0)
+                for app_id, values in [("app1", latencies),
+                                       ("app2", bounds * 3)]:
+                    assert df.loc[app_id, f"latency_p{q}"] == pytest.approx(
+                        np.percentile(values, q)
+                    )
+
+        check()
+
+        # Bins follow deleted and replaced records.
+        self.db.apply_retention(RetentionPolicy(max_records_per_app=150))
+        replaced = make_record("app1", i=199, latency=1000.0)
+        replaced.record_id = records[-1].record_id
+        self.db.insert_record(replaced)
+        latencies = latencies[50:-1] + [1000.0]
+        check()
+
+        # Only the latencies of one bin are skipped, through the index.
+        with self.db._transaction() as c:
+            c.execute(
+                f"""EXPLAIN QUERY PLAN
+                    SELECT {self.db._latency_sql("perf_json")} AS latency
+                    FROM records
+                    WHERE app_id=?
+                        AND {self.db._latency_sql("perf_json")} >= 1.0
+                    ORDER BY latency LIMIT 2""", ("app1",)
+            )
+            plan = " ".join(row[-1] for row in c.fetchall())
+        assert "SEARCH" in plan and "records_app_id_latency" in plan
+        assert "TEMP B-TREE" not in plan
+
+    def test_migration_latency_bins(self):
+        self.db.insert_app(make_app())
+        latencies = [0.5, 2.0, 2.0, 7.5]
+        self.db.insert_records(
+            [
+                make_record(i=i, latency=latency)
+                for i, latency in enumerate(latencies)
+            ]
+        )
+
+        with self.db._transaction() as c:
+            c.execute("DROP TABLE app_latency_bins")
+            c.execute(
+                "UPDATE meta SET value='10' WHERE key='schema_version'"
+            )
+        self.db.close()
+
+        db = LocalSQLite(filename=self.db.filename)
+        df, _ = db.get_app_summaries()
+        for q in [50, 95, 99]:
+            assert df[f"latency_p{q}"][0] == pytest.approx(
+                np.percentile(latencies, q)
+            )
+
+        with db._transaction() as c:
+            c.execute("SELECT SUM(records) FROM app_latency_bins")
+            assert c.fetchone()[0] == 4
+        db.close()
+
+    def test_migration_summaries(self):
+        self.db.insert_app(make_app())
+        records = [make_record(i=i, latency=i) for i in range(3)]
+        self.db.insert_records(records)
+        self.db.insert_feedbacks([make_feedback(record) for record in records])
+
+        with self.db._transaction() as c:
+            c.execute("DROP TABLE app_summary")
+            c.execute("DROP TABLE app_feedback_summary")
+            c.execute(
+                "UPDATE meta SET value='2' WHERE key='schema_version'"
+            )
+        self.db.close()
+
+        db = LocalSQLite(filename=self.db.filename)
+        df, feedback_cols = db.get_app_summaries()
+        assert list(df.records) == [3]
+        assert list(df.latency) == pytest.approx([1.0])
+        assert list(df.relevance) == [0.5]
+
+        # Not summarized again on reopening.
+        db.close()
+        db = LocalSQLite(filename=self.db.filename)
+        df, feedback_cols = db.get_app_summaries()
+        assert list(df.records) == [3]
+        db.close()
+
+    def test_timeseries(self):
+        for app_id in ["app0", "app1"]:
+            self.db.insert_app(make_app(app_id))
+
+        # Two records a minute per app; the first minute of app0 gets two more.
+        records = [
+            make_record(app_id=f"app{i % 2}", i=15 * i, latency=i / 4)
+            for i in range(16)
+        ] + [make_record(app_id="app0", i=1, latency=l) for l in [0.2, 3.0]]
+        records[-2].record_id = "extra0"
+        records[-1].record_id = "extra1"
+        self.db.insert_records(records)
+        self.db.insert_feedbacks(
+            [
+                make_feedback(record, result=i / 20)
+                for i, record in enumerate(records)
+            ]
+        )
+        self.db.insert_record(records[0])
+
+        df, feedback_cols = self.db.get_timeseries(granularity="minute")
+        expected, expected_cols = TruDB.get_timeseries(
+            self.db, granularity="minute"
+        )
+        assert feedback_cols == expected_cols == ["relevance"]
+        exact_cols = [
+            "app_id", "ts", "records", "latency", "total_cost", "total_tokens",
+            "relevance"
+        ]
+        pd.testing.assert_frame_equal(
+            df[exact_cols], expected[exact_cols], check_dtype=False
+        )
+
+        assert list(df.app_id) == ["app0"] * 4 + ["app1"] * 4
+        assert list(df.records) == [4, 2, 2, 2, 2, 2, 2, 2]
+        assert df.ts[1] == datetime(2023, 6, 1, 0, 1)
+
+        # Latencies 0, 0.5, 0.2 and 3.0 in the first minute of app0, one in
+        # each of the bins ending at 0.1, 0.25, 0.5 and 5.
+        first = df.iloc[0]
+        assert first.latency_p50 == pytest.approx(0.25)
+        assert first.latency_p99 == pytest.approx(2.5 + 2.5 * 0.96)
+        assert (df.latency_p50 <= df.latency_p95).all()
+
+        df, feedback_cols = self.db.get_timeseries(granularity="hour")
+        assert list(df.records) == [10, 8]
+
+        df, feedback_cols = self.db.get_timeseries(
+            app_ids=["app1"],
+            granularity="minute",
+            start=datetime(2023, 6, 1, 0, 1, 30),
+            end=datetime(2023, 6, 1, 0, 3)
+        )
+        assert list(df.ts) == [
+            datetime(2023, 6, 1, 0, 1),
+            datetime(2023, 6, 1, 0, 2)
+        ]
+
+        with pytest.raises(ValueError):
+            self.db.get_timeseries(granularity="week")
+
+    def test_migration_rollups(self):
+        self.db.insert_app(make_app())
+        records = [make_record(i=30 * i, latency=i) for i in range(3)]
+        self.db.insert_records(records)
+        self.db.insert_feedbacks([make_feedback(record) for record in records])
+
+        with self.db._transaction() as c:
+            c.execute("DROP TABLE app_rollups")
+            c.execute("DROP TABLE app_feedback_rollups")
+            c.execute(
+                "UPDATE meta SET value='3' WHERE key='schema_version'"
+            )
+        self.db.close()
+
+        db = LocalSQLite(filename=self.db.filename)
+        df, feedback_cols = db.get_timeseries(granularity="minute")
+        assert list(df.records) == [2, 1]
+        assert list(df.latency) == pytest.approx([0.5, 2.0])
+        assert list(df.relevance) == [0.5, 0.5]
+
+        # Not rolled up again on reopening.
+        db.close()
+        db = LocalSQLite(filename=self.db.filename)
+        df, feedback_cols = db.get_timeseries(granularity="day")
+        assert list(df.records) == [3]
+        db.close()
+
+    def test_feedback_before_record(self):
+        self.db.insert_app(make_app())
+        records = [make_record(i=30 * i) for i in range(3)]
+
+        def feedback_counts():
+            with self.db._transaction() as c:
+                c.execute("SELECT result_count FROM app_feedback_summary")
+                summary = [row[0] for row in c.fetchall()]
+                c.execute(
+                    "SELECT result_count FROM app_feedback_rollups "
+                    "WHERE granularity=60 ORDER BY period"
+                )
+                return summary, [row[0] for row in c.fetchall()]
+
+        # Results written before their records count once the records are.
+        self.db.insert_feedbacks(
+            [
+                make_feedback(record, result=i / 10)
+                for i, record in enumerate(records[:2])
+            ]
+        )
+        assert feedback_counts() == ([], [])
+        self.db.insert_records(records)
+        self.db.insert_feedback(make_feedback(records[2], result=0.2))
+        assert feedback_counts() == ([3], [2, 1])
+
+        df, feedback_cols = self.db.get_app_summaries()
+        expected, expected_cols = TruDB.get_app_summaries(self.db)
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+        assert list(df.relevance) == pytest.approx([0.1])
+
+        df, feedback_cols = self.db.get_timeseries(granularity="minute")
+        assert list(df.relevance) == pytest.approx([0.05, 0.2])
+
+        # Results left by a deleted record are uncounted with it, and not
+        # again when deleted themselves.
+        with self.db._transaction() as c:
+            c.execute(
+                "DELETE FROM records WHERE record_id=?",
+                (records[0].record_id,)
+            )
+            c.execute(
+                "DELETE FROM feedbacks WHERE record_id=?",
+                (records[0].record_id,)
+            )
+        assert feedback_counts() == ([2], [1, 1])
+
+        self.db.apply_retention(RetentionPolicy(max_size_mb=0.01))
+        assert feedback_counts() == ([0], [0, 0])
+
+    def test_migration_feedback_counts(self):
+        self.db.insert_app(make_app())
+        records = [make_record(i=i) for i in range(3)]
+        self.db.insert_records(records)
+        self.db.insert_feedbacks([make_feedback(record) for record in records])
+
+        # Counts that drifted before results were counted with their records.
+        with self.db._transaction() as c:
+            c.execute("UPDATE app_feedback_summary SET result_count=-1")
+            c.execute("UPDATE app_feedback_rollups SET result_count=-1")
+            c.execute(
+                "UPDATE meta SET value='9' WHERE key='schema_version'"
+            )
+        self.db.close()
+
+        db = LocalSQLite(filename=self.db.filename)
+        df, feedback_cols = db.get_app_summaries()
+        expected, expected_cols = TruDB.get_app_summaries(db)
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+
+        with db._transaction() as c:
+            c.execute("SELECT MIN(result_count) FROM app_feedback_rollups")
+            assert c.fetchone()[0] == 3
+        db.close()
+
+    def test_blobs(self):
+        self.db.blob_min_size = 100
+        self.db.insert_app(make_app())
+
+        # The same long contexts across records.
+        contexts = [f"context {i} " * 20 for i in range(3)]
+        records = [make_record(i=i) for i in range(4)]
+        for record in records:
+            record.main_output = contexts[0]
+            record.calls = [make_call(rets=contexts)]
+        self.db.insert_records(records[:3])
+        self.db.insert_record_with_pending_feedbacks(
+            records[3], [make_feedback(records[3])]
+        )
+
+        with self.db._transaction() as c:
+            c.execute("SELECT COUNT(*) FROM blobs")
+            # One per context, one for the list of them and one for the calls,
+            # which are the same in all records.
+            assert c.fetchone()[0] == 5
+
+            c.execute("SELECT record_json FROM records")
+            assert all(contexts[0] not in row[0] for row in c.fetchall())
+
+        for record in records:
+            assert self.db.get_record_json(record.record_id) == json.loads(
+                json_str_of_obj(record)
+            )
+
+        df = self.db.get_feedback()
+        assert df.record_json[0]["main_output"] == contexts[0]
+
+        df, feedback_cols = self.db.get_records_and_feedback([])
+        assert all(
+            json.loads(r)["calls"][0]["rets"] == contexts
+            for r in df.record_json
+        )
+
+        # Records written before blobs were enabled remain readable.
+        self.db.blob_min_size = None
+        self.db.insert_record(make_record(i=4))
+        df, feedback_cols = self.db.get_records_and_feedback([])
+        assert len(df) == 5
+
+    def test_retention(self):
+        self.db.blob_min_size = 100
+        for app_id in ["app0", "app1"]:
+            self.db.insert_app(make_app(app_id))
+
+        # The first 6 records are long past, the rest recent. Each shares a
+        # long output with one other record.
+        now = datetime.now()
+        records = [
+            make_record(app_id=f"app{i % 2}", i=i, latency=i)
+            for i in range(10)
+        ]
+        for i, record in enumerate(records):
+            if i >= 6:
+                record.ts = now - timedelta(seconds=10 - i)
+            record.main_output = f"output {i // 2} " * 20
+        self.db.insert_records(records)
+        self.db.insert_feedbacks([make_feedback(record) for record in records])
+
+        def record_ids():
+            df, _ = self.db.get_records_and_feedback([], include_json=False)
+            return set(df.record_id)
+
+        def count(table):
+            with self.db._transaction() as c:
+                c.execute(f"SELECT COUNT(*) FROM {table}")
+                return c.fetchone()[0]
+
+        deleted = self.db.apply_retention(
+            RetentionPolicy(max_age_days=1, batch_size=4)
+        )
+        assert deleted == 6
+        assert record_ids() == {record.record_id for record in records[6:]}
+        assert count("feedbacks") == 4
+        assert count("blobs") == 2
+
+        df, feedback_cols = self.db.get_app_summaries()
+        assert list(df.records) == [2, 2]
+        assert list(df.latency) == pytest.approx([7.0, 8.0])
+        assert list(df.relevance) == [0.5, 0.5]
+
+        df, feedback_cols = self.db.get_timeseries(granularity="day")
+        assert df.records.sum() == 4
+
+        # The newest records of each app are kept.
+        deleted = self.db.apply_retention(
+            RetentionPolicy(max_records_per_app=1)
+        )
+        assert deleted == 2
+        assert record_ids() == {records[8].record_id, records[9].record_id}
+        assert count("blobs") == 1
+
+        # Nothing is left within a limit smaller than the schema.
+        deleted = self.db.apply_retention(RetentionPolicy(max_size_mb=0.01))
+        assert deleted == 2
+        assert record_ids() == set()
+        assert count("feedbacks") == count("blobs") == count("blob_refs") == 0
+
+    def test_incremental_vacuum(self):
+        self.db.insert_app(make_app())
+
+        with self.db._transaction() as c:
+            c.execute("PRAGMA auto_vacuum")
+            assert c.fetchone()[0] == 2
+
+        records = [make_record(i=i) for i in range(200)]
+        for i, record in enumerate(records):
+            record.main_output = f"output {i} " * 200
+        self.db.insert_records(records)
+
+        def pages():
+            with self.db._transaction() as c:
+                c.execute("PRAGMA page_count")
+                page_count = c.fetchone()[0]
+                c.execute("PRAGMA freelist_count")
+                return page_count, c.fetchone()[0]
+
+        full, _ = pages()
+        self.db.apply_retention(RetentionPolicy(max_age_days=1))
+        page_count, freelist_count = pages()
+        assert freelist_count == 0
+        assert page_count < full / 4
+
+    def test_migration_blob_refs(self):
+        self.db.blob_min_size = 100
+        self.db.insert_app(make_app())
+
+        contexts = [f"context {i} " * 20 for i in range(3)]
+        records = [make_record(i=i) for i in range(3)]
+        for record in records:
+            record.calls = [make_call(rets=contexts[:record.cost.n_tokens - 9])]
+        self.db.insert_records(records)
+
+        with self.db._transaction() as c:
+            c.execute("SELECT record_id, blob_id FROM blob_refs")
+            refs = set(c.fetchall())
+            c.execute("DROP TABLE blob_refs")
+            c.execute(
+                "UPDATE meta SET value='4' WHERE key='schema_version'"
+            )
+        self.db.close()
+
+        db = LocalSQLite(filename=self.db.filename)
+        with db._transaction() as c:
+            c.execute("SELECT record_id, blob_id FROM blob_refs")
+            assert set(c.fetchall()) == refs
+
+        db.apply_retention(RetentionPolicy(max_records_per_app=1))
+        assert db.get_record_json(records[2].record_id
+                                 )["calls"][0]["rets"] == contexts
+        db.close()
+
+    def test_search_records(self):
+        for app_id in ["app0", "app1"]:
+            self.db.insert_app(make_app(app_id))
+
+        records = [make_record(f"app{i % 2}", i) for i in range(6)]
+        records[0].main_input = "How do I bake bread?"
+        records[1].main_output = "Baking bread takes 100% patience."
+        records[2].main_input = 'A "quoted" (question) AND more'
+        self.db.insert_records(records)
+        self.db.insert_feedback(make_feedback(records[1], "relevance", 0.9))
+
+        def inputs(text, **kwargs):
+            df, _ = self.db.search_records(text, **kwargs)
+            return list(df.input)
+
+        # Stems match and ranking puts the best match first.
+        assert inputs("bread bake") == ["How do I bake bread?", "question 1"]
+        assert inputs('"quoted" (question) AND') == [records[2].main_input]
+        assert set(inputs("question", app_ids=["app1"])
+                  ) == {"question 1", "question 3", "question 5"}
+        assert len(inputs("question", limit=2)) == 2
+        assert inputs("missing") == []
+        assert inputs("") == [f"question {i}" for i in [5, 4, 3]] + [
+            records[2].main_input, "question 1", "How do I bake bread?"
+        ]
+
+        df, feedback_cols = self.db.search_records("patience")
+        assert feedback_cols == ["relevance"]
+        assert list(df.relevance) == [0.9]
+
+        # The index follows replaced, deleted and vacuumed records.
+        records[0].main_input = "How do I bake cake?"
+        self.db.insert_record(records[0])
+        self.db.apply_retention(RetentionPolicy(max_records_per_app=2))
+        self.db.vacuum()
+        assert inputs("bake") == []
+        assert set(inputs("question")) == {
+            records[2].main_input, "question 3", "question 4", "question 5"
+        }
+
+        # Without the index, records are scanned for the words.
+        with self.db._transaction() as c:
+            c.execute("DROP TABLE records_fts")
+        assert inputs("ESTION 5") == ["question 5"]
+        assert inputs(
+            "question", limit=3
+        ) == ["question 5", "question 4", "question 3"]
+
+    def test_migration_records_fts(self):
+        self.db.insert_app(make_app())
+        self.db.insert_records([make_record(i=i) for i in range(3)])
+
+        with self.db._transaction() as c:
+            c.execute("DROP TABLE records_fts")
+            for trigger in ["insert", "delete", "update"]:
+                c.execute(f"DROP TRIGGER records_fts_{trigger}")
+            c.execute(
+                "UPDATE meta SET value='6' WHERE key='schema_version'"
+            )
+        self.db.close()
+
+        db = LocalSQLite(filename=self.db.filename)
+        db.insert_record(make_record(i=3))
+        df, _ = db.search_records("question")
+        assert len(df) == 4
+        db.close()
+
+    def test_snapshot(self):
+        self.db.insert_app(make_app())
+        self.db.insert_records([make_record(i=i) for i in range(3)])
+
+        filename = Path(self.tmp.name) / "test.sqlite.snapshot"
+        self.db.snapshot(filename)
+        snapshot = SQLiteSnapshot(filename=filename)
+
+        df, _ = snapshot.get_records_and_feedback([])
+        assert len(df) == 3
+        assert snapshot.get_app("app")["app_id"] == "app"
+
+        # A long read of the snapshot does not hold up writers of the
+        # database, nor the next snapshot, which is seen once it is taken.
+        with snapshot._transaction() as c:
+            c.execute("BEGIN")
+            c.execute("SELECT COUNT(*) FROM records")
+            self.db.busy_timeout = 0.01
+            self.db.max_retries = 0
+            self.db.insert_record(make_record(i=3))
+            self.db.snapshot(filename)
+            c.execute("SELECT COUNT(*) FROM records")
+            assert c.fetchone()[0] == 3
+
+        df, _ = snapshot.get_records_and_feedback([])
+        assert len(df) == 4
+
+        with pytest.raises(sqlite3.OperationalError):
+            snapshot.insert_record(make_record(i=4))
+
+        # The data stamp of a snapshot changes when it is replaced.
+        stamp = snapshot.get_data_stamp()
+        assert snapshot.get_data_stamp() == stamp
+        self.db.snapshot(filename)
+        assert snapshot.get_data_stamp() != stamp
+
+        with snapshot._transaction() as c:
+            c.execute("PRAGMA journal_mode")
+            assert c.fetchone()[0] == "delete"
+
+        snapshot.close()
+
+    def test_codec(self):
+        self.db.insert_app(make_app())
+
+        # Written as plain text before compression was enabled.
+        old = make_record(i=0)
+        self.db.insert_record(old)
+        self.db.insert_feedback(make_feedback(old))
+
+        self.db.codec = ZlibCodec(level=9)
+        new = make_record(i=1)
+        self.db.insert_record(new)
+        self.db.insert_feedback(make_feedback(new))
+
+        with self.db._transaction() as c:
+            c.execute("SELECT typeof(record_json) FROM records ORDER BY ts")
+            assert [row[0] for row in c.fetchall()] == ["text", "blob"]
+
+        for record in [old, new]:
+            assert self.db.get_record_json(record.record_id
+                                          )["main_input"] == record.main_input
+
+        df = self.db.get_feedback()
+        assert len(df) == 2
+        assert all(calls == [] for calls in df.calls_json)
+        assert set(r["record_id"] for r in df.record_json
+                  ) == {old.record_id, new.record_id}
+
+        df, feedback_cols = self.db.get_records_and_feedback([])
+        assert all(
+            json.loads(r)["record_id"] == record_id
+            for r, record_id in zip(df.record_json, df.record_id)
+        )
+        assert all(calls == [] for calls in df.relevance_calls)
+
+        # Values compressed by any codec remain readable without one.
+        self.db.codec = None
+        assert self.db.get_record_json(new.record_id
+                                      )["main_input"] == new.main_input
+
+
+class TestInMemoryDB():
+
+    def test_records_and_feedback(self):
+        db = InMemoryDB()
+        db.insert_app(make_app())
+        db.insert_feedback_definition(
+            FeedbackDefinition(feedback_definition_id="feedback_definition")
+        )
+
+        # Written from several threads at once through the one connection.
+        records = [make_record(i=i) for i in range(20)]
+        promises = [
+            TP().promise(
+                db.insert_record_with_pending_feedbacks, record,
+                [make_feedback(record)]
+            ) for record in records
+        ]
+        for promise in promises:
+            promise.get()
+
+        df, feedback_cols = db.get_records_and_feedback([])
+        assert len(df) == 20
+        assert feedback_cols == ["relevance"]
+
+        db.close()
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = Path(tmp) / "snapshot.sqlite"
+
+            db = InMemoryDB(snapshot_file=filename, snapshot_interval=0.1)
+            db.insert_app(make_app())
+            record = make_record()
+            db.insert_record(record)
+
+            sleep(0.5)
+            other = LocalSQLite(filename=filename)
+            assert other.get_record_json(record.record_id) is not None
+            other.close()
+
+            # A final snapshot is written on close and read back on start.
+            db.insert_record(make_record(i=1))
+            db.close()
+
+            db = InMemoryDB(snapshot_file=filename)
+            df, feedback_cols = db.get_records_and_feedback([])
+            assert len(df) == 2
+
+            stamp = db.get_data_stamp()
+            db.insert_record(make_record(i=2))
+            assert db.get_data_stamp() != stamp
+            db.close()
+
+    def test_db_of_url(self):
+        assert isinstance(db_of_url("sqlite://"), InMemoryDB)
+        assert isinstance(db_of_url("sqlite:///:memory:"), InMemoryDB)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            db = db_of_url(f"sqlite:///{tmp}/test.sqlite")
+            assert type(db) is LocalSQLite
+            assert db.filename == Path(tmp) / "test.sqlite"
+
+            db.snapshot(Path(tmp) / "test.sqlite.snapshot")
+            db.close()
+
+            db = db_of_url(f"sqlite+snapshot:///{tmp}/test.sqlite.snapshot")
+            assert type(db) is SQLiteSnapshot
+            db.close()
+
+            db = db_of_url(f"sqlite+writer:///{tmp}/test.sqlite")
+            assert type(db) is FunneledSQLite
+            db.close()
+
+        with pytest.raises(ValueError):
+            db_of_url("postgresql://localhost/trulens")
+
+
+@pytest.mark.slow
+def test_insert_throughput():
+    n = 2000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = LocalSQLite(filename=Path(tmp) / "bench.sqlite")
+        db.insert_app(make_app())
+        records = [make_record(i=i) for i in range(n)]
+
+        start = perf_counter()
+        for record in records:
+            db.insert_record(record)
+        elapsed = perf_counter() - start
+
+        print(f"\ninsert_record: {n / elapsed:.0f} records/s")
+
+    db = InMemoryDB()
+    db.insert_app(make_app())
+    records = [make_record(i=i) for i in range(n)]
+
+    start = perf_counter()
+    for record in records:
+        db.insert_record(record)
+    elapsed = perf_counter() - start
+
+    print(f"insert_record (in memory): {n / elapsed:.0f} records/s")
+
+
+@pytest.mark.slow
+def test_bulk_feedback_throughput():
+    n = 200
+    n_feedbacks = 8
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = LocalSQLite(filename=Path(tmp) / "bench.sqlite")
+        db.insert_app(make_app())
+        records = [make_record(i=i) for i in range(2 * n)]
+        feedbacks = [
+            [
+                make_feedback(record, name=f"feedback{j}")
+                for j in range(n_feedbacks)
+            ]
+            for record in records
+        ]
+
+        start = perf_counter()
+        for record, results in zip(records[:n], feedbacks[:n]):
+            db.insert_record(record)
+            for result in results:
+                db.insert_feedback(result)
+        single = perf_counter() - start
+
+        start = perf_counter()
+        for record, results in zip(records[n:], feedbacks[n:]):
+            db.insert_record_with_pending_feedbacks(record, results)
+        bulk = perf_counter() - start
+
+        print(
+            f"\nrecord + {n_feedbacks} feedbacks: {n / single:.0f} records/s "
+            f"one at a time, {n / bulk:.0f} records/s in one transaction"
+        )
+
+
+def _synthetic_db(
+    filename: Path,
+    n: int,
+    n_apps: int = 10,
+    n_feedbacks: int = 1
+) -> LocalSQLite:
+    # Rows are written directly, bypassing the pydantic models, so that large
+    # databases can be built quickly.
+
+    db = LocalSQLite(filename=filename)
+    db.insert_feedback_definition(
+        FeedbackDefinition(feedback_definition_id="feedback_definition")
+    )
+    for a in range(n_apps):
+        db.insert_app(make_app(f"app{a}"))
+
+    cost_json = '{"n_tokens": 10, "cost": 0.01}'
+    perf_json = (
+        '{"start_time": "2023-06-01T00:00:00", '
+        '"end_time": "2023-06-01T00:00:01.5"}'
+    )
+    calls_json = '{"calls": []}'
+
+    # All but the last app have the same number of records; the last one has
+    # only a few.
+    chunk = 100000
+    with db._transaction() as c:
+        for start in range(0, n, chunk):
+            rows = []
+            feedback_rows = []
+            for i in range(start, min(n, start + chunk)):
+                app_id = f"app{i % (n_apps - 1)}" if i >= 100 else f"app{n_apps - 1}"
+                record_id = f"record_{i}"
+                rows.append(
+                    (
+                        record_id, app_id, "input", "output",
+                        f'{{"record_id": "{record_id}"}}', "", 1685577600 + i,
+                        cost_json, perf_json
+                    )
+                )
+                for j in range(n_feedbacks):
+                    feedback_rows.append(
+                        (
+                            f"feedback_{i}_{j}", record_id,
+                            "feedback_definition", 1685577600 + i,
+                            FeedbackResultStatus.DONE.value if i >= 10 else
+                            FeedbackResultStatus.NONE.value, None, calls_json,
+                            0.5, "relevance" if j == 0 else f"feedback{j}",
+                            cost_json, 1685577600 + i if i < 10 else None
+                        )
+                    )
+            db._insert_or_replace_many(c, db.TABLE_RECORDS, rows)
+            c.executemany(
+                f"""INSERT INTO {db.TABLE_FEEDBACKS}
+                    ({', '.join(db.FEEDBACK_COLUMNS)})
+                    VALUES ({','.join('?' for _ in db.FEEDBACK_COLUMNS)})""",
+                feedback_rows
+            )
+
+    return db
+
+
+@pytest.mark.slow
+def test_index_query_speed():
+    n = int(os.environ.get("TRULENS_BENCH_RECORDS", 100000))
+
+    def timed(func, repeat=3):
+        start = perf_counter()
+        for _ in range(repeat):
+            func()
+        return (perf_counter() - start) / repeat
+
+    queries = dict(
+        feedback_of_record=lambda: db.get_feedback(record_id="record_1234"),
+        pending_feedback=lambda: db.
+        get_feedback(status=[FeedbackResultStatus.NONE]),
+        records_of_small_app=lambda: db.get_records_and_feedback(["app9"])
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = _synthetic_db(Path(tmp) / "bench.sqlite", n=n)
+
+        with_indexes = {name: timed(query) for name, query in queries.items()}
+
+        with db._transaction() as c:
+            c.execute(
+                "SELECT name FROM sqlite_master WHERE type='index' AND sql IS NOT NULL"
+            )
+            for (index,) in c.fetchall():
+                c.execute(f"DROP INDEX {index}")
+
+        without_indexes = {name: timed(query) for name, query in queries.items()}
+
+        print(f"\nqueries over {n} records:")
+        for name in queries:
+            print(
+                f"{name}: {without_indexes[name] * 1000:.1f} ms without "
+                f"indexes, {with_indexes[name] * 1000:.1f} ms with"
+            )
+
+
+@pytest.mark.slow
+def test_records_and_feedback_speed():
+    n = int(os.environ.get("TRULENS_BENCH_RECORDS", 100000))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = _synthetic_db(Path(tmp) / "bench.sqlite", n=n, n_feedbacks=8)
+
+        start = perf_counter()
+        df, feedback_cols = db.get_records_and_feedback([])
+        elapsed = perf_counter() - start
+
+        assert len(df) == n
+        assert len(feedback_cols) == 8
+
+        print(
+            f"\nget_records_and_feedback: {elapsed * 1000:.0f} ms for {n} "
+            f"records x 8 feedbacks"
+        )
+
+
+@pytest.mark.slow
+def test_app_summaries_speed():
+    n = int(os.environ.get("TRULENS_BENCH_RECORDS", 100000))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = perf_counter()
+        db = _synthetic_db(Path(tmp) / "bench.sqlite", n=n, n_feedbacks=8)
+        print(
+            f"\nbuilt {n} records x 8 feedbacks in {perf_counter() - start:.1f}s"
+        )
+
+        start = perf_counter()
+        df, feedback_cols = TruDB.get_app_summaries(db)
+        print(f"from records: {(perf_counter() - start) * 1000:.0f} ms")
+
+        start = perf_counter()
+        df, feedback_cols = db.get_app_summaries()
+        print(f"get_app_summaries: {(perf_counter() - start) * 1000:.1f} ms")
+
+        assert df.records.sum() == n
+        assert len(feedback_cols) == 8
+
+
+@pytest.mark.slow
+def test_timeseries_speed():
+    n = int(os.environ.get("TRULENS_BENCH_RECORDS", 100000))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = _synthetic_db(Path(tmp) / "bench.sqlite", n=n, n_feedbacks=8)
+
+        start = perf_counter()
+        df, feedback_cols = TruDB.get_timeseries(db, granularity="hour")
+        print(f"\nfrom records: {(perf_counter() - start) * 1000:.0f} ms")
+
+        start = perf_counter()
+        df, feedback_cols = db.get_timeseries(granularity="hour")
+        print(f"get_timeseries: {(perf_counter() - start) * 1000:.1f} ms")
+
+        assert df.records.sum() == n
+        assert len(feedback_cols) == 8
+
+
+@pytest.mark.slow
+def test_query_records_speed():
+    n = int(os.environ.get("TRULENS_BENCH_RECORDS", 100000))
+
+    query = dict(
+        app_ids=["app3"],
+        feedback_filters={"feedback1": (">", 0.4)},
+        order_by="-ts",
+        limit=50
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = _synthetic_db(Path(tmp) / "bench.sqlite", n=n, n_feedbacks=8)
+
+        start = perf_counter()
+        expected, _ = TruDB.query_records(db, **query)
+        print(f"\nfrom all records: {(perf_counter() - start) * 1000:.0f} ms")
+
+        start = perf_counter()
+        df, feedback_cols = db.query_records(**query)
+        print(f"query_records: {(perf_counter() - start) * 1000:.1f} ms")
+
+        assert list(df.record_id) == list(expected.record_id)
+        assert len(df) == 50
+
+
+@pytest.mark.slow
+def test_paged_records_speed():
+    n = int(os.environ.get("TRULENS_BENCH_RECORDS", 100000))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = _synthetic_db(Path(tmp) / "bench.sqlite", n=n, n_feedbacks=4)
+
+        def timed(func):
+            start = perf_counter()
+            result = func()
+            return result, (perf_counter() - start) * 1000
+
+        count, count_ms = timed(
+            lambda: db.count_records(
+                app_ids=["app0"], feedback_filters={"relevance": (">=", 0.5)}
+            )
+        )
+        (df, _), page_ms = timed(
+            lambda: db.query_records(
+                app_ids=["app0"],
+                order_by="-ts",
+                limit=50,
+                offset=1000,
+                include_json=False
+            )
+        )
+        histograms, histograms_ms = timed(db.get_feedback_histograms)
+
+        assert count > 0 and len(df) == 50
+        assert histograms.values.sum() == 4 * n
+
+        print(
+            f"\nover {n} records x 4 feedbacks: count_records {count_ms:.0f} "
+            f"ms, page of 50 {page_ms:.0f} ms, get_feedback_histograms "
+            f"{histograms_ms:.0f} ms"
+        )
+
+
+@pytest.mark.slow
+def test_search_records_speed():
+    n = int(os.environ.get("TRULENS_BENCH_RECORDS", 100000))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = _synthetic_db(Path(tmp) / "bench.sqlite", n=n)
+        with db._transaction() as c:
+            c.execute(
+                "UPDATE records SET input='what is the weather in ' || rowid"
+            )
+
+        start = perf_counter()
+        expected, _ = TruDB.search_records(db, "weather 4242")
+        print(f"\nfrom all records: {(perf_counter() - start) * 1000:.0f} ms")
+
+        start = perf_counter()
+        df, _ = db.search_records("weather 4242")
+        print(f"search_records: {(perf_counter() - start) * 1000:.1f} ms")
+
+        # Words match whole, unlike the substrings of the default.
+        assert list(df.input) == ["what is the weather in 4242"]
+        assert "what is the weather in 4242" in set(expected.input)
+
+        with db._transaction() as c:
+            c.execute("DROP TABLE records_fts")
+
+        start = perf_counter()
+        df, _ = db.search_records("weather 4242")
+        print(f"without index: {(perf_counter() - start) * 1000:.1f} ms")
+
+
+@pytest.mark.slow
+def test_concurrent_writers_speed():
+    workers = 8
+    n = int(os.environ.get("TRULENS_BENCH_RECORDS", 500))
+
+    def run(label, db_class, **kwargs):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = LocalSQLite(filename=Path(tmp) / "bench.sqlite")
+            db.insert_feedback_definition(
+                FeedbackDefinition(
+                    feedback_definition_id="feedback_definition"
+                )
+            )
+            db.insert_app(make_app())
+
+            server = None
+            if db_class is FunneledSQLite:
+                server = WriterServer(db=db)
+                server.start()
+
+            start = perf_counter()
+            failed = _run_writers(db_class, db.filename, workers, n, **kwargs)
+            elapsed = perf_counter() - start
+
+            if server is not None:
+                server.stop()
+
+            written = len(db.get_records_and_feedback([])[0])
+            db.close()
+
+        print(
+            f"{label}: {written} records in {elapsed:.1f}s "
+            f"({written / elapsed:.0f}/s), {failed} failed"
+        )
+        return written, failed
+
+    print(f"\n{workers} processes writing {n} records each:")
+    run("direct, no retries", LocalSQLite, busy_timeout=0.05, max_retries=0)
+    written, failed = run("direct", LocalSQLite)
+    assert failed == 0
+    written, failed = run("writer", FunneledSQLite)
+    assert failed == 0 and written == workers * n
+
+
+@pytest.mark.slow
+def test_retention_write_stalls():
+    # Longest wait of a writer while half of the records are deleted, in
+    # batches or all at once.
+    n = int(os.environ.get("TRULENS_BENCH_RECORDS", 100000))
+
+    print()
+    for batch_size in [500, n]:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = _synthetic_db(Path(tmp) / "bench.sqlite", n=n, n_feedbacks=8)
+
+            # Synthetic records are timestamped in seconds since the epoch;
+            # the app of the first 100 is deleted entirely.
+            policy = RetentionPolicy(
+                max_records_per_app=n // 20, batch_size=batch_size
+            )
+            retention = threading.Thread(
+                target=db.apply_retention, args=(policy,)
+            )
+
+            writer = LocalSQLite(filename=db.filename, busy_timeout=60)
+            stalls = []
+            start = perf_counter()
+            retention.start()
+            i = 0
+            while retention.is_alive():
+                begin = perf_counter()
+                writer.insert_record(make_record(app_id="app0", i=n + i))
+                stalls.append(perf_counter() - begin)
+                i += 1
+            elapsed = perf_counter() - start
+
+            print(
+                f"batch_size={batch_size}: deleted in {elapsed:.1f}s, "
+                f"{len(stalls)} inserts meanwhile, longest "
+                f"{max(stalls) * 1000:.0f} ms"
+            )
+            writer.close()
+            db.close()
+
+
+@pytest.mark.slow
+def test_codec_size_and_throughput():
+    n = 2000
+
+    # Records with long, repetitive text such as retrieved contexts.
+    records = []
+    for i in range(n):
+        record = make_record(i=i)
+        record.main_output = " ".join(
+            f"Paragraph {j} of the retrieved context for question {i}."
+            for j in range(100)
+        )
+        records.append(record)
+
+    print()
+    for codec in [None, ZlibCodec(level=1), ZlibCodec(level=6)]:
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = Path(tmp) / "bench.sqlite"
+            db = LocalSQLite(filename=filename, codec=codec)
+            db.insert_app(make_app())
+
+            start = perf_counter()
+            db.insert_records(records)
+            write = perf_counter() - start
+
+            start = perf_counter()
+            db.get_records_and_feedback([])
+            read = perf_counter() - start
+
+            with db._transaction() as c:
+                c.execute("VACUUM")
+            db.close()
+
+            name = "none" if codec is None else f"zlib({codec.level})"
+            print(
+                f"{name}: {filename.stat().st_size / 2**20:.1f} MiB, "
+                f"write {n / write:.0f} records/s, read {n / read:.0f} records/s"
+            )
+
+
+@pytest.mark.slow
+def test_blobs_size_and_throughput():
+    n = 2000
+
+    # Retrieval-heavy records: each gets a few of a small set of long chunks.
+    chunks = [
+        " ".join(f"Sentence {j} of document chunk {i}."
+                 for j in range(50))
+        for i in range(20)
+    ]
+    records = []
+    for i in range(n):
+        record = make_record(i=i)
+        record.main_output = " ".join(chunks[i % 20:i % 20 + 3])
+        record.calls = [make_call(rets=chunks[i % 17:i % 17 + 3])]
+        records.append(record)
+
+    print()
+    for blob_min_size in [None, 256]:
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = Path(tmp) / "bench.sqlite"
+            db = LocalSQLite(filename=filename, blob_min_size=blob_min_size)
+            db.insert_app(make_app())
+
+            start = perf_counter()
+            db.insert_records(records)
+            write = perf_counter() - start
+
+            start = perf_counter()
+            db.get_records_and_feedback([])
+            read = perf_counter() - start
+
+            with db._transaction() as c:
+                c.execute("VACUUM")
+            db.close()
+
+            print(
+                f"blob_min_size={blob_min_size}: "
+                f"{filename.stat().st_size / 2**20:.1f} MiB, "
+                f"write {n / write:.0f} records/s, read {n / read:.0f} records/s"
+            )
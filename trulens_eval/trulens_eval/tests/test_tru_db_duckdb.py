@@ -0,0 +1,439 @@
+"""
+Tests for the DuckDB database.
+"""
+
+from datetime import datetime
+from datetime import timedelta
+import os
+from pathlib import Path
+import tempfile
+from time import perf_counter
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("duckdb")
+
+from trulens_eval.schema import App
+from trulens_eval.schema import Cost
+from trulens_eval.schema import FeedbackDefinition
+from trulens_eval.schema import FeedbackResult
+from trulens_eval.schema import FeedbackResultStatus
+from trulens_eval.schema import Perf
+from trulens_eval.schema import Record
+from trulens_eval.tru_db import LocalSQLite
+from trulens_eval.tru_db import TruDB
+from trulens_eval.tru_db import ZlibCodec
+from trulens_eval.tru_db_duckdb import LocalDuckDB
+from trulens_eval.tru_db_duckdb import migrate_from_sqlite
+from trulens_eval.util import Class
+
+
+def make_app(app_id: str = "app") -> App:
+    return App(app_id=app_id, root_class=Class.of_class(dict))
+
+
+def make_record(
+    app_id: str = "app", i: int = 0, latency: float = 1.0
+) -> Record:
+    start = datetime(2023, 6, 1) + timedelta(seconds=i)
+    return Record(
+        app_id=app_id,
+        main_input=f"question {i}",
+        main_output=f"answer {i}",
+        cost=Cost(n_tokens=10 + i, cost=0.01 * i),
+        perf=Perf(
+            start_time=start, end_time=start + timedelta(seconds=latency)
+        ),
+        ts=start
+    )
+
+
+def make_feedback(
+    record: Record,
+    name: str = "relevance",
+    result: float = 0.5,
+    status: FeedbackResultStatus = FeedbackResultStatus.DONE
+) -> FeedbackResult:
+    return FeedbackResult(
+        record_id=record.record_id,
+        feedback_definition_id="feedback_definition",
+        name=name,
+        result=result,
+        status=status
+    )
+
+
+class TestLocalDuckDB():
+
+    def setup_method(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = LocalDuckDB(filename=Path(self.tmp.name) / "test.duckdb")
+        self.db.insert_feedback_definition(
+            FeedbackDefinition(feedback_definition_id="feedback_definition")
+        )
+
+    def teardown_method(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_records_and_feedback(self):
+        for app_id in ["app0", "app1"]:
+            self.db.insert_app(make_app(app_id))
+
+        records = [
+            make_record(app_id=f"app{i % 2}", i=i, latency=i) for i in range(4)
+        ]
+        self.db.insert_records(records)
+        self.db.insert_feedbacks(
+            [
+                make_feedback(record, result=i)
+                for i, record in enumerate(records)
+            ] + [make_feedback(records[0], name="harm", result=0.1)]
+        )
+
+        df, feedback_cols = self.db.get_records_and_feedback([])
+        assert len(df) == 4
+        assert sorted(feedback_cols) == ["harm", "relevance"]
+        assert list(df.relevance) == [0.0, 1.0, 2.0, 3.0]
+        assert list(df.latency) == [timedelta(seconds=i) for i in range(4)]
+        assert "record_json" in df.columns and "harm_calls" in df.columns
+
+        df, feedback_cols = self.db.get_records_and_feedback(
+            ["app1"], include_json=False
+        )
+        assert list(df.record_id
+                   ) == [records[1].record_id, records[3].record_id]
+        assert feedback_cols == ["relevance"]
+        assert "record_json" not in df.columns
+
+        assert self.db.get_record_json(records[2].record_id
+                                      )["main_input"] == "question 2"
+        assert self.db.get_record_json("missing") is None
+
+        df = self.db.get_feedback(record_id=records[0].record_id)
+        assert set(df.name) == {"harm", "relevance"}
+        assert set(df.status) == {FeedbackResultStatus.DONE}
+
+    def test_query_records(self):
+        for app_id in ["app0", "app1"]:
+            self.db.insert_app(make_app(app_id))
+
+        records = [
+            make_record(f"app{i % 2}", i, latency=10 - i) for i in range(10)
+        ]
+        for record in records[7:]:
+            record.tags = "slow"
+        self.db.insert_records(records)
+        self.db.insert_feedbacks(
+            [
+                make_feedback(record, result=i / 10)
+                for i, record in enumerate(records)
+            ]
+        )
+
+        def ids(df):
+            return [int(text[-1]) for text in df.input]
+
+        for query in [dict(app_ids=["app0"], order_by="-relevance"),
+                      dict(feedback_filters={"relevance": (">=", 0.3)},
+                           order_by="latency", limit=3, offset=1),
+                      dict(tags=["slow"], order_by="-ts", offset=1),
+                      dict(ts_range=(datetime(2023, 6, 1, 0, 0,
+                                              2), datetime(2023, 6, 1, 0, 0,
+                                                           5)), order_by="ts")]:
+            df, feedback_cols = self.db.query_records(**query)
+            expected, _ = TruDB.query_records(self.db, **query)
+            assert feedback_cols == ["relevance"]
+            assert ids(df) == ids(expected)
+
+        df, _ = self.db.query_records(
+            feedback_filters={"relevance": (">=", 0.3)},
+            order_by="latency",
+            limit=3,
+            offset=1,
+            include_json=False
+        )
+        assert ids(df) == [8, 7, 6]
+        assert list(df.relevance) == [0.8, 0.7, 0.6]
+        assert "record_json" not in df.columns
+
+    def test_count_records_and_histograms(self):
+        for app_id in ["app0", "app1"]:
+            self.db.insert_app(make_app(app_id))
+
+        records = [make_record(f"app{i % 2}", i=i) for i in range(10)]
+        self.db.insert_records(records)
+        self.db.insert_feedbacks(
+            [
+                make_feedback(record, result=i / 9)
+                for i, record in enumerate(records)
+            ]
+        )
+
+        for query in [dict(), dict(app_ids=["app1"]),
+                      dict(feedback_filters={"relevance": (">", 0.25)})]:
+            expected = TruDB.count_records(self.db, **query)
+            assert self.db.count_records(**query) == expected
+
+        for app_ids in [None, ["app1"]]:
+            df = self.db.get_feedback_histograms(app_ids)
+            expected = TruDB.get_feedback_histograms(self.db, app_ids)
+            pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+
+        assert self.db.get_feedback_histograms().loc["relevance"].tolist() == [
+            2, 2, 2, 2, 2
+        ]
+
+    def test_search_records(self):
+        self.db.insert_app(make_app())
+
+        records = [make_record(i=i) for i in range(4)]
+        records[1].main_output = "Bread needs FLOUR."
+        self.db.insert_records(records)
+
+        df, _ = self.db.search_records("flour question")
+        assert list(df.record_id) == [records[1].record_id]
+
+        df, _ = self.db.search_records("question", limit=2)
+        assert list(df.input) == ["question 3", "question 2"]
+
+        df, _ = self.db.search_records("missing")
+        assert len(df) == 0
+
+    def test_app_summaries(self):
+        for app_id in ["app0", "app1"]:
+            self.db.insert_app(make_app(app_id))
+
+        records = [
+            make_record(app_id=f"app{i % 2}", i=i, latency=i) for i in range(4)
+        ]
+        self.db.insert_records(records)
+        self.db.insert_feedbacks(
+            [
+                make_feedback(record, result=i)
+                for i, record in enumerate(records)
+            ]
+        )
+
+        df, feedback_cols = self.db.get_app_summaries()
+        expected, expected_cols = TruDB.get_app_summaries(self.db)
+        assert feedback_cols == expected_cols == ["relevance"]
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+
+        df = df.set_index("app_id")
+        assert list(df.records) == [2, 2]
+        assert list(df.latency) == [1.0, 2.0]
+        assert list(df.latency_p50) == [1.0, 2.0]
+        assert list(df.latency_p99) == pytest.approx([1.98, 2.98])
+        assert list(df.total_tokens) == [22, 24]
+        assert list(df.relevance) == [1.0, 2.0]
+
+        df, feedback_cols = self.db.get_app_summaries(["app1"])
+        assert list(df.app_id) == ["app1"]
+
+    def test_feedback_before_record(self):
+        for app_id in ["app0", "app1"]:
+            self.db.insert_app(make_app(app_id))
+
+        # Results written before their records, alone and in a batch, are
+        # counted with the app of their records once those are written.
+        records = [make_record(f"app{i % 2}", i=i) for i in range(4)]
+        self.db.insert_feedback(make_feedback(records[0], result=0.1))
+        self.db.insert_feedbacks(
+            [
+                make_feedback(record, result=i / 10)
+                for i, record in enumerate(records[1:], 1)
+            ]
+        )
+        self.db.insert_record(records[0])
+        self.db.insert_records(records[1:])
+
+        df, feedback_cols = self.db.get_app_summaries()
+        expected, expected_cols = TruDB.get_app_summaries(self.db)
+        assert feedback_cols == expected_cols == ["relevance"]
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+        assert list(df.relevance) == pytest.approx([0.15, 0.2])
+
+        for app_ids in [None, ["app1"]]:
+            df = self.db.get_feedback_histograms(app_ids)
+            expected = TruDB.get_feedback_histograms(self.db, app_ids)
+            pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+
+    def test_timeseries(self):
+        for app_id in ["app0", "app1"]:
+            self.db.insert_app(make_app(app_id))
+
+        records = [
+            make_record(app_id=f"app{i % 2}", i=15 * i, latency=i / 4)
+            for i in range(16)
+        ]
+        self.db.insert_records(records)
+        self.db.insert_feedbacks(
+            [
+                make_feedback(record, result=i / 20)
+                for i, record in enumerate(records)
+            ]
+        )
+
+        df, feedback_cols = self.db.get_timeseries(granularity="minute")
+        expected, expected_cols = TruDB.get_timeseries(
+            self.db, granularity="minute"
+        )
+        assert feedback_cols == expected_cols == ["relevance"]
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+        assert list(df.records) == [2] * 8
+
+        df, feedback_cols = self.db.get_timeseries(
+            app_ids=["app1"],
+            granularity="minute",
+            start=datetime(2023, 6, 1, 0, 1, 30),
+            end=datetime(2023, 6, 1, 0, 3)
+        )
+        assert list(df.ts) == [
+            datetime(2023, 6, 1, 0, 1),
+            datetime(2023, 6, 1, 0, 2)
+        ]
+
+    def test_data_stamp(self):
+        stamp = self.db.get_data_stamp()
+        assert self.db.get_data_stamp() == stamp
+
+        record = make_record()
+        self.db.insert_record(record)
+        assert self.db.get_data_stamp() != stamp
+
+        stamp = self.db.get_data_stamp()
+        self.db.insert_feedback(make_feedback(record))
+        assert self.db.get_data_stamp() != stamp
+
+    def test_claim_pending_feedback(self):
+        self.db.insert_app(make_app())
+
+        record = make_record()
+        pending = [
+            make_feedback(
+                record, name=f"feedback{i}", status=FeedbackResultStatus.NONE
+            ) for i in range(3)
+        ]
+        self.db.insert_record_with_pending_feedbacks(record, pending)
+
+        claimed = self.db.claim_pending_feedback(limit=2, worker_id="worker")
+        assert len(claimed) == 2
+        assert set(claimed.status) == {FeedbackResultStatus.RUNNING}
+        assert list(claimed.attempts) == [1, 1]
+
+        claimed = self.db.claim_pending_feedback(limit=2, worker_id="worker")
+        assert len(claimed) == 1
+        assert len(self.db.claim_pending_feedback()) == 0
+
+        # Writing a result keeps the count of attempts.
+        result = pending[0]
+        result.status = FeedbackResultStatus.DONE
+        self.db.insert_feedback(result)
+        df = self.db.get_feedback(feedback_result_id=result.feedback_result_id)
+        assert list(df.attempts) == [1]
+
+    def test_claim_unclaimable_feedback(self):
+        self.db.insert_app(make_app())
+        record = make_record()
+        result = make_feedback(record, status=FeedbackResultStatus.NONE)
+
+        def expire():
+            with self.db._transaction() as conn:
+                conn.execute(
+                    "UPDATE feedbacks SET next_retry_ts=0 "
+                    "WHERE next_retry_ts IS NOT NULL"
+                )
+
+        # Not claimed before its record is written, nor counted as attempts.
+        self.db.insert_feedback(result)
+        assert len(self.db.claim_pending_feedback()) == 0
+        expire()
+        assert len(self.db.claim_pending_feedback()) == 0
+
+        self.db.insert_record(record)
+        expire()
+        for _ in range(self.db.MAX_ATTEMPTS):
+            assert len(self.db.claim_pending_feedback()) == 1
+            expire()
+
+        # Given up on after MAX_ATTEMPTS claims.
+        assert len(self.db.claim_pending_feedback()) == 0
+        df = self.db.get_feedback()
+        assert list(df.status) == [FeedbackResultStatus.FAILED]
+        assert list(df.attempts) == [self.db.MAX_ATTEMPTS]
+
+    def test_migrate_from_sqlite(self):
+        sqlite_db = LocalSQLite(
+            filename=Path(self.tmp.name) / "test.sqlite",
+            codec=ZlibCodec(),
+            blob_min_size=10
+        )
+        sqlite_db.insert_feedback_definition(
+            FeedbackDefinition(feedback_definition_id="feedback_definition")
+        )
+        sqlite_db.insert_app(make_app())
+
+        records = [make_record(i=i, latency=i) for i in range(5)]
+        sqlite_db.insert_records(records)
+        sqlite_db.insert_feedbacks(
+            [
+                make_feedback(record, result=i)
+                for i, record in enumerate(records)
+            ]
+        )
+        sqlite_db.claim_pending_feedback()
+
+        migrate_from_sqlite(sqlite_db, self.db, chunk_size=2)
+        sqlite_db.close()
+
+        df, feedback_cols = self.db.get_records_and_feedback([])
+        assert len(df) == 5
+        assert list(df.relevance) == [0.0, 1.0, 2.0, 3.0, 4.0]
+        assert list(df.latency) == [timedelta(seconds=i) for i in range(5)]
+        assert all(calls == [] for calls in df.relevance_calls)
+        assert self.db.get_record_json(records[3].record_id
+                                      )["main_output"] == "answer 3"
+
+
+@pytest.mark.slow
+def test_app_summaries_speed():
+    # Records are generated by DuckDB itself so that large databases can be
+    # built quickly.
+    n = int(os.environ.get("TRULENS_BENCH_RECORDS", 10000000))
+    n_apps = 10
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = LocalDuckDB(filename=Path(tmp) / "bench.duckdb")
+        for a in range(n_apps):
+            db.insert_app(make_app(f"app{a}"))
+
+        start = perf_counter()
+        with db._transaction() as conn:
+            conn.execute(
+                f"""INSERT INTO {db.TABLE_RECORDS}
+                    SELECT 'record_' || i, 'app' || (i % {n_apps}), 'input',
+                        'output', '{{}}', '',
+                        TIMESTAMP '2023-06-01' + to_seconds(i), '{{}}', '{{}}',
+                        (i % 100) / 10, 10, 0.01
+                    FROM range({n}) t(i)"""
+            )
+            conn.execute(
+                f"""INSERT INTO {db.TABLE_FEEDBACKS}
+                    SELECT 'feedback_' || i, 'record_' || i,
+                        'feedback_definition', 1685577600 + i, 'done', NULL,
+                        '{{"calls": []}}', (i % 10) / 10, 'relevance', '{{}}',
+                        NULL, NULL, NULL, 1, 'app' || (i % {n_apps})
+                    FROM range({n}) t(i)"""
+            )
+        print(f"\ngenerated {n} records in {perf_counter() - start:.1f}s")
+
+        for _ in range(3):
+            start = perf_counter()
+            df, feedback_cols = db.get_app_summaries()
+            print(f"get_app_summaries: {(perf_counter() - start) * 1000:.0f}ms")
+
+        assert df.records.sum() == n
+
+        db.close()
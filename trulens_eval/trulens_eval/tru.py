@@ -1,3 +1,4 @@
+import atexit
 from datetime import datetime
 import logging
 from multiprocessing import Process
@@ -12,11 +13,16 @@ from typing import Iterable, List, Optional, Sequence, Union
 
 import pkg_resources
 
+from trulens_eval.db_writer import DBWriter
 from trulens_eval.schema import FeedbackResult
 from trulens_eval.schema import App
 from trulens_eval.schema import Record
+from trulens_eval.tru_db import db_of_url
+from trulens_eval.tru_db import InMemoryDB
 from trulens_eval.tru_db import JSON
 from trulens_eval.tru_db import LocalSQLite
+from trulens_eval.tru_db import RetentionPolicy
+from trulens_eval.tru_db import TruDB
 from trulens_eval.tru_feedback import Feedback
 from trulens_eval.utils.notebook_utils import is_notebook, setup_widget_stdout_stderr
 from trulens_eval.util import SingletonPerName
@@ -34,16 +40,27 @@ class Tru(SingletonPerName):
     * Run and log feedback functions
     * Run streamlit dashboard to view experiment results
 
-    All data is logged to the current working directory to default.sqlite.
+    All data is logged to the current working directory to default.sqlite
+    unless another database is given.
     """
     DEFAULT_DATABASE_FILE = "default.sqlite"
 
-    # Process or Thread of the deferred feedback function evaluator.
+    # Environment variable with the url of the database to use when none is
+    # given, see `tru_db.db_of_url`. Set for the dashboard by `run_dashboard`.
+    DATABASE_URL_ENV = "TRULENS_DATABASE_URL"
+
+    # Thread or process-based `Evaluator` of the deferred feedback functions.
     evaluator_proc = None
 
     # Process of the dashboard app.
     dashboard_proc = None
 
+    # Thread applying a retention policy to the database.
+    retention_thread = None
+
+    # Thread refreshing the snapshot of the database read by the dashboard.
+    snapshot_thread = None
+
     def Chain(self, chain, **kwargs):
         """
         Create a TruChain with database managed by self.
@@ -62,17 +79,54 @@ class Tru(SingletonPerName):
 
         return TruLlama(tru=self, app=engine, **kwargs)
 
-    def __init__(self):
+    def __init__(
+        self, database_url: Optional[str] = None, db: Optional[TruDB] = None
+    ):
         """
         TruLens instrumentation, logging, and feedback functions for apps.
-        Creates a local database 'default.sqlite' in current working directory.
+        Creates a local database 'default.sqlite' in current working directory
+        unless a database is given, here or by url in the environment variable
+        `TRULENS_DATABASE_URL`.
+
+        Args:
+
+            - database_url: Optional[str]: Database to use, see
+              `tru_db.db_of_url`. For example "sqlite://" for an in-memory
+              database.
+
+            - db: Optional[TruDB]: Database to use.
         """
 
         if hasattr(self, "db"):
             # Already initialized by SingletonByName mechanism.
+            if database_url is not None or db is not None:
+                logger.warning(
+                    f"Tru is already using {self.db}; the given database is ignored."
+                )
             return
 
-        self.db = LocalSQLite(filename=Path(Tru.DEFAULT_DATABASE_FILE))
+        if db is not None and database_url is not None:
+            raise ValueError("Give either `database_url` or `db`, not both.")
+
+        if db is None and database_url is None:
+            database_url = os.environ.get(Tru.DATABASE_URL_ENV)
+
+        if db is not None:
+            self.db = db
+        elif database_url is not None:
+            self.db = db_of_url(database_url)
+        else:
+            self.db = LocalSQLite(filename=Path(Tru.DEFAULT_DATABASE_FILE))
+
+        # Write-behind logger used by apps so that database writes are not
+        # part of their request latency. Drained on interpreter exit. Records
+        # of apps only show up in the database once written; see `flush`.
+        self.writer = DBWriter(db=self.db, on_pending=self.notify_evaluator)
+        atexit.register(self.writer.stop)
+
+        # Set when there may be new pending feedback for the in-process
+        # evaluator.
+        self.evaluator_wakeup = threading.Event()
 
     def reset_database(self):
         """
@@ -103,6 +157,47 @@ class Tru(SingletonPerName):
 
         return self.db.insert_record(record=record)
 
+    def add_record_later(
+        self, record: Record, feedback_results: Sequence[FeedbackResult] = ()
+    ) -> None:
+        """
+        Queue a record, and any (possibly pending) feedback results on it, to be
+        written to the database by the background writer.
+        """
+
+        self.writer.put_record(record=record, feedback_results=feedback_results)
+
+    def add_feedbacks_later(
+        self, feedback_results: Sequence[FeedbackResult]
+    ) -> None:
+        """
+        Queue feedback results to be written to the database by the background
+        writer.
+        """
+
+        self.writer.put_feedbacks(feedback_results=feedback_results)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the background writer to write everything queued so far.
+        Returns False if `timeout` seconds passed first.
+
+        Apps write their records, and feedback results unless evaluated
+        deferred, through the background writer, so for example
+        `get_records_and_feedback` right after calling an app may not include
+        its record until this is called.
+        """
+
+        return self.writer.flush(timeout=timeout)
+
+    def notify_evaluator(self) -> None:
+        """
+        Wake up the in-process deferred feedback evaluator, if any, to look for
+        pending feedback now rather than at its next poll.
+        """
+
+        self.evaluator_wakeup.set()
+
     def run_feedback_functions(
         self,
         record: Record,
@@ -179,11 +274,10 @@ class Tru(SingletonPerName):
 
     def add_feedbacks(self, feedback_results: Iterable[FeedbackResult]) -> None:
         """
-        Add multiple feedback results to the database.
+        Add multiple feedback results to the database in one transaction.
         """
 
-        for feedback_result in feedback_results:
-            self.add_feedback(feedback_result=feedback_result)
+        self.db.insert_feedbacks(feedback_results=list(feedback_results))
 
     def get_app(self, app_id: Optional[str] = None) -> JSON:
         """
@@ -202,14 +296,21 @@ class Tru(SingletonPerName):
 
         return df, feedback_columns
 
-    def start_evaluator(self,
-                        restart=False,
-                        fork=False) -> Union[Process, Thread]:
-        """
-        Start a deferred feedback function evaluation thread.
+    def start_evaluator(
+        self,
+        restart=False,
+        fork=False,
+        workers: int = 2,
+        poll_interval: float = 10.0
+    ) -> Union[Thread, 'Evaluator']:
         """
+        Start a deferred feedback function evaluation thread or, if `fork`, an
+        evaluator with `workers` worker processes.
 
-        assert not fork, "Fork mode not yet implemented."
+        The thread is woken up by records with deferred feedback logged from
+        this process and the worker processes by any write to the database.
+        Both also look for work every `poll_interval` seconds.
+        """
 
         if self.evaluator_proc is not None:
             if restart:
@@ -219,32 +320,46 @@ class Tru(SingletonPerName):
                     "Evaluator is already running in this process."
                 )
 
+        if fork:
+            from trulens_eval.evaluator import Evaluator
+
+            if not isinstance(self.db, LocalSQLite) or isinstance(self.db,
+                                                                  InMemoryDB):
+                raise ValueError(
+                    f"Evaluator processes cannot share {self.db}. "
+                    "Use a sqlite file or start the evaluator without `fork`."
+                )
+
+            # Workers open a database like this one, with the same settings.
+            self.evaluator_proc = Evaluator(
+                db=self.db, workers=workers, poll_interval=poll_interval
+            ).start()
+
+            return self.evaluator_proc
+
         from trulens_eval.tru_feedback import Feedback
 
-        if not fork:
-            self.evaluator_stop = threading.Event()
+        self.evaluator_stop = threading.Event()
 
         def runloop():
-            while fork or not self.evaluator_stop.is_set():
+            while not self.evaluator_stop.is_set():
                 print(
                     "Looking for things to do. Stop me with `tru.stop_evaluator()`.",
                     end=''
                 )
-                Feedback.evaluate_deferred(tru=self)
+                limit = 256
+                started = Feedback.evaluate_deferred(tru=self, limit=limit)
                 TP().finish(timeout=10)
-                if fork:
-                    sleep(10)
-                else:
-                    self.evaluator_stop.wait(10)
 
-            print("Evaluator stopped.")
+                # A full batch means there may be more waiting already.
+                if started < limit:
+                    self.evaluator_wakeup.wait(poll_interval)
+                self.evaluator_wakeup.clear()
 
-        if fork:
-            proc = Process(target=runloop)
-        else:
-            proc = Thread(target=runloop)
+            print("Evaluator stopped.")
 
-        # Start a persistent thread or process that evaluates feedback functions.
+        # Start a persistent thread that evaluates feedback functions.
+        proc = Thread(target=runloop)
 
         self.evaluator_proc = proc
         proc.start()
@@ -253,22 +368,72 @@ class Tru(SingletonPerName):
 
     def stop_evaluator(self):
         """
-        Stop the deferred feedback evaluation thread.
+        Stop the deferred feedback evaluation thread or processes.
         """
 
         if self.evaluator_proc is None:
             raise RuntimeError("Evaluator not running this process.")
 
-        if isinstance(self.evaluator_proc, Process):
-            self.evaluator_proc.terminate()
-
-        elif isinstance(self.evaluator_proc, Thread):
+        if isinstance(self.evaluator_proc, Thread):
             self.evaluator_stop.set()
+            self.evaluator_wakeup.set()
             self.evaluator_proc.join()
             self.evaluator_stop = None
 
+        else:
+            self.evaluator_proc.stop()
+
         self.evaluator_proc = None
 
+    def start_retention(
+        self, policy: RetentionPolicy, interval: float = 60 * 60.0
+    ) -> Thread:
+        """
+        Start a thread that applies the retention `policy` to the database now
+        and then every `interval` seconds, deleting old records and their
+        feedback results in small batches; see `TruDB.apply_retention`.
+        """
+
+        if self.retention_thread is not None:
+            raise RuntimeError("Retention is already running in this process.")
+
+        self.retention_stop = threading.Event()
+
+        def runloop():
+            while True:
+                try:
+                    deleted = self.db.apply_retention(policy)
+                    if deleted > 0:
+                        logger.info(
+                            f"Deleted {deleted} record(s) from {self.db}."
+                        )
+
+                except Exception as e:
+                    logger.error(
+                        f"Could not apply retention policy to {self.db}: {e}"
+                    )
+
+                if self.retention_stop.wait(interval):
+                    break
+
+        self.retention_thread = Thread(target=runloop, daemon=True)
+        self.retention_thread.start()
+
+        return self.retention_thread
+
+    def stop_retention(self) -> None:
+        """
+        Stop the retention thread, waiting for the policy being applied, if
+        it is, to finish.
+        """
+
+        if self.retention_thread is None:
+            raise RuntimeError("Retention not running in this process.")
+
+        self.retention_stop.set()
+        self.retention_thread.join()
+        self.retention_thread = None
+
     def stop_dashboard(self, force: bool = False) -> None:
         """
         Stop existing dashboard(s) if running.
@@ -310,8 +475,16 @@ class Tru(SingletonPerName):
             Tru.dashboard_proc.kill()
             Tru.dashboard_proc = None
 
+        if Tru.snapshot_thread is not None:
+            Tru.snapshot_stop.set()
+            Tru.snapshot_thread.join()
+            Tru.snapshot_thread = None
+
     def run_dashboard(
-        self, force: bool = False, _dev: Optional[Path] = None
+        self,
+        force: bool = False,
+        _dev: Optional[Path] = None,
+        snapshot_interval: Optional[float] = None
     ) -> Process:
         """
         Run a streamlit dashboard to view logged results and apps.
@@ -324,6 +497,12 @@ class Tru(SingletonPerName):
               PYTHONPATH. This can be used to run the dashboard from outside of
               its pip package installation folder.
 
+            - snapshot_interval: Optional[float]: If given, the dashboard reads
+              a copy of the sqlite database refreshed every `snapshot_interval`
+              seconds by this process, so that its queries and the writes of
+              apps and evaluators never wait for each other. Otherwise it reads
+              the database itself.
+
         Raises:
 
             - ValueError: Dashboard is already running.
@@ -373,6 +552,12 @@ class Tru(SingletonPerName):
             env_opts['env'] = os.environ
             env_opts['env']['PYTHONPATH'] = str(_dev)
 
+        if snapshot_interval is not None:
+            snapshot_file = self._start_snapshots(snapshot_interval)
+            env_opts['env'] = env_opts.get('env', os.environ.copy())
+            env_opts['env'][Tru.DATABASE_URL_ENV
+                           ] = f"sqlite+snapshot:///{snapshot_file.resolve()}"
+
         proc = subprocess.Popen(
             ["streamlit", "run", "--server.headless=True", leaderboard_path],
             stdout=subprocess.PIPE,
@@ -427,3 +612,40 @@ class Tru(SingletonPerName):
         return proc
 
     start_dashboard = run_dashboard
+
+    def _start_snapshots(self, interval: float) -> Path:
+        """
+        Snapshot the database now and start a thread refreshing the snapshot
+        every `interval` seconds until the dashboard is stopped. Returns the
+        snapshot file.
+        """
+
+        if isinstance(self.db, InMemoryDB):
+            snapshot_file = self.db.snapshot_file
+            if snapshot_file is None:
+                raise ValueError(
+                    "Dashboard snapshots of an in-memory database need its "
+                    "snapshot_file."
+                )
+        elif isinstance(self.db, LocalSQLite):
+            snapshot_file = Path(f"{self.db.filename}.snapshot")
+        else:
+            raise ValueError(
+                f"Dashboard snapshots are not supported for {self.db}."
+            )
+
+        self.db.snapshot(snapshot_file)
+
+        Tru.snapshot_stop = threading.Event()
+
+        def runloop():
+            while not Tru.snapshot_stop.wait(interval):
+                try:
+                    self.db.snapshot(snapshot_file)
+                except Exception as e:
+                    logger.error(f"Could not snapshot {self.db}: {e}")
+
+        Tru.snapshot_thread = Thread(target=runloop, daemon=True)
+        Tru.snapshot_thread.start()
+
+        return snapshot_file
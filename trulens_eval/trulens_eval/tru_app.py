@@ -155,11 +155,12 @@ class TruApp(App, SerialModel):
 
             raise error
 
-        if self.feedback_mode == FeedbackMode.WITH_APP:
+        if self.feedback_mode in [FeedbackMode.WITH_APP, FeedbackMode.DEFERRED]:
+            # Only queues writes in DEFERRED mode; in WITH_APP the feedback
+            # functions run here but their results are still written later.
             self._handle_record(record=ret_record)
 
-        elif self.feedback_mode in [FeedbackMode.DEFERRED,
-                                    FeedbackMode.WITH_APP_THREAD]:
+        elif self.feedback_mode == FeedbackMode.WITH_APP_THREAD:
             TP().runlater(self._handle_record, record=ret_record)
 
         return ret_record
@@ -172,31 +173,33 @@ class TruApp(App, SerialModel):
         if self.tru is None or self.feedback_mode is None:
             return
 
-        record_id = self.tru.add_record(record=record)
-
-        if len(self.feedbacks) == 0:
-            return
-
-        # Add empty (to run) feedback to db.
         if self.feedback_mode == FeedbackMode.DEFERRED:
-            for f in self.feedbacks:
-                self.db.insert_feedback(
+            # Add record and empty (to run) feedback to db together.
+            self.tru.add_record_later(
+                record=record,
+                feedback_results=[
                     FeedbackResult(
                         name=f.name,
-                        record_id=record_id,
+                        record_id=record.record_id,
                         feedback_definition_id=f.feedback_definition_id
-                    )
-                )
+                    ) for f in self.feedbacks
+                ]
+            )
+            return
+
+        self.tru.add_record_later(record=record)
+
+        if len(self.feedbacks) == 0:
+            return
 
-        elif self.feedback_mode in [FeedbackMode.WITH_APP,
-                                    FeedbackMode.WITH_APP_THREAD]:
+        if self.feedback_mode in [FeedbackMode.WITH_APP,
+                                  FeedbackMode.WITH_APP_THREAD]:
 
             results = self.tru.run_feedback_functions(
                 record=record, feedback_functions=self.feedbacks, app=self
             )
 
-            for result in results:
-                self.tru.add_feedback(result)
+            self.tru.add_feedbacks_later(results)
 
     def _handle_error(self, record: Record, error: Exception):
         if self.db is None:
@@ -1,11 +1,27 @@
 import abc
+from collections import defaultdict
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from datetime import timedelta
+import hashlib
 import json
 import logging
+import operator
+import os
 from pathlib import Path
 from pprint import PrettyPrinter
+import random
+import re
 import sqlite3
-from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import threading
+from time import perf_counter
+from time import sleep
+from typing import (
+    Callable, ClassVar, Dict, Hashable, Iterable, Iterator, List, Optional,
+    Sequence, Tuple, Type, TypeVar, Union
+)
+import zlib
 
 import pydantic
 from frozendict import frozendict
@@ -28,6 +44,7 @@ from trulens_eval.schema import Record
 from trulens_eval.schema import RecordAppCall
 from trulens_eval.schema import RecordID
 from trulens_eval.util import all_queries
+from trulens_eval.util import Class
 from trulens_eval.util import GetItemOrAttribute
 from trulens_eval.util import JSON
 from trulens_eval.util import json_str_of_obj
@@ -39,6 +56,8 @@ from trulens_eval.util import UNICODE_CHECK
 mj = MerkleJson()
 NoneType = type(None)
 
+T = TypeVar("T")
+
 pp = PrettyPrinter()
 
 logger = logging.getLogger(__name__)
@@ -50,11 +69,306 @@ class DBMeta(pydantic.BaseModel):
     """
 
     trulens_version: Optional[str]
+    schema_version: Optional[int]
     attributes: dict
 
 
+class Codec(SerialModel, abc.ABC):
+    """
+    Compression of the large json columns of a database. Encoded values are
+    bytes starting with the codec's `tag` so that they can be told apart from
+    plain (uncompressed) text and decoded without knowing which codec wrote
+    them. Subclasses are registered by their tag on definition.
+    """
+
+    # Tags of known codecs.
+    codecs: ClassVar[Dict[str, Type['Codec']]] = dict()
+
+    tag: ClassVar[str]
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        Codec.codecs[cls.tag] = cls
+
+    @abc.abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError()
+
+    def encode(self, text: str) -> bytes:
+        return self.tag.encode() + b":" + self.compress(text.encode())
+
+    @staticmethod
+    def decode(value: Union[str, bytes, None]) -> Optional[str]:
+        """
+        Decode a stored value written by any registered codec. Text is returned
+        as is.
+        """
+
+        if not isinstance(value, bytes):
+            return value
+
+        tag, _, data = value.partition(b":")
+
+        return Codec.codecs[tag.decode()]().decompress(data).decode()
+
+
+class ZlibCodec(Codec):
+    tag = "zlib"
+
+    # 1 (fastest) to 9 (smallest).
+    level: int = 6
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class RetentionPolicy(SerialModel):
+    """
+    Which records a database keeps when the policy is applied with
+    `TruDB.apply_retention`. Records are deleted oldest first, together with
+    their feedback results. Rules that are not given are not applied.
+    """
+
+    # Delete records logged more than this many days ago.
+    max_age_days: Optional[float] = None
+
+    # Keep at most this many records of each app.
+    max_records_per_app: Optional[int] = None
+
+    # Delete the oldest records of any app until the data takes up at most
+    # this many megabytes.
+    max_size_mb: Optional[float] = None
+
+    # Records deleted per transaction. Other writers wait for at most one
+    # batch.
+    batch_size: int = 500
+
+
+class RecordsQuery(SerialModel):
+    """
+    Which records to get with `TruDB.query_records` and in what order. Filters
+    that are not given match all records.
+    """
+
+    # Comparison operators of feedback filters.
+    OPS: ClassVar[List[str]] = ["<", "<=", ">", ">=", "=", "!="]
+
+    # Largest LIMIT, for an OFFSET without one.
+    MAX_LIMIT: ClassVar[int] = 2**63 - 1
+
+    app_ids: Optional[List[AppID]] = None
+
+    # Records with one of these ids. Meant for a few records, such as those
+    # found by `TruDB.search_records`.
+    record_ids: Optional[List[RecordID]] = None
+
+    # Records logged from the first (inclusive) until the second (exclusive)
+    # of these, either of which may be None for no bound.
+    ts_range: Optional[Tuple[Optional[datetime], Optional[datetime]]] = None
+
+    # Records tagged with one of these.
+    tags: Optional[List[str]] = None
+
+    # Records with a result of each of the named feedback functions that
+    # compares to the given value with the given operator, for example
+    # {"relevance": (">", 0.5)}.
+    feedback_filters: Dict[str, Tuple[str, float]] = dict()
+
+    # Column of the records or name of a feedback function, prefixed with "-"
+    # for descending order. Records are in no particular order otherwise.
+    order_by: Optional[str] = None
+
+    limit: Optional[int] = None
+    offset: int = 0
+
+    @pydantic.validator("feedback_filters")
+    def check_ops(cls, feedback_filters):
+        for name, (op, _) in feedback_filters.items():
+            if op not in cls.OPS:
+                raise ValueError(
+                    f"Unknown operator {op} in the filter of {name}, "
+                    f"expected one of {cls.OPS}."
+                )
+
+        return feedback_filters
+
+    def where_sql(self, feedbacks_table: str) -> Tuple[str, list]:
+        """
+        WHERE clause, empty if there are no filters, selecting the matching
+        records of a table aliased `r`, and its parameters. Feedback filters
+        are subqueries of the `feedbacks_table`.
+        """
+
+        clauses = []
+        vars = []
+
+        if self.app_ids:
+            clauses.append(
+                f"r.app_id IN ({', '.join('?' * len(self.app_ids))})"
+            )
+            vars.extend(self.app_ids)
+
+        if self.record_ids is not None:
+            clauses.append(
+                f"r.record_id IN ({', '.join('?' * len(self.record_ids))})"
+                if len(self.record_ids) > 0 else "1 = 0"
+            )
+            vars.extend(self.record_ids)
+
+        if self.ts_range is not None:
+            start, end = self.ts_range
+            if start is not None:
+                clauses.append("r.ts >= ?")
+                vars.append(start)
+            if end is not None:
+                clauses.append("r.ts < ?")
+                vars.append(end)
+
+        if self.tags:
+            clauses.append(f"r.tags IN ({', '.join('?' * len(self.tags))})")
+            vars.extend(self.tags)
+
+        for name, (op, value) in self.feedback_filters.items():
+            clauses.append(
+                f"""r.record_id IN (
+                    SELECT record_id FROM {feedbacks_table}
+                    WHERE name=? AND result {op} ?
+                )"""
+            )
+            vars.extend([name, value])
+
+        if len(clauses) == 0:
+            return "", []
+
+        return "WHERE " + " AND ".join(clauses), vars
+
+    def order_sql(self, columns: Dict[str, str],
+                  feedbacks_table: str) -> Tuple[str, list]:
+        """
+        ORDER BY, LIMIT and OFFSET clauses, as needed, and their parameters.
+        `columns` maps the names of the columns records can be ordered by to
+        their SQL expressions. Other names are those of feedback functions,
+        ordered by their first result in `feedbacks_table`.
+        """
+
+        clauses = []
+        vars = []
+
+        if self.order_by is not None:
+            name = self.order_by.lstrip("-")
+            direction = "DESC" if self.order_by.startswith("-") else "ASC"
+
+            if name in columns:
+                clauses.append(f"ORDER BY {columns[name]} {direction}")
+            else:
+                clauses.append(
+                    f"""ORDER BY (
+                        SELECT result FROM {feedbacks_table} f
+                        WHERE f.record_id=r.record_id AND f.name=?
+                            AND f.result IS NOT NULL
+                        LIMIT 1
+                    ) {direction}"""
+                )
+                vars.append(name)
+
+        if self.limit is not None or self.offset > 0:
+            clauses.append("LIMIT ? OFFSET ?")
+            vars.extend(
+                [
+                    self.MAX_LIMIT if self.limit is None else self.limit,
+                    self.offset
+                ]
+            )
+
+        return " ".join(clauses), vars
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Select and order the matching rows of a dataframe in the format of
+        `TruDB.get_records_and_feedback`. Feedback filters and order use the
+        first result of each feedback function there.
+        """
+
+        if len(df) == 0:
+            return df
+
+        if self.app_ids:
+            df = df[df['app_id'].isin(self.app_ids)]
+
+        if self.record_ids is not None:
+            df = df[df['record_id'].isin(self.record_ids)]
+
+        if self.ts_range is not None:
+            ts = pd.to_datetime(df['ts'])
+            start, end = self.ts_range
+            keep = pd.Series(True, index=df.index)
+            if start is not None:
+                keep &= ts >= pd.Timestamp(start)
+            if end is not None:
+                keep &= ts < pd.Timestamp(end)
+            df = df[keep]
+
+        if self.tags:
+            df = df[df['tags'].isin(self.tags)]
+
+        compare = {
+            "<": operator.lt,
+            "<=": operator.le,
+            ">": operator.gt,
+            ">=": operator.ge,
+            "=": operator.eq,
+            "!=": operator.ne
+        }
+        for name, (op, value) in self.feedback_filters.items():
+            if name in df.columns:
+                results = df[name]
+            else:
+                results = pd.Series(np.nan, index=df.index)
+            df = df[results.notna() & compare[op](results, value)]
+
+        if self.order_by is not None:
+            name = self.order_by.lstrip("-")
+            if name in df.columns:
+                df = df.sort_values(
+                    name,
+                    ascending=not self.order_by.startswith("-"),
+                    kind="stable"
+                )
+
+        end = None if self.limit is None else self.offset + self.limit
+
+        return df.iloc[self.offset:end].reset_index(drop=True)
+
+
 class TruDB(SerialModel, abc.ABC):
 
+    # Granularities of `get_timeseries` in seconds, by name.
+    GRANULARITIES: ClassVar[Dict[str, int]] = {
+        "minute": 60,
+        "hour": 60 * 60,
+        "day": 24 * 60 * 60
+    }
+
+    # Columns of `get_app_summaries` other than those of feedback results.
+    SUMMARY_COLUMNS: ClassVar[List[str]] = [
+        "app_id", "records", "latency", "latency_p50", "latency_p95",
+        "latency_p99", "total_cost", "total_tokens"
+    ]
+
+    # Columns of `get_timeseries` other than those of feedback results.
+    TIMESERIES_COLUMNS: ClassVar[List[str]] = [
+        "app_id", "ts", "records", "latency", "latency_p50", "latency_p95",
+        "latency_p99", "total_cost", "total_tokens"
+    ]
+
     @abc.abstractmethod
     def reset_database(self):
         """
@@ -114,33 +428,549 @@ class TruDB(SerialModel, abc.ABC):
 
         raise NotImplementedError()
 
+    def insert_records(self, records: Sequence[Record]) -> List[RecordID]:
+        """
+        Insert multiple records into the db. Implementations should write them
+        in a single transaction; this default inserts them one at a time.
+        """
+
+        return [self.insert_record(record=record) for record in records]
+
+    def insert_feedbacks(
+        self, feedback_results: Sequence[FeedbackResult]
+    ) -> List[FeedbackResultID]:
+        """
+        Insert or update multiple feedback results in the db. Implementations
+        should write them in a single transaction; this default inserts them
+        one at a time.
+        """
+
+        return [
+            self.insert_feedback(feedback_result=feedback_result)
+            for feedback_result in feedback_results
+        ]
+
+    def insert_record_with_pending_feedbacks(
+        self, record: Record, feedback_results: Sequence[FeedbackResult]
+    ) -> RecordID:
+        """
+        Insert `record` together with the placeholders of the feedback results
+        still to be computed for it. Implementations should write them in a
+        single transaction.
+        """
+
+        record_id = self.insert_record(record=record)
+        self.insert_feedbacks(feedback_results=feedback_results)
+
+        return record_id
+
+    def claim_pending_feedback(
+        self,
+        limit: int = 64,
+        worker_id: Optional[str] = None,
+        lease_seconds: float = 60.0
+    ) -> pd.DataFrame:
+        """
+        Atomically claim up to `limit` feedback results that need to be
+        computed: those not yet started, those whose running lease expired and
+        failed ones due for a retry. The claimed results are marked as running
+        by `worker_id` for the next `lease_seconds`, their attempt count is
+        increased, and they are returned in the format of `get_feedback` with
+        their record, app and feedback definition json. Results whose record,
+        app or definition is not written yet are left for later, and those
+        claimed too many times without being computed are marked as failed.
+
+        This default only selects them, from those returned by the
+        implementation's `get_feedback`, without claiming them: results not
+        started, running for over 30 seconds or failed over 5 minutes ago.
+        Concurrent evaluators may then compute the same result more than once.
+        """
+
+        df = self.get_feedback(
+            status=[
+                FeedbackResultStatus.NONE, FeedbackResultStatus.RUNNING,
+                FeedbackResultStatus.FAILED
+            ]
+        )
+        if len(df) == 0:
+            return df
+
+        age = datetime.now().timestamp() - df['last_ts']
+        due = (df['status'] == FeedbackResultStatus.NONE) | (
+            (df['status'] == FeedbackResultStatus.RUNNING) & (age > 30)
+        ) | ((df['status'] == FeedbackResultStatus.FAILED) & (age > 5 * 60))
+
+        return df[due].head(limit).reset_index(drop=True)
+
+    def apply_retention(self, policy: RetentionPolicy) -> int:
+        """
+        Delete the records that `policy` does not keep, together with their
+        feedback results, in batches of `policy.batch_size` records so that
+        other writers are only held up briefly, and release the space they
+        took up where supported. Returns the number of records deleted.
+        """
+
+        raise NotImplementedError(
+            f"{self} does not support retention policies."
+        )
+
+    def get_data_version(self) -> Optional[int]:
+        """
+        A number that changes whenever the db is modified by another
+        connection or process, cheap to check. None if not supported, in which
+        case waiting for changes has to fall back to polling.
+        """
+
+        return None
+
+    def get_data_stamp(self) -> Optional[Hashable]:
+        """
+        A value that changes whenever the db is modified, by this process or
+        another, and is the same for all threads of this process. Cheap to
+        check, so that results read from the db can be cached under it. None
+        if not supported, in which case nothing should be cached.
+        """
+
+        return None
+
     @abc.abstractmethod
     def get_records_and_feedback(
-        self, app_ids: List[str]
+        self,
+        app_ids: List[str],
+        include_json: bool = True
     ) -> Tuple[pd.DataFrame, Sequence[str]]:
         """
         Get the records logged for the given set of `app_ids` (otherwise all)
         alongside the names of the feedback function columns listed the
-        dataframe.
+        dataframe. If not `include_json`, the `record_json` and `app_json`
+        columns as well as the calls of each feedback function are left out.
         """
         raise NotImplementedError()
 
+    def query_records(
+        self,
+        app_ids: Optional[List[AppID]] = None,
+        record_ids: Optional[List[RecordID]] = None,
+        ts_range: Optional[Tuple[Optional[datetime],
+                                 Optional[datetime]]] = None,
+        tags: Optional[List[str]] = None,
+        feedback_filters: Optional[Dict[str, Tuple[str, float]]] = None,
+        order_by: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+        include_json: bool = True
+    ) -> Tuple[pd.DataFrame, Sequence[str]]:
+        """
+        Get the records matching the given filters, see `RecordsQuery`, in the
+        format of `get_records_and_feedback`: those of the given apps and
+        `record_ids`, logged within `ts_range`, tagged with one of `tags`, and
+        with feedback results matching `feedback_filters`, ordered by
+        `order_by`, skipping the first `offset` and returning at most `limit`.
+        Implementations should only read the matching records; this default
+        reads all of them and filters them here.
+        """
+
+        query = RecordsQuery(
+            app_ids=app_ids,
+            record_ids=record_ids,
+            ts_range=ts_range,
+            tags=tags,
+            feedback_filters=feedback_filters or dict(),
+            order_by=order_by,
+            limit=limit,
+            offset=offset
+        )
+
+        df, feedback_cols = self.get_records_and_feedback(
+            app_ids or [], include_json=include_json
+        )
+
+        return query.apply(df), feedback_cols
+
+    def count_records(
+        self,
+        app_ids: Optional[List[AppID]] = None,
+        record_ids: Optional[List[RecordID]] = None,
+        ts_range: Optional[Tuple[Optional[datetime],
+                                 Optional[datetime]]] = None,
+        tags: Optional[List[str]] = None,
+        feedback_filters: Optional[Dict[str, Tuple[str, float]]] = None
+    ) -> int:
+        """
+        Number of records `query_records` returns with the same filters and no
+        limit, for example to page through them. Implementations should count
+        in the db; this default reads the matching records.
+        """
+
+        df, _ = self.query_records(
+            app_ids=app_ids,
+            record_ids=record_ids,
+            ts_range=ts_range,
+            tags=tags,
+            feedback_filters=feedback_filters,
+            include_json=False
+        )
+
+        return len(df)
+
+    def get_feedback_histograms(
+        self,
+        app_ids: Optional[List[AppID]] = None,
+        bins: Sequence[float] = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+    ) -> pd.DataFrame:
+        """
+        Number of feedback results of the records of the given apps (otherwise
+        all) in each of the `bins`, given by their edges as for
+        `numpy.histogram`: one row per feedback function, indexed by name, and
+        one column per bin. Implementations should count in the db; this
+        default reads all records and so counts the first result of each
+        function per record.
+        """
+
+        df, feedback_cols = self.get_records_and_feedback(
+            app_ids or [], include_json=False
+        )
+
+        return pd.DataFrame(
+            [
+                np.histogram(df[name].dropna(), bins=bins)[0]
+                for name in feedback_cols
+            ],
+            index=pd.Index(feedback_cols, name="name"),
+            columns=range(len(bins) - 1)
+        )
+
+    def _bin_sql(self, value: str, bins: Sequence[float]) -> str:
+        # Index of the bin of `value` among those with the given edges, the
+        # last including its upper edge as in `numpy.histogram`, or NULL if
+        # outside all of them.
+        cases = " ".join(
+            f"WHEN {value} < {float(upper)!r} THEN {i}"
+            for i, upper in enumerate(bins[1:-1])
+        )
+        return f"""CASE WHEN {value} < {float(bins[0])!r} THEN NULL
+            {cases}
+            WHEN {value} <= {float(bins[-1])!r} THEN {len(bins) - 2}
+            END"""
+
+    def _histograms_of_counts(
+        self, df_counts: pd.DataFrame, bins: Sequence[float]
+    ) -> pd.DataFrame:
+        # Pivot rows of name, bin and count to the format of
+        # `get_feedback_histograms`.
+        histograms = df_counts.pivot(
+            index="name", columns="bin", values="count"
+        ).reindex(columns=range(len(bins) - 1)).fillna(0).astype(int)
+        histograms.columns.name = None
+
+        return histograms
+
+    def search_records(
+        self,
+        text: str,
+        app_ids: Optional[List[AppID]] = None,
+        limit: int = 50,
+        include_json: bool = True
+    ) -> Tuple[pd.DataFrame, Sequence[str]]:
+        """
+        Get at most `limit` records of the given apps (otherwise all) whose
+        input or output contains each of the words of `text`, best matches
+        first, in the format of `get_records_and_feedback`. Without any words,
+        the latest records are returned. Implementations should use an index;
+        this default reads all records and ranks them by how often the words
+        occur.
+        """
+
+        terms = text.lower().split()
+
+        df, feedback_cols = self.get_records_and_feedback(
+            app_ids or [], include_json=include_json
+        )
+        if len(df) == 0:
+            return df, feedback_cols
+
+        texts = (df['input'].fillna("") + "\n" +
+                 df['output'].fillna("")).str.lower()
+        counts = pd.DataFrame(
+            {term: texts.str.count(re.escape(term)) for term in terms},
+            index=df.index
+        )
+        df = df.assign(
+            _score=counts.sum(axis=1), _ts=pd.to_datetime(df['ts'])
+        )[(counts > 0).all(axis=1)]
+        df = df.sort_values(["_score", "_ts"], ascending=False, kind="stable")
+
+        return df.drop(columns=["_score", "_ts"]
+                      ).head(limit).reset_index(drop=True), feedback_cols
+
+    def get_record_json(self, record_id: RecordID) -> Optional[JSON]:
+        """
+        Get the json of a single record or None if there is no such record.
+        Implementations should only read that record; this default reads all
+        of them.
+        """
+
+        df, _ = self.query_records(record_ids=[record_id])
+        if len(df) == 0:
+            return None
+
+        # Records dataframes hold the json as text.
+        return json.loads(df['record_json'].iloc[0])
+
+    def get_app_summaries(
+        self,
+        app_ids: Optional[List[str]] = None
+    ) -> Tuple[pd.DataFrame, Sequence[str]]:
+        """
+        Get aggregates of the records of each of the given apps (otherwise
+        all), one row per app ordered by app_id: the number of `records`, their
+        mean `latency` and its 50th, 95th and 99th percentiles
+        (`latency_p50`, ...) in seconds, `total_cost`, `total_tokens`, and the
+        mean result of each feedback function in a column named after it. The
+        names of those columns are returned alongside. Implementations should
+        not need to read every record; this default reads every record.
+        """
+
+        df, feedback_cols = self.get_records_and_feedback(
+            app_ids or [], include_json=False
+        )
+        if len(df) == 0:
+            return pd.DataFrame(columns=self.SUMMARY_COLUMNS), []
+
+        df['latency'] = df['latency'].dt.total_seconds()
+
+        by_app = df.groupby("app_id")
+        summaries = pd.DataFrame(
+            dict(
+                records=by_app.size(),
+                latency=by_app['latency'].mean(),
+                **{
+                    f"latency_p{q}": by_app['latency'].quantile(q / 100)
+                    for q in [50, 95, 99]
+                },
+                total_cost=by_app['total_cost'].sum(),
+                total_tokens=by_app['total_tokens'].sum()
+            )
+        ).join(by_app[list(feedback_cols)].mean())
+
+        return summaries.reset_index(), list(feedback_cols)
+
+    def get_timeseries(
+        self,
+        app_ids: Optional[List[str]] = None,
+        granularity: str = "hour",
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None
+    ) -> Tuple[pd.DataFrame, Sequence[str]]:
+        """
+        Get aggregates of the records of each of the given apps (otherwise
+        all) per period of the given `granularity`, one of
+        `TruDB.GRANULARITIES`, overlapping `start` to `end` if given. One row
+        per app and period with records, ordered by app_id and `ts`, the start
+        of the period: the number of `records`, their mean `latency` and its
+        50th, 95th and 99th percentiles (`latency_p50` and so on) in seconds,
+        `total_cost`, `total_tokens`, and the mean result of each feedback
+        function in a column named after it. The names of those columns are
+        returned alongside. Periods are aligned to the unix epoch and
+        timestamps are in the time zone the records were logged in.
+        Implementations may estimate the percentiles and should not need to
+        read every record; this default reads every record and computes them
+        exactly.
+        """
+
+        seconds = self._granularity_seconds(granularity)
+
+        df, feedback_cols = self.get_records_and_feedback(
+            app_ids or [], include_json=False
+        )
+
+        if len(df) > 0:
+            df['ts'] = pd.to_datetime(df['ts']).dt.floor(f"{seconds}s")
+            df['latency'] = df['latency'].map(lambda td: td.total_seconds())
+
+            if start is not None:
+                df = df[df['ts'] > pd.Timestamp(start) -
+                        pd.Timedelta(seconds=seconds)]
+            if end is not None:
+                df = df[df['ts'] < pd.Timestamp(end)]
+
+        if len(df) == 0:
+            return pd.DataFrame(columns=self.TIMESERIES_COLUMNS), []
+
+        by_period = df.groupby(["app_id", "ts"])
+        latency = by_period['latency']
+        timeseries = pd.DataFrame(
+            dict(
+                records=by_period.size(),
+                latency=latency.mean(),
+                latency_p50=latency.quantile(0.5),
+                latency_p95=latency.quantile(0.95),
+                latency_p99=latency.quantile(0.99),
+                total_cost=by_period['total_cost'].sum(),
+                total_tokens=by_period['total_tokens'].sum()
+            )
+        ).join(by_period[list(feedback_cols)].mean())
+
+        # Feedback functions with no results in the selected periods.
+        timeseries = timeseries.dropna(axis=1, how="all")
+        feedback_cols = [
+            col for col in feedback_cols if col in timeseries.columns
+        ]
+
+        return timeseries.reset_index(), feedback_cols
+
+    def _granularity_seconds(self, granularity: str) -> int:
+        if granularity not in self.GRANULARITIES:
+            raise ValueError(
+                f"Unknown granularity {granularity}, "
+                f"expected one of {list(self.GRANULARITIES)}."
+            )
+
+        return self.GRANULARITIES[granularity]
+
 
 class LocalSQLite(TruDB):
     filename: Path
 
+    # Connection settings applied to every connection opened by this instance.
+    # WAL lets readers proceed while a write is committing and, together with
+    # NORMAL synchronous, only syncs to disk at checkpoints instead of on every
+    # commit. Busy timeout is in seconds.
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    busy_timeout: float = 5.0
+
+    # Writes still failing with "database is locked" after the busy timeout,
+    # for example while another process holds the write lock for a long
+    # transaction, are retried up to max_retries times, waiting retry_delay
+    # seconds (doubling with each retry, with jitter) in between.
+    max_retries: int = 5
+    retry_delay: float = 0.1
+
+    # Space freed by deletions is returned to the file system bit by bit by
+    # `apply_retention` rather than by a full VACUUM. Only takes effect for new
+    # databases; existing ones need a `vacuum` first.
+    auto_vacuum: str = "INCREMENTAL"
+
+    # Number of parsed apps to keep around. There are usually only a handful of
+    # distinct apps behind a great many records and feedback results.
+    app_cache_size: int = 128
+
+    # Compression of the record_json and calls_json columns, none if not given.
+    # Values written without one remain readable with one and vice versa.
+    codec: Optional[Codec] = None
+
+    # Strings and lists inside record_json whose json is at least this many
+    # characters long are stored once in the blobs table, keyed by their
+    # content hash, and referenced from the record. Records are stored whole if
+    # not given.
+    blob_min_size: Optional[int] = None
+
+    # Long-lived connections, one per thread. Connections are not carried over
+    # a fork; see `_connect`.
+    _local: threading.local = pydantic.PrivateAttr(
+        default_factory=threading.local
+    )
+    _conns: List = pydantic.PrivateAttr(default_factory=list)
+    _conns_lock: threading.Lock = pydantic.PrivateAttr(
+        default_factory=threading.Lock
+    )
+    _pid: int = pydantic.PrivateAttr(default_factory=os.getpid)
+
+    # Connection reading the data version for `get_data_stamp`, shared by all
+    # threads of the process that opened it. Nothing is written through it.
+    _stamp_conn: Optional[Tuple[int, sqlite3.Connection]
+                         ] = pydantic.PrivateAttr(None)
+    _stamp_lock: threading.Lock = pydantic.PrivateAttr(
+        default_factory=threading.Lock
+    )
+
+    # Parsed apps keyed by app_id and a hash of their json, least recently used
+    # first.
+    _app_cache: OrderedDict = pydantic.PrivateAttr(default_factory=OrderedDict)
+    _app_cache_lock: threading.Lock = pydantic.PrivateAttr(
+        default_factory=threading.Lock
+    )
+
     TABLE_META = "meta"
     TABLE_RECORDS = "records"
     TABLE_FEEDBACKS = "feedbacks"
     TABLE_FEEDBACK_DEFS = "feedback_defs"
     TABLE_APPS = "apps"
+    TABLE_BLOBS = "blobs"
+    TABLE_BLOB_REFS = "blob_refs"
+    TABLE_APP_SUMMARY = "app_summary"
+    TABLE_APP_FEEDBACK_SUMMARY = "app_feedback_summary"
+    TABLE_APP_ROLLUPS = "app_rollups"
+    TABLE_APP_FEEDBACK_ROLLUPS = "app_feedback_rollups"
+    TABLE_APP_LATENCY_BINS = "app_latency_bins"
+
+    # Full-text index of the inputs and outputs of records, only present if
+    # sqlite was built with FTS5.
+    TABLE_RECORDS_FTS = "records_fts"
 
     TYPE_TIMESTAMP = "FLOAT"
     TYPE_ENUM = "TEXT"
 
-    TABLES = [TABLE_RECORDS, TABLE_FEEDBACKS, TABLE_FEEDBACK_DEFS, TABLE_APPS]
-
-    def __init__(self, filename: Path):
+    TABLES = [
+        TABLE_RECORDS, TABLE_FEEDBACKS, TABLE_FEEDBACK_DEFS, TABLE_APPS,
+        TABLE_BLOBS, TABLE_BLOB_REFS, TABLE_APP_SUMMARY,
+        TABLE_APP_FEEDBACK_SUMMARY, TABLE_APP_ROLLUPS,
+        TABLE_APP_FEEDBACK_ROLLUPS, TABLE_APP_LATENCY_BINS
+    ]
+
+    # Upper bounds in seconds of the bins of the latency histograms kept in
+    # the rollups; the last bin holds the latencies above the last bound. Part
+    # of the schema: existing rollups are not rebinned if these change.
+    LATENCY_BINS = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+    # Upper bounds in seconds of the finer bins in which the records of each
+    # app are counted, about 10% apart from a millisecond to an hour, to find
+    # the latency percentiles of `get_app_summaries`. Also part of the schema.
+    LATENCY_SUMMARY_BINS = sorted({round(0.001 * 1.1**i, 3) for i in range(160)})
+
+    # Key of the json object standing in for a value stored in the blobs table.
+    BLOB_KEY = "__tru_blob"
+
+    # Schema migrations as (schema_version, method name), numbered from 1 in
+    # the order they are applied. A step runs when the schema_version recorded
+    # in the meta table is lower than the step's, after which the database is
+    # marked with the step's version. Databases without a schema_version, new
+    # or from before it was tracked, get every step; steps must therefore cope
+    # with tables that already have what they add.
+    MIGRATIONS = [
+        (1, "_migrate_add_indexes"),
+        (2, "_migrate_add_leases"),
+        (3, "_migrate_add_retries"),
+        (4, "_migrate_add_summaries"),
+        (5, "_migrate_add_rollups"),
+        (6, "_migrate_add_blob_refs"),
+        (7, "_migrate_add_query_indexes"),
+        (8, "_migrate_add_records_fts"),
+        (9, "_migrate_add_latency_index"),
+        (10, "_migrate_count_early_feedback"),
+        (11, "_migrate_add_latency_bins"),
+    ]
+
+    # Columns of the feedbacks table as written by `insert_feedback`, in the
+    # order of `_feedback_vals`. The lease columns and attempt count are only
+    # written by `claim_pending_feedback`.
+    FEEDBACK_COLUMNS = [
+        "feedback_result_id", "record_id", "feedback_definition_id", "last_ts",
+        "status", "error", "calls_json", "result", "name", "cost_json",
+        "next_retry_ts"
+    ]
+
+    # Seconds after which a running feedback result that was not claimed with
+    # a lease is assumed abandoned. Failed results are retried after
+    # FAILED_RETRY_DELAY seconds, doubling with each attempt, until they have
+    # been attempted MAX_ATTEMPTS times. Results whose lease ran out after
+    # that many claims are marked as failed.
+    RUNNING_TIMEOUT = 30
+    FAILED_RETRY_DELAY = 5 * 60
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, filename: Path, **kwargs):
         """
         Database locally hosted using SQLite.
 
@@ -149,8 +979,22 @@ class LocalSQLite(TruDB):
         - filename: Optional[Path] -- location of sqlite database dump
           file. It will be created if it does not exist.
 
+        - journal_mode: str -- sqlite journal mode, "WAL" by default.
+
+        - synchronous: str -- sqlite synchronous level, "NORMAL" by default.
+
+        - busy_timeout: float -- seconds to wait for a lock held by another
+          connection before failing with "database is locked".
+
+        - max_retries: int -- times a write that failed with "database is
+          locked" is retried.
+
+        - retry_delay: float -- seconds to wait before the first retry.
+
+        - auto_vacuum: str -- sqlite auto vacuum mode of new databases,
+          "INCREMENTAL" by default.
         """
-        super().__init__(filename=filename)
+        super().__init__(filename=filename, **kwargs)
 
         self._build_tables()
 
@@ -160,452 +1004,2625 @@ class LocalSQLite(TruDB):
     # TruDB requirement
     def reset_database(self) -> None:
         self._drop_tables()
+
+        # Forget the schema version so that all migrations are re-applied.
+        with self._transaction() as c:
+            c.execute(f'''DROP TABLE IF EXISTS {self.TABLE_META}''')
+
         self._build_tables()
 
     def _clear_tables(self) -> None:
-        conn, c = self._connect()
+        with self._transaction() as c:
+            for table in self.TABLES:
+                c.execute(f'''DELETE FROM {table}''')
 
-        for table in self.TABLES:
-            c.execute(f'''DELETE FROM {table}''')
+    def _drop_tables(self) -> None:
+        with self._transaction() as c:
+            for table in self.TABLES:
+                c.execute(f'''DROP TABLE IF EXISTS {table}''')
+            c.execute(f'''DROP TABLE IF EXISTS {self.TABLE_RECORDS_FTS}''')
 
-        self._close(conn)
+    # TruDB requirement
+    def apply_retention(self, policy: RetentionPolicy) -> int:
+        deleted = 0
 
-    def _drop_tables(self) -> None:
-        conn, c = self._connect()
+        if policy.max_age_days is not None:
+            cutoff = datetime.now() - timedelta(days=policy.max_age_days)
+            deleted += self._delete_oldest(
+                policy.batch_size, "WHERE ts < ?", (cutoff,)
+            )
 
-        for table in self.TABLES:
-            c.execute(f'''DROP TABLE IF EXISTS {table}''')
+        if policy.max_records_per_app is not None:
+            # Counted by the app summaries rather than by the records.
+            with self._transaction() as c:
+                c.execute(
+                    f"""SELECT app_id, records FROM {self.TABLE_APP_SUMMARY}
+                        WHERE records > ?""", (policy.max_records_per_app,)
+                )
+                excess = c.fetchall()
 
-        self._close(conn)
+            for app_id, records in excess:
+                deleted += self._delete_oldest(
+                    policy.batch_size,
+                    "WHERE app_id=?", (app_id,),
+                    limit=records - policy.max_records_per_app
+                )
 
-    def get_meta(self):
-        conn, c = self._connect()
+        if policy.max_size_mb is not None:
+            while self._data_size() > policy.max_size_mb * 2**20:
+                n = self._delete_oldest(
+                    policy.batch_size, limit=policy.batch_size
+                )
+                if n == 0:
+                    break
+                deleted += n
 
-        try:
-            c.execute(f'''SELECT key, value from {self.TABLE_META}''')
-            rows = c.fetchall()
+        if deleted > 0:
+            self._incremental_vacuum()
 
-            ret = {}
+        return deleted
 
-            for row in rows:
-                ret[row[0]] = row[1]
+    def _delete_oldest(
+        self,
+        batch_size: int,
+        where_clause: str = "",
+        vars: tuple = (),
+        limit: Optional[int] = None
+    ) -> int:
+        # Delete the oldest records matching `where_clause`, up to `limit` if
+        # given, `batch_size` per transaction. Returns the number deleted.
+
+        deleted = 0
+
+        while limit is None or deleted < limit:
+            n = batch_size if limit is None else min(
+                batch_size, limit - deleted
+            )
 
-            if 'trulens_version' in ret:
-                trulens_version = ret['trulens_version']
-            else:
-                trulens_version = None
+            # Other writers wait for the lock by polling rather than in a
+            # queue, so give them as much time to take it as this held it.
+            if deleted > 0:
+                sleep(held)
+            start = perf_counter()
+
+            with self._transaction() as c:
+                c.execute("BEGIN IMMEDIATE")
+                c.execute(
+                    f"""SELECT record_id FROM {self.TABLE_RECORDS}
+                        {where_clause}
+                        ORDER BY ts
+                        LIMIT ?""", vars + (n,)
+                )
+                record_ids = [row[0] for row in c.fetchall()]
+                self._delete_records(c, record_ids)
 
-            return DBMeta(trulens_version=trulens_version, attributes=ret)
+            held = perf_counter() - start
+            deleted += len(record_ids)
+            if len(record_ids) < n:
+                break
 
-        except Exception as e:
-            return DBMeta(trulens_version=None, attributes={})
+        return deleted
 
-    def _build_tables(self):
-        conn, c = self._connect()
+    def _delete_records(
+        self, c: sqlite3.Cursor, record_ids: Sequence[RecordID]
+    ) -> None:
+        # Delete the given records with their feedback results and the blobs
+        # no other record uses. Feedback results go first so that the triggers
+        # of the summaries still find their records.
 
-        # Create table if it does not exist. Note that the record_json column
-        # also encodes inside it all other columns.
+        if len(record_ids) == 0:
+            return
 
-        meta = self.get_meta()
+        ids = ", ".join("?" * len(record_ids))
 
         c.execute(
-            f'''CREATE TABLE IF NOT EXISTS {self.TABLE_META} (
-                key TEXT NOT NULL PRIMARY KEY,
-                value TEXT
-            )'''
+            f"DELETE FROM {self.TABLE_FEEDBACKS} WHERE record_id IN ({ids})",
+            record_ids
         )
 
-        if meta.trulens_version is None:
-            # migrate from pre-version-tracked database
-            # print(f"Migrating DB {self.filename} from trulens_version {meta.trulens_version} to {__version__}.")
-            c.execute(
-                f'''INSERT INTO {self.TABLE_META} VALUES (?, ?)''',
-                ('trulens_version', __version__)
-            )
-
         c.execute(
-            f'''CREATE TABLE IF NOT EXISTS {self.TABLE_RECORDS} (
-                record_id TEXT NOT NULL PRIMARY KEY,
-                app_id TEXT NOT NULL,
-                input TEXT,
-                output TEXT,
-                record_json TEXT NOT NULL,
-                tags TEXT NOT NULL,
-                ts {self.TYPE_TIMESTAMP} NOT NULL,
-                cost_json TEXT NOT NULL,
-                perf_json TEXT NOT NULL
-            )'''
-        )
-        c.execute(
-            f'''CREATE TABLE IF NOT EXISTS {self.TABLE_FEEDBACKS} (
-                feedback_result_id TEXT NOT NULL PRIMARY KEY,
-                record_id TEXT NOT NULL,
-                feedback_definition_id TEXT,
-                last_ts {self.TYPE_TIMESTAMP} NOT NULL,
-                status {self.TYPE_ENUM} NOT NULL,
-                error TEXT,
-                calls_json TEXT NOT NULL,
-                result FLOAT,
-                name TEXT NOT NULL,
-                cost_json TEXT NOT NULL
-            )'''
+            f"""SELECT DISTINCT blob_id FROM {self.TABLE_BLOB_REFS}
+                WHERE record_id IN ({ids})""", record_ids
         )
+        blob_ids = [row[0] for row in c.fetchall()]
+
         c.execute(
-            f'''CREATE TABLE IF NOT EXISTS {self.TABLE_FEEDBACK_DEFS} (
-                feedback_definition_id TEXT NOT NULL PRIMARY KEY,
-                feedback_json TEXT NOT NULL
-            )'''
+            f"DELETE FROM {self.TABLE_BLOB_REFS} WHERE record_id IN ({ids})",
+            record_ids
         )
         c.execute(
-            f'''CREATE TABLE IF NOT EXISTS {self.TABLE_APPS} (
-                app_id TEXT NOT NULL PRIMARY KEY,
-                app_json TEXT NOT NULL
-            )'''
+            f"DELETE FROM {self.TABLE_RECORDS} WHERE record_id IN ({ids})",
+            record_ids
         )
-        self._close(conn)
 
-    def _connect(self) -> Tuple[sqlite3.Connection, sqlite3.Cursor]:
-        conn = sqlite3.connect(self.filename)
-        c = conn.cursor()
-        return conn, c
+        for start in range(0, len(blob_ids), 500):
+            chunk = blob_ids[start:start + 500]
+            c.execute(
+                f"""DELETE FROM {self.TABLE_BLOBS}
+                    WHERE blob_id IN ({', '.join('?' * len(chunk))})
+                        AND NOT EXISTS (
+                            SELECT 1 FROM {self.TABLE_BLOB_REFS} r
+                            WHERE r.blob_id={self.TABLE_BLOBS}.blob_id
+                        )""", chunk
+            )
 
-    def _close(self, conn: sqlite3.Connection) -> None:
-        conn.commit()
-        conn.close()
+    def _data_size(self) -> int:
+        # Bytes of the database in use, not counting free pages.
 
-    # TruDB requirement-
-    def insert_record(
-        self,
-        record: Record,
-    ) -> RecordID:
-        # NOTE: Oddness here in that the entire record is put into the
-        # record_json column while some parts of that records are also put in
-        # other columns. Might want to keep this so we can query on the columns
-        # within sqlite.
+        with self._transaction() as c:
+            sizes = []
+            for pragma in ["page_count", "freelist_count", "page_size"]:
+                c.execute(f"PRAGMA {pragma}")
+                sizes.append(c.fetchone()[0])
 
-        vals = (
-            record.record_id, record.app_id, record.main_input,
-            record.main_output, json_str_of_obj(record), record.tags, record.ts,
-            json_str_of_obj(record.cost), json_str_of_obj(record.perf)
-        )
+        page_count, freelist_count, page_size = sizes
 
-        self._insert_or_replace_vals(table=self.TABLE_RECORDS, vals=vals)
+        return (page_count - freelist_count) * page_size
 
-        print(
-            f"{UNICODE_CHECK} record {record.record_id} from {record.app_id} -> {self.filename}"
-        )
+    def _incremental_vacuum(self, pages: int = 1024) -> None:
+        # Return free pages to the file system, `pages` per transaction. Does
+        # nothing unless the database uses incremental auto vacuum.
 
-        return record.record_id
+        with self._transaction() as c:
+            c.execute("PRAGMA auto_vacuum")
+            if c.fetchone()[0] != 2:
+                return
 
-    # TruDB requirement
+        free = None
+        while True:
+            with self._transaction() as c:
+                c.execute("PRAGMA freelist_count")
+                last, free = free, c.fetchone()[0]
+                if free == 0 or free == last:
+                    return
+
+                c.execute(f"PRAGMA incremental_vacuum({pages})")
+                c.fetchall()
+
+    def snapshot(self, filename: Path) -> None:
+        """
+        Write a consistent copy of the database to `filename` with sqlite's
+        online backup API, replacing it atomically. In WAL mode, writers are
+        not blocked while the copy is made. The copy uses a rollback journal so
+        that it can be opened read-only, see `SQLiteSnapshot`.
+        """
+
+        filename = Path(filename)
+        temp = filename.with_name(filename.name + ".tmp")
+
+        dest = sqlite3.connect(temp)
+        try:
+            conn, c = self._connect()
+            c.close()
+            conn.backup(dest)
+            dest.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            dest.close()
+
+        os.replace(temp, filename)
+
+    def vacuum(self) -> None:
+        """
+        Rebuild the database file, releasing all free space and switching it
+        to the `auto_vacuum` mode of this instance. Other connections are
+        blocked while this runs, which may take a while for large databases.
+        """
+
+        conn, c = self._connect()
+        try:
+            c.execute(f"PRAGMA auto_vacuum={self.auto_vacuum}")
+            c.execute("VACUUM")
+        finally:
+            c.close()
+
+        # VACUUM may renumber the rowids of records that the full-text index
+        # refers to.
+        with self._transaction() as c:
+            if self._has_fts(c):
+                c.execute(
+                    f"""INSERT INTO {self.TABLE_RECORDS_FTS}
+                        ({self.TABLE_RECORDS_FTS}) VALUES ('rebuild')"""
+                )
+
+    def get_meta(self):
+        conn, c = self._connect()
+
+        try:
+            c.execute(f'''SELECT key, value from {self.TABLE_META}''')
+            rows = c.fetchall()
+
+            ret = {}
+
+            for row in rows:
+                ret[row[0]] = row[1]
+
+            if 'trulens_version' in ret:
+                trulens_version = ret['trulens_version']
+            else:
+                trulens_version = None
+
+            if 'schema_version' in ret:
+                schema_version = int(ret['schema_version'])
+            else:
+                schema_version = None
+
+            return DBMeta(
+                trulens_version=trulens_version,
+                schema_version=schema_version,
+                attributes=ret
+            )
+
+        except Exception as e:
+            return DBMeta(
+                trulens_version=None, schema_version=None, attributes={}
+            )
+
+    def _build_tables(self):
+        with self._transaction() as c:
+            # Create table if it does not exist. Note that the record_json
+            # column also encodes inside it all other columns.
+
+            meta = self.get_meta()
+
+            c.execute(
+                f'''CREATE TABLE IF NOT EXISTS {self.TABLE_META} (
+                    key TEXT NOT NULL PRIMARY KEY,
+                    value TEXT
+                )'''
+            )
+
+            c.execute(
+                f'''CREATE TABLE IF NOT EXISTS {self.TABLE_RECORDS} (
+                    record_id TEXT NOT NULL PRIMARY KEY,
+                    app_id TEXT NOT NULL,
+                    input TEXT,
+                    output TEXT,
+                    record_json TEXT NOT NULL,
+                    tags TEXT NOT NULL,
+                    ts {self.TYPE_TIMESTAMP} NOT NULL,
+                    cost_json TEXT NOT NULL,
+                    perf_json TEXT NOT NULL
+                )'''
+            )
+            c.execute(
+                f'''CREATE TABLE IF NOT EXISTS {self.TABLE_FEEDBACKS} (
+                    feedback_result_id TEXT NOT NULL PRIMARY KEY,
+                    record_id TEXT NOT NULL,
+                    feedback_definition_id TEXT,
+                    last_ts {self.TYPE_TIMESTAMP} NOT NULL,
+                    status {self.TYPE_ENUM} NOT NULL,
+                    error TEXT,
+                    calls_json TEXT NOT NULL,
+                    result FLOAT,
+                    name TEXT NOT NULL,
+                    cost_json TEXT NOT NULL
+                )'''
+            )
+            c.execute(
+                f'''CREATE TABLE IF NOT EXISTS {self.TABLE_FEEDBACK_DEFS} (
+                    feedback_definition_id TEXT NOT NULL PRIMARY KEY,
+                    feedback_json TEXT NOT NULL
+                )'''
+            )
+            c.execute(
+                f'''CREATE TABLE IF NOT EXISTS {self.TABLE_APPS} (
+                    app_id TEXT NOT NULL PRIMARY KEY,
+                    app_json TEXT NOT NULL
+                )'''
+            )
+            c.execute(
+                f'''CREATE TABLE IF NOT EXISTS {self.TABLE_BLOBS} (
+                    blob_id TEXT NOT NULL PRIMARY KEY,
+                    blob_json TEXT NOT NULL
+                )'''
+            )
+
+            if meta.trulens_version is None:
+                # migrate from pre-version-tracked database
+                c.execute(
+                    f'''INSERT OR REPLACE INTO {self.TABLE_META} VALUES (?, ?)''',
+                    ('trulens_version', __version__)
+                )
+
+            # A missing schema version means either a new database or one from
+            # before schema versions were tracked; both get all migrations.
+            self._migrate(c, from_version=meta.schema_version or 0)
+
+    def _migrate(self, c: sqlite3.Cursor, from_version: int) -> None:
+        """
+        Apply the schema migrations numbered above `from_version` and record
+        the schema version reached.
+        """
+
+        for version, step in self.MIGRATIONS:
+            if version > from_version:
+                logger.debug(f"Applying migration {version} {step}.")
+                getattr(self, step)(c)
+
+                c.execute(
+                    f'''INSERT OR REPLACE INTO {self.TABLE_META} VALUES (?, ?)''',
+                    ('schema_version', str(version))
+                )
+
+    def _migrate_add_indexes(self, c: sqlite3.Cursor) -> None:
+        # Columns that the dashboard and the deferred evaluator filter or join
+        # on.
+        for table, columns in [
+            (self.TABLE_RECORDS, ["app_id", "ts"]),
+            (self.TABLE_RECORDS, ["ts"]),
+            (self.TABLE_FEEDBACKS, ["record_id"]),
+            (self.TABLE_FEEDBACKS, ["status"]),
+            (self.TABLE_FEEDBACKS, ["feedback_definition_id"]),
+        ]:
+            c.execute(
+                f'''CREATE INDEX IF NOT EXISTS {table}_{'_'.join(columns)}
+                    ON {table} ({', '.join(columns)})'''
+            )
+
+    def _migrate_add_leases(self, c: sqlite3.Cursor) -> None:
+        # Which worker is computing a feedback result and until when it holds
+        # it; see `claim_pending_feedback`.
+        self._add_columns(
+            c, self.TABLE_FEEDBACKS, [
+                ("worker_id", "TEXT"),
+                ("lease_until", self.TYPE_TIMESTAMP),
+            ]
+        )
+
+    def _migrate_add_retries(self, c: sqlite3.Cursor) -> None:
+        # Attempts so far and when a feedback result is next due to be claimed,
+        # null if never again. Claims only look at the due ones through the
+        # index instead of at every running or failed result.
+        c.execute(f"PRAGMA table_info({self.TABLE_FEEDBACKS})")
+        backfill = "next_retry_ts" not in {row[1] for row in c.fetchall()}
+
+        self._add_columns(
+            c, self.TABLE_FEEDBACKS, [
+                ("attempts", "INTEGER NOT NULL DEFAULT 0"),
+                ("next_retry_ts", self.TYPE_TIMESTAMP),
+            ]
+        )
+
+        if backfill:
+            c.execute(
+                f"""UPDATE {self.TABLE_FEEDBACKS}
+                    SET next_retry_ts={self._next_retry_sql("status", "last_ts", "attempts")}"""
+            )
+
+        c.execute(
+            f"""CREATE INDEX IF NOT EXISTS {self.TABLE_FEEDBACKS}_next_retry_ts
+                ON {self.TABLE_FEEDBACKS} (next_retry_ts)"""
+        )
+
+    def _migrate_add_summaries(self, c: sqlite3.Cursor) -> None:
+        # Per app aggregates of records and of feedback results, kept up to
+        # date by triggers in the same transaction as the rows they summarize.
+        # Sums of squares allow for variances.
+        #
+        # The triggers avoid conflict clauses such as INSERT OR IGNORE as those
+        # are overridden by the one of the statement firing them.
+
+        c.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+            (self.TABLE_APP_SUMMARY,)
+        )
+        exists = c.fetchone() is not None
+
+        c.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.TABLE_APP_SUMMARY} (
+                app_id TEXT NOT NULL PRIMARY KEY,
+                records INTEGER NOT NULL,
+                latency_sum FLOAT NOT NULL,
+                latency_sumsq FLOAT NOT NULL,
+                cost_sum FLOAT NOT NULL,
+                cost_sumsq FLOAT NOT NULL,
+                tokens_sum INTEGER NOT NULL,
+                tokens_sumsq INTEGER NOT NULL
+            )"""
+        )
+        c.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.TABLE_APP_FEEDBACK_SUMMARY} (
+                app_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                result_sum FLOAT NOT NULL,
+                result_count INTEGER NOT NULL,
+                PRIMARY KEY (app_id, name)
+            )"""
+        )
+
+        record_values = {
+            "latency": self._latency_sql("{row}.perf_json"),
+            "cost": "COALESCE(json_extract({row}.cost_json, '$.cost'), 0.0)",
+            "tokens": "COALESCE(json_extract({row}.cost_json, '$.n_tokens'), 0)"
+        }
+
+        def record_delta(row: str, sign: str) -> str:
+            # Assignments adding (sign "+") or removing (sign "-") the record
+            # `row` to or from its app's summary.
+            return ", ".join(
+                [f"records=records {sign} 1"] + [
+                    f"{name}_sum={name}_sum {sign} {value}, "
+                    f"{name}_sumsq={name}_sumsq {sign} ({value}) * ({value})"
+                    for name, value in record_values.items()
+                ]
+            ).format(row=row)
+
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_RECORDS}_summary_insert
+                AFTER INSERT ON {self.TABLE_RECORDS}
+                BEGIN
+                    INSERT INTO {self.TABLE_APP_SUMMARY}
+                        SELECT NEW.app_id, 0, 0, 0, 0, 0, 0, 0
+                        WHERE NOT EXISTS (
+                            SELECT 1 FROM {self.TABLE_APP_SUMMARY}
+                            WHERE app_id=NEW.app_id
+                        );
+                    UPDATE {self.TABLE_APP_SUMMARY} SET {record_delta("NEW", "+")}
+                        WHERE app_id=NEW.app_id;
+                END"""
+        )
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_RECORDS}_summary_delete
+                AFTER DELETE ON {self.TABLE_RECORDS}
+                BEGIN
+                    UPDATE {self.TABLE_APP_SUMMARY} SET {record_delta("OLD", "-")}
+                        WHERE app_id=OLD.app_id;
+                END"""
+        )
+
+        def feedback_delta(row: str, sign: str) -> str:
+            # Statement adding or removing the result of feedback `row` to or
+            # from the summary of its record's app.
+            return f"""
+                INSERT INTO {self.TABLE_APP_FEEDBACK_SUMMARY}
+                    SELECT r.app_id, {row}.name, 0, 0
+                    FROM {self.TABLE_RECORDS} r
+                    WHERE r.record_id={row}.record_id
+                        AND {row}.result IS NOT NULL
+                        AND NOT EXISTS (
+                            SELECT 1 FROM {self.TABLE_APP_FEEDBACK_SUMMARY} s
+                            WHERE s.app_id=r.app_id AND s.name={row}.name
+                        );
+                UPDATE {self.TABLE_APP_FEEDBACK_SUMMARY}
+                    SET result_sum=result_sum {sign} {row}.result,
+                        result_count=result_count {sign} 1
+                    WHERE {row}.result IS NOT NULL
+                        AND name={row}.name
+                        AND app_id=(
+                            SELECT app_id FROM {self.TABLE_RECORDS}
+                            WHERE record_id={row}.record_id
+                        );"""
+
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_FEEDBACKS}_summary_insert
+                AFTER INSERT ON {self.TABLE_FEEDBACKS}
+                BEGIN {feedback_delta("NEW", "+")} END"""
+        )
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_FEEDBACKS}_summary_delete
+                AFTER DELETE ON {self.TABLE_FEEDBACKS}
+                BEGIN {feedback_delta("OLD", "-")} END"""
+        )
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_FEEDBACKS}_summary_update
+                AFTER UPDATE OF result, name, record_id ON {self.TABLE_FEEDBACKS}
+                BEGIN {feedback_delta("OLD", "-")} {feedback_delta("NEW", "+")} END"""
+        )
+
+        if exists:
+            return
+
+        # Summarize what was written before the triggers existed.
+        sums = ", ".join(
+            f"SUM({value}), SUM(({value}) * ({value}))"
+            for value in record_values.values()
+        ).format(row=self.TABLE_RECORDS)
+        c.execute(
+            f"""INSERT INTO {self.TABLE_APP_SUMMARY}
+                SELECT app_id, COUNT(*), {sums}
+                FROM {self.TABLE_RECORDS}
+                GROUP BY app_id"""
+        )
+        self._summarize_feedbacks(c)
+
+    def _summarize_feedbacks(self, c: sqlite3.Cursor) -> None:
+        # Fill the empty feedback summaries from the feedbacks table.
+        c.execute(
+            f"""INSERT INTO {self.TABLE_APP_FEEDBACK_SUMMARY}
+                SELECT r.app_id, f.name, SUM(f.result), COUNT(f.result)
+                FROM {self.TABLE_FEEDBACKS} f
+                JOIN {self.TABLE_RECORDS} r ON r.record_id=f.record_id
+                WHERE f.result IS NOT NULL
+                GROUP BY r.app_id, f.name"""
+        )
+
+    def _migrate_add_rollups(self, c: sqlite3.Cursor) -> None:
+        # Per app aggregates of records and of feedback results by the minute,
+        # hour and day in which the records were logged, kept up to date by
+        # triggers like the summaries. Periods are identified by the
+        # granularity and start of each, in seconds since the epoch. Rows
+        # whose records were all deleted are left with a count of 0.
+        #
+        # The triggers compute the values of a row once and add them to each
+        # granularity's period with an upsert, which unlike other conflict
+        # clauses is not overridden by the statement firing them.
+
+        c.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+            (self.TABLE_APP_ROLLUPS,)
+        )
+        exists = c.fetchone() is not None
+
+        bins = [f"latency_bin_{i}" for i in range(len(self.LATENCY_BINS) + 1)]
+
+        c.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.TABLE_APP_ROLLUPS} (
+                app_id TEXT NOT NULL,
+                granularity INTEGER NOT NULL,
+                period INTEGER NOT NULL,
+                records INTEGER NOT NULL,
+                latency_sum FLOAT NOT NULL,
+                cost_sum FLOAT NOT NULL,
+                tokens_sum INTEGER NOT NULL,
+                {", ".join(f"{bin} INTEGER NOT NULL" for bin in bins)},
+                PRIMARY KEY (app_id, granularity, period)
+            )"""
+        )
+        c.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.TABLE_APP_FEEDBACK_ROLLUPS} (
+                app_id TEXT NOT NULL,
+                granularity INTEGER NOT NULL,
+                period INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                result_sum FLOAT NOT NULL,
+                result_count INTEGER NOT NULL,
+                PRIMARY KEY (app_id, granularity, period, name)
+            )"""
+        )
+
+        granularities = self._granularities_sql()
+
+        def record_values(row: str) -> str:
+            # Columns of the record `row` to aggregate.
+            return f"""SELECT {row}.app_id AS app_id,
+                {self._ts_sql(f"{row}.ts")} AS epoch,
+                {self._latency_sql(f"{row}.perf_json")} AS latency,
+                COALESCE(json_extract({row}.cost_json, '$.cost'), 0.0) AS cost,
+                COALESCE(json_extract({row}.cost_json, '$.n_tokens'), 0)
+                    AS tokens"""
+
+        bounds = [None] + self.LATENCY_BINS + [None]
+        in_bins = [
+            " AND ".join(
+                [f"v.latency > {lower}"] * (lower is not None) +
+                [f"v.latency <= {upper}"] * (upper is not None)
+            ) for lower, upper in zip(bounds[:-1], bounds[1:])
+        ]
+
+        def record_delta(row: str, sign: str) -> str:
+            # Statement adding (sign "+") or removing (sign "-") the record
+            # `row` to or from the rollups of its app.
+            return f"""
+                INSERT INTO {self.TABLE_APP_ROLLUPS}
+                    SELECT v.app_id, g.seconds, v.epoch / g.seconds * g.seconds,
+                        {sign}1, {sign}v.latency, {sign}v.cost, {sign}v.tokens,
+                        {", ".join(f"{sign}({in_bin})" for in_bin in in_bins)}
+                    FROM ({record_values(row)}) v, ({granularities}) g
+                    WHERE true
+                    ON CONFLICT (app_id, granularity, period) DO UPDATE SET
+                        {", ".join(
+                            f"{column}={column} + excluded.{column}"
+                            for column in [
+                                "records", "latency_sum", "cost_sum",
+                                "tokens_sum"
+                            ] + bins
+                        )};"""
+
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_RECORDS}_rollup_insert
+                AFTER INSERT ON {self.TABLE_RECORDS}
+                BEGIN {record_delta("NEW", "+")} END"""
+        )
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_RECORDS}_rollup_delete
+                AFTER DELETE ON {self.TABLE_RECORDS}
+                BEGIN {record_delta("OLD", "-")} END"""
+        )
+
+        def feedback_delta(row: str, sign: str) -> str:
+            # Statement adding or removing the result of feedback `row` to or
+            # from the rollups of its record's app and period.
+            return f"""
+                INSERT INTO {self.TABLE_APP_FEEDBACK_ROLLUPS}
+                    SELECT r.app_id, g.seconds,
+                        {self._ts_sql("r.ts")} / g.seconds * g.seconds,
+                        {row}.name, {sign}{row}.result, {sign}1
+                    FROM {self.TABLE_RECORDS} r, ({granularities}) g
+                    WHERE r.record_id={row}.record_id
+                        AND {row}.result IS NOT NULL
+                    ON CONFLICT (app_id, granularity, period, name) DO UPDATE
+                    SET result_sum=result_sum + excluded.result_sum,
+                        result_count=result_count + excluded.result_count;"""
+
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_FEEDBACKS}_rollup_insert
+                AFTER INSERT ON {self.TABLE_FEEDBACKS}
+                BEGIN {feedback_delta("NEW", "+")} END"""
+        )
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_FEEDBACKS}_rollup_delete
+                AFTER DELETE ON {self.TABLE_FEEDBACKS}
+                BEGIN {feedback_delta("OLD", "-")} END"""
+        )
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_FEEDBACKS}_rollup_update
+                AFTER UPDATE OF result, name, record_id ON {self.TABLE_FEEDBACKS}
+                BEGIN {feedback_delta("OLD", "-")} {feedback_delta("NEW", "+")} END"""
+        )
+
+        if exists:
+            return
+
+        # Roll up what was written before the triggers existed.
+        c.execute(
+            f"""INSERT INTO {self.TABLE_APP_ROLLUPS}
+                SELECT v.app_id, g.seconds,
+                    v.epoch / g.seconds * g.seconds AS period,
+                    COUNT(*), SUM(v.latency), SUM(v.cost), SUM(v.tokens),
+                    {", ".join(f"SUM({in_bin})" for in_bin in in_bins)}
+                FROM ({record_values(self.TABLE_RECORDS)}
+                    FROM {self.TABLE_RECORDS}) v, ({granularities}) g
+                GROUP BY v.app_id, g.seconds, period"""
+        )
+        self._roll_up_feedbacks(c)
+
+    def _granularities_sql(self) -> str:
+        # Table of the seconds of each granularity of the rollups.
+        return " UNION ALL ".join(
+            f"SELECT {seconds} AS seconds"
+            for seconds in self.GRANULARITIES.values()
+        )
+
+    def _roll_up_feedbacks(self, c: sqlite3.Cursor) -> None:
+        # Fill the empty feedback rollups from the feedbacks table.
+        c.execute(
+            f"""INSERT INTO {self.TABLE_APP_FEEDBACK_ROLLUPS}
+                SELECT r.app_id, g.seconds,
+                    {self._ts_sql("r.ts")} / g.seconds * g.seconds AS period,
+                    f.name, SUM(f.result), COUNT(f.result)
+                FROM {self.TABLE_FEEDBACKS} f
+                JOIN {self.TABLE_RECORDS} r ON r.record_id=f.record_id,
+                    ({self._granularities_sql()}) g
+                WHERE f.result IS NOT NULL
+                GROUP BY r.app_id, g.seconds, period, f.name"""
+        )
+
+    def _migrate_add_blob_refs(self, c: sqlite3.Cursor) -> None:
+        # Which blobs each record uses, directly or through other blobs, so
+        # that those no longer used by any record can be found when records
+        # are deleted.
+
+        c.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+            (self.TABLE_BLOB_REFS,)
+        )
+        exists = c.fetchone() is not None
+
+        c.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.TABLE_BLOB_REFS} (
+                record_id TEXT NOT NULL,
+                blob_id TEXT NOT NULL,
+                PRIMARY KEY (record_id, blob_id)
+            ) WITHOUT ROWID"""
+        )
+        c.execute(
+            f"""CREATE INDEX IF NOT EXISTS {self.TABLE_BLOB_REFS}_blob_id
+                ON {self.TABLE_BLOB_REFS} (blob_id)"""
+        )
+
+        if exists:
+            return
+
+        # Find the blobs of the records written before. Blobs are shared, so
+        # the ones inside each are only looked up once.
+        inner = dict()
+        blob_c = c.connection.cursor()
+
+        def closure(blob_ids: set) -> set:
+            found = set()
+            while len(blob_ids) > 0:
+                blob_id = blob_ids.pop()
+                if blob_id in found:
+                    continue
+                found.add(blob_id)
+
+                if blob_id not in inner:
+                    inner[blob_id] = set()
+                    blob_c.execute(
+                        f"""SELECT blob_json FROM {self.TABLE_BLOBS}
+                            WHERE blob_id=?""", (blob_id,)
+                    )
+                    row = blob_c.fetchone()
+                    if row is not None:
+                        self._find_blob_ids(
+                            json.loads(Codec.decode(row[0])), inner[blob_id]
+                        )
+
+                blob_ids |= inner[blob_id]
+
+            return found
+
+        records_c = c.connection.cursor()
+        records_c.execute(
+            f"""SELECT record_id, record_json FROM {self.TABLE_RECORDS}
+                WHERE EXISTS (SELECT 1 FROM {self.TABLE_BLOBS})"""
+        )
+        while True:
+            rows = records_c.fetchmany(1000)
+            if len(rows) == 0:
+                break
+
+            refs = []
+            for record_id, record_json in rows:
+                text = Codec.decode(record_json)
+                if self.BLOB_KEY not in text:
+                    continue
+
+                blob_ids = set()
+                self._find_blob_ids(json.loads(text), blob_ids)
+                refs.extend(
+                    (record_id, blob_id) for blob_id in closure(blob_ids)
+                )
+
+            c.executemany(
+                f"""INSERT OR IGNORE INTO {self.TABLE_BLOB_REFS}
+                    VALUES (?, ?)""", refs
+            )
+
+    def _migrate_add_query_indexes(self, c: sqlite3.Cursor) -> None:
+        # Columns that `query_records` filters on. Filters on feedback results
+        # look up the matching records by name and range of result.
+        for table, columns in [
+            (self.TABLE_RECORDS, ["tags"]),
+            (self.TABLE_FEEDBACKS, ["name", "result"]),
+        ]:
+            c.execute(
+                f'''CREATE INDEX IF NOT EXISTS {table}_{'_'.join(columns)}
+                    ON {table} ({', '.join(columns)})'''
+            )
+
+    def _migrate_add_records_fts(self, c: sqlite3.Cursor) -> None:
+        # Full-text index of the inputs and outputs of records for
+        # `search_records`. The text is not copied: the index reads it from the
+        # records table by rowid, and triggers keep the two in sync.
+
+        exists = self._has_fts(c)
+
+        try:
+            c.execute(
+                f"""CREATE VIRTUAL TABLE IF NOT EXISTS {self.TABLE_RECORDS_FTS}
+                    USING fts5(
+                        input, output,
+                        content={self.TABLE_RECORDS},
+                        tokenize='porter unicode61'
+                    )"""
+            )
+        except sqlite3.OperationalError as e:
+            logger.warning(
+                f"Full-text search is not available ({e}); "
+                "search_records will scan the records instead."
+            )
+            return
+
+        def index(row: str, command: str = "") -> str:
+            # Statement adding (or, with the 'delete' command, removing) the
+            # text of the given record row to the index.
+            if command:
+                return f"""INSERT INTO {self.TABLE_RECORDS_FTS}
+                    ({self.TABLE_RECORDS_FTS}, rowid, input, output)
+                    VALUES ('{command}', {row}.rowid, {row}.input, {row}.output);"""
+            return f"""INSERT INTO {self.TABLE_RECORDS_FTS}
+                (rowid, input, output)
+                VALUES ({row}.rowid, {row}.input, {row}.output);"""
+
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_RECORDS}_fts_insert
+                AFTER INSERT ON {self.TABLE_RECORDS}
+                BEGIN {index("NEW")} END"""
+        )
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_RECORDS}_fts_delete
+                AFTER DELETE ON {self.TABLE_RECORDS}
+                BEGIN {index("OLD", "delete")} END"""
+        )
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_RECORDS}_fts_update
+                AFTER UPDATE OF input, output ON {self.TABLE_RECORDS}
+                BEGIN {index("OLD", "delete")} {index("NEW")} END"""
+        )
+
+        if not exists:
+            c.execute(
+                f"""INSERT INTO {self.TABLE_RECORDS_FTS}
+                    ({self.TABLE_RECORDS_FTS}) VALUES ('rebuild')"""
+            )
+
+    def _migrate_add_latency_index(self, c: sqlite3.Cursor) -> None:
+        # Latencies of the records of each app in order, so that
+        # `get_app_summaries` finds their percentiles without sorting them.
+        # The expression must be written exactly as in `_latency_quantile` for
+        # the index to be used there.
+        try:
+            c.execute(
+                f"""CREATE INDEX IF NOT EXISTS {self.TABLE_RECORDS}_app_id_latency
+                    ON {self.TABLE_RECORDS}
+                    (app_id, {self._latency_sql("perf_json")})"""
+            )
+        except sqlite3.OperationalError as e:
+            # Date functions are only allowed in indexes since sqlite 3.20.
+            logger.warning(
+                f"Cannot index records by latency ({e}); "
+                "get_app_summaries will sort the records of each app instead."
+            )
+
+    def _migrate_count_early_feedback(self, c: sqlite3.Cursor) -> None:
+        # The feedback triggers only count results whose record exists, so
+        # results written before their record, as concurrent writers may do,
+        # were never counted, yet were subtracted when deleted. Count the results of a record when it is
+        # inserted and uncount those left when it is deleted instead, so that
+        # a result is counted exactly while both it and its record exist.
+
+        def summary_delta(row: str, sign: str) -> str:
+            # Statement adding (sign "+") or removing (sign "-") the results
+            # of the record `row` to or from the summaries of its app.
+            return f"""
+                INSERT INTO {self.TABLE_APP_FEEDBACK_SUMMARY}
+                    SELECT {row}.app_id, f.name, {sign}SUM(f.result),
+                        {sign}COUNT(*)
+                    FROM {self.TABLE_FEEDBACKS} f
+                    WHERE f.record_id={row}.record_id
+                        AND f.result IS NOT NULL
+                    GROUP BY f.name
+                    ON CONFLICT (app_id, name) DO UPDATE
+                    SET result_sum=result_sum + excluded.result_sum,
+                        result_count=result_count + excluded.result_count;"""
+
+        def rollup_delta(row: str, sign: str) -> str:
+            # Same for the rollups of its app and period.
+            return f"""
+                INSERT INTO {self.TABLE_APP_FEEDBACK_ROLLUPS}
+                    SELECT {row}.app_id, g.seconds,
+                        {self._ts_sql(f"{row}.ts")} / g.seconds * g.seconds,
+                        f.name, {sign}SUM(f.result), {sign}COUNT(*)
+                    FROM {self.TABLE_FEEDBACKS} f, ({self._granularities_sql()}) g
+                    WHERE f.record_id={row}.record_id
+                        AND f.result IS NOT NULL
+                    GROUP BY g.seconds, f.name
+                    ON CONFLICT (app_id, granularity, period, name) DO UPDATE
+                    SET result_sum=result_sum + excluded.result_sum,
+                        result_count=result_count + excluded.result_count;"""
+
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_RECORDS}_feedback_insert
+                AFTER INSERT ON {self.TABLE_RECORDS}
+                BEGIN {summary_delta("NEW", "+")} {rollup_delta("NEW", "+")} END"""
+        )
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_RECORDS}_feedback_delete
+                AFTER DELETE ON {self.TABLE_RECORDS}
+                BEGIN {summary_delta("OLD", "-")} {rollup_delta("OLD", "-")} END"""
+        )
+
+        # Recount what may have drifted before.
+        c.execute(f"DELETE FROM {self.TABLE_APP_FEEDBACK_SUMMARY}")
+        self._summarize_feedbacks(c)
+        c.execute(f"DELETE FROM {self.TABLE_APP_FEEDBACK_ROLLUPS}")
+        self._roll_up_feedbacks(c)
+
+    def _migrate_add_latency_bins(self, c: sqlite3.Cursor) -> None:
+        # Number of records of each app per bin of `LATENCY_SUMMARY_BINS`,
+        # kept up to date by triggers like the summaries. Bins without records
+        # are left with a count of 0.
+
+        c.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+            (self.TABLE_APP_LATENCY_BINS,)
+        )
+        exists = c.fetchone() is not None
+
+        c.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.TABLE_APP_LATENCY_BINS} (
+                app_id TEXT NOT NULL,
+                bin INTEGER NOT NULL,
+                records INTEGER NOT NULL,
+                PRIMARY KEY (app_id, bin)
+            )"""
+        )
+
+        def bin_values(row: str, source: str = "") -> str:
+            # App and latency bin of the records `row` of `source`, computing
+            # each latency once rather than for each bound.
+            bins = " ".join(
+                f"WHEN v.latency < {bound!r} THEN {i}"
+                for i, bound in enumerate(self.LATENCY_SUMMARY_BINS)
+            )
+            return f"""SELECT v.app_id,
+                    CASE {bins} ELSE {len(self.LATENCY_SUMMARY_BINS)} END
+                        AS bin
+                FROM (SELECT {row}.app_id AS app_id,
+                    {self._latency_sql(f"{row}.perf_json")} AS latency
+                    {source}) v"""
+
+        def record_delta(row: str, sign: str) -> str:
+            # Statement adding (sign "+") or removing (sign "-") the record
+            # `row` to or from the count of its bin.
+            return f"""
+                INSERT INTO {self.TABLE_APP_LATENCY_BINS}
+                    SELECT b.app_id, b.bin, {sign}1 FROM ({bin_values(row)}) b
+                    WHERE true
+                    ON CONFLICT (app_id, bin) DO UPDATE
+                    SET records=records + excluded.records;"""
+
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_RECORDS}_latency_bins_insert
+                AFTER INSERT ON {self.TABLE_RECORDS}
+                BEGIN {record_delta("NEW", "+")} END"""
+        )
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {self.TABLE_RECORDS}_latency_bins_delete
+                AFTER DELETE ON {self.TABLE_RECORDS}
+                BEGIN {record_delta("OLD", "-")} END"""
+        )
+
+        if exists:
+            return
+
+        # Count what was written before the triggers existed.
+        c.execute(
+            f"""INSERT INTO {self.TABLE_APP_LATENCY_BINS}
+                SELECT b.app_id, b.bin, COUNT(*)
+                FROM ({bin_values("r", f"FROM {self.TABLE_RECORDS} r")}) b
+                GROUP BY b.app_id, b.bin"""
+        )
+
+    def _has_fts(self, c: sqlite3.Cursor) -> bool:
+        c.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+            (self.TABLE_RECORDS_FTS,)
+        )
+        return c.fetchone() is not None
+
+    def _latency_sql(self, perf_json: str) -> str:
+        # Latency in seconds of the record with the given perf_json, to the
+        # millisecond. Differences of julianday are less precise.
+
+        def epoch(time: str) -> str:
+            return f"""(CAST(strftime('%s', {time}) AS FLOAT)
+                + strftime('%f', {time}) - strftime('%S', {time}))"""
+
+        end = epoch(f"json_extract({perf_json}, '$.end_time')")
+        start = epoch(f"json_extract({perf_json}, '$.start_time')")
+
+        return f"COALESCE({end} - {start}, 0.0)"
+
+    def _ts_sql(self, ts: str) -> str:
+        # Whole seconds since the epoch of the given records.ts value. Those
+        # are either numbers of seconds already or text, as datetimes are
+        # written by sqlite3, taken to be in UTC.
+
+        return f"""(CASE WHEN typeof({ts}) IN ('integer', 'real')
+            THEN CAST({ts} AS INTEGER)
+            ELSE CAST(strftime('%s', {ts}) AS INTEGER)
+        END)"""
+
+    def _next_retry_sql(self, status: str, last_ts: str, attempts: str) -> str:
+        """
+        SQL expression for when a feedback result with the given `status`,
+        `last_ts` and number of `attempts` (column names or expressions) is
+        next due to be claimed, if ever. Running results keep their lease.
+        """
+
+        return f"""CASE {status}
+            WHEN '{FeedbackResultStatus.NONE.value}' THEN {last_ts}
+            WHEN '{FeedbackResultStatus.RUNNING.value}'
+                THEN COALESCE(lease_until, {last_ts} + {self.RUNNING_TIMEOUT})
+            WHEN '{FeedbackResultStatus.FAILED.value}'
+                THEN CASE WHEN {attempts} < {self.MAX_ATTEMPTS}
+                    THEN {last_ts} + {self.FAILED_RETRY_DELAY}
+                        * (1 << MAX({attempts} - 1, 0))
+                END
+        END"""
+
+    def _add_columns(
+        self, c: sqlite3.Cursor, table: str, columns: Sequence[Tuple[str, str]]
+    ) -> None:
+        """
+        Add the given (name, type) columns to `table` unless already present.
+        """
+
+        c.execute(f"PRAGMA table_info({table})")
+        existing = {row[1] for row in c.fetchall()}
+
+        for name, type_ in columns:
+            if name not in existing:
+                c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {type_}")
+
+    def _connect(self) -> Tuple[sqlite3.Connection, sqlite3.Cursor]:
+        """
+        Get the calling thread's connection, opening and configuring it on
+        first use. Connections inherited over a fork are abandoned (not closed,
+        as the parent may still be using them) and reopened.
+        """
+
+        if self._pid != os.getpid():
+            self._local = threading.local()
+            self._conns = []
+            self._conns_lock = threading.Lock()
+            self._pid = os.getpid()
+
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None:
+            conn = self._open()
+
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+
+        return conn, conn.cursor()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.filename, timeout=self.busy_timeout, check_same_thread=False
+        )
+        # Setting the auto vacuum mode takes the write lock even when it does
+        # not change, and only matters before the first table is created.
+        if conn.execute("PRAGMA page_count").fetchone()[0] == 0:
+            conn.execute(f"PRAGMA auto_vacuum={self.auto_vacuum}")
+        conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        self._configure(conn)
+
+        return conn
+
+    def _configure(self, conn: sqlite3.Connection) -> None:
+        # Settings needed by the schema itself. Rows replaced by INSERT OR
+        # REPLACE only fire the delete triggers of the summaries with
+        # recursive triggers.
+        conn.execute("PRAGMA recursive_triggers=ON")
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        """
+        Run the statements issued on the yielded cursor in a single transaction,
+        committed on exit or rolled back on error.
+        """
+
+        conn, c = self._connect()
+
+        try:
+            yield c
+            conn.commit()
+
+        except BaseException:
+            conn.rollback()
+            raise
+
+        finally:
+            c.close()
+
+    def _write(self, write: Callable[[sqlite3.Cursor], T]) -> T:
+        """
+        Run `write` on a cursor in a transaction and return its result. If the
+        database stays locked by another connection for longer than the busy
+        timeout, the transaction is rolled back and run again, up to
+        `max_retries` times.
+        """
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self._transaction() as c:
+                    return write(c)
+
+            except sqlite3.OperationalError as e:
+                if not self._is_locked(e) or attempt == self.max_retries:
+                    raise
+
+                delay = self.retry_delay * 2**attempt * random.uniform(0.5, 1.5)
+                logger.warning(
+                    f"{self} is locked, retrying in {delay:.2f}s "
+                    f"({attempt + 1}/{self.max_retries})."
+                )
+                sleep(delay)
+
+    @staticmethod
+    def _is_locked(e: sqlite3.OperationalError) -> bool:
+        # SQLITE_BUSY, and SQLITE_LOCKED for shared cache connections.
+        message = str(e)
+        return "database is locked" in message or "database table is locked" in message
+
+    def close(self) -> None:
+        """
+        Close all connections opened by this instance. Threads using the
+        database afterwards will open new ones.
+        """
+
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns = []
+
+        self._local = threading.local()
+
+        with self._stamp_lock:
+            if self._stamp_conn is not None:
+                pid, conn = self._stamp_conn
+                if pid == os.getpid():
+                    conn.close()
+                self._stamp_conn = None
+
+    def _record_vals(
+        self,
+        record: Record,
+        blobs: Optional[Dict[str, Union[str, bytes]]] = None,
+        blob_ids: Optional[set] = None
+    ) -> tuple:
+        # NOTE: Oddness here in that the entire record is put into the
+        # record_json column while some parts of that records are also put in
+        # other columns. Might want to keep this so we can query on the columns
+        # within sqlite.
+
+        record_str = json_str_of_obj(record)
+        if self.blob_min_size is not None:
+            record_str = json.dumps(
+                self._split_blobs(json.loads(record_str), blobs, blob_ids)
+            )
+
+        return (
+            record.record_id,
+            record.app_id, record.main_input, record.main_output,
+            self._encode(record_str), record.tags, record.ts,
+            json_str_of_obj(record.cost), json_str_of_obj(record.perf)
+        )
+
+    def _split_blobs(
+        self,
+        obj: JSON,
+        blobs: Dict[str, Union[str, bytes]],
+        blob_ids: Optional[set] = None
+    ) -> JSON:
+        # Replace large values inside `obj` by references, adding their
+        # (encoded) json to `blobs` by id and their ids, including those of
+        # blobs inside blobs, to `blob_ids`. Done bottom up so that values
+        # repeated within larger ones are only stored once as well.
+
+        if isinstance(obj, dict):
+            obj = {
+                k: self._split_blobs(v, blobs, blob_ids) for k, v in obj.items()
+            }
+        elif isinstance(obj, list):
+            obj = [self._split_blobs(v, blobs, blob_ids) for v in obj]
+
+        if isinstance(obj, (str, list)):
+            blob_str = json.dumps(obj)
+            if len(blob_str) >= self.blob_min_size:
+                blob_id = mj.hash(obj)
+                if blob_id not in blobs:
+                    blobs[blob_id] = self._encode(blob_str)
+                if blob_ids is not None:
+                    blob_ids.add(blob_id)
+                return {self.BLOB_KEY: blob_id}
+
+        return obj
+
+    def _insert_records(
+        self, c: sqlite3.Cursor, records: Iterable[Record]
+    ) -> None:
+        blobs = dict()
+        refs = []
+        rows = []
+        for record in records:
+            blob_ids = set()
+            rows.append(self._record_vals(record, blobs, blob_ids))
+            refs.extend((record.record_id, blob_id) for blob_id in blob_ids)
+
+        # Blobs are never changed once written. Those of a replaced record
+        # stay referenced by it until it is deleted.
+        c.executemany(
+            f"""INSERT OR IGNORE INTO {self.TABLE_BLOBS} VALUES (?, ?)""",
+            blobs.items()
+        )
+        self._insert_or_replace_many(c, table=self.TABLE_RECORDS, rows=rows)
+        c.executemany(
+            f"""INSERT OR IGNORE INTO {self.TABLE_BLOB_REFS} VALUES (?, ?)""",
+            refs
+        )
+
+    def _load_records(
+        self, c: sqlite3.Cursor, values: Sequence[Union[str, bytes]]
+    ) -> List[JSON]:
+        # Parse record_json values, replacing blob references by their contents.
+
+        texts = [Codec.decode(value) for value in values]
+        objs = [json.loads(text) for text in texts]
+
+        if not any(self.BLOB_KEY in text for text in texts):
+            return objs
+
+        blobs = dict()
+        blob_ids = set()
+        for obj in objs:
+            self._find_blob_ids(obj, blob_ids)
+
+        # Blobs may refer to other blobs, fetched in turn.
+        while len(blob_ids) > 0:
+            fetched = dict()
+            blob_ids = list(blob_ids)
+            for start in range(0, len(blob_ids), 500):
+                chunk = blob_ids[start:start + 500]
+                c.execute(
+                    f"""SELECT blob_id, blob_json FROM {self.TABLE_BLOBS}
+                        WHERE blob_id IN ({','.join('?' * len(chunk))})""",
+                    chunk
+                )
+                for blob_id, blob_json in c.fetchall():
+                    fetched[blob_id] = json.loads(Codec.decode(blob_json))
+
+            blobs.update(fetched)
+
+            blob_ids = set()
+            for obj in fetched.values():
+                self._find_blob_ids(obj, blob_ids)
+            blob_ids -= blobs.keys()
+
+        return [self._join_blobs(obj, blobs) for obj in objs]
+
+    def _find_blob_ids(self, obj: JSON, blob_ids: set) -> None:
+        if isinstance(obj, dict):
+            if len(obj) == 1 and self.BLOB_KEY in obj:
+                blob_ids.add(obj[self.BLOB_KEY])
+            else:
+                for v in obj.values():
+                    self._find_blob_ids(v, blob_ids)
+        elif isinstance(obj, list):
+            for v in obj:
+                self._find_blob_ids(v, blob_ids)
+
+    def _join_blobs(self, obj: JSON, blobs: Dict[str, JSON]) -> JSON:
+        if isinstance(obj, dict):
+            if len(obj) == 1 and self.BLOB_KEY in obj:
+                blob_id = obj[self.BLOB_KEY]
+                if blob_id not in blobs:
+                    raise RuntimeError(f"Blob {blob_id} missing from {self}.")
+                return self._join_blobs(blobs[blob_id], blobs)
+            return {k: self._join_blobs(v, blobs) for k, v in obj.items()}
+        elif isinstance(obj, list):
+            return [self._join_blobs(v, blobs) for v in obj]
+
+        return obj
+
+    def _encode(self, text: str) -> Union[str, bytes]:
+        if self.codec is None:
+            return text
+
+        return self.codec.encode(text)
+
+    def _feedback_vals(self, feedback_result: FeedbackResult) -> tuple:
+        return (
+            feedback_result.feedback_result_id,
+            feedback_result.record_id,
+            feedback_result.feedback_definition_id,
+            feedback_result.last_ts.timestamp(),
+            feedback_result.status.value,
+            feedback_result.error,
+            self._encode(json_str_of_obj(dict(calls=feedback_result.calls))
+                        ),  # extra dict is needed json's root must be a dict
+            feedback_result.result,
+            feedback_result.name,
+            json_str_of_obj(feedback_result.cost),
+            self._first_due_ts(feedback_result)
+        )
+
+    def _first_due_ts(self, feedback_result: FeedbackResult) -> Optional[float]:
+        # When a feedback result that was never claimed is due to be, as in
+        # `_next_retry_sql` with no attempts and no lease.
+
+        last_ts = feedback_result.last_ts.timestamp()
+
+        if feedback_result.status == FeedbackResultStatus.NONE:
+            return last_ts
+        elif feedback_result.status == FeedbackResultStatus.RUNNING:
+            return last_ts + self.RUNNING_TIMEOUT
+        elif feedback_result.status == FeedbackResultStatus.FAILED:
+            return last_ts + self.FAILED_RETRY_DELAY
+        else:
+            return None
+
+    # TruDB requirement
+    def insert_record(
+        self,
+        record: Record,
+    ) -> RecordID:
+        self._write(lambda c: self._insert_records(c, [record]))
+
+        print(
+            f"{UNICODE_CHECK} record {record.record_id} from {record.app_id} -> {self.filename}"
+        )
+
+        return record.record_id
+
+    def insert_records(self, records: Sequence[Record]) -> List[RecordID]:
+        """
+        Insert multiple records in one transaction.
+        """
+
+        self._write(lambda c: self._insert_records(c, records))
+
+        print(f"{UNICODE_CHECK} {len(records)} record(s) -> {self.filename}")
+
+        return [record.record_id for record in records]
+
+    # TruDB requirement
     def insert_app(self, app: App) -> AppID:
         app_id = app.app_id
         app_str = app.json()
 
-        vals = (app_id, app_str)
-        self._insert_or_replace_vals(table=self.TABLE_APPS, vals=vals)
+        vals = (app_id, app_str)
+        self._insert_or_replace_vals(table=self.TABLE_APPS, vals=vals)
+
+        self._invalidate_app(app_id)
+
+        print(f"{UNICODE_CHECK} app {app_id} -> {self.filename}")
+
+        return app_id
+
+    def insert_feedback_definition(
+        self, feedback: FeedbackDefinition
+    ) -> FeedbackDefinitionID:
+        """
+        Insert a feedback definition into the database.
+        """
+
+        feedback_definition_id = feedback.feedback_definition_id
+        feedback_str = feedback.json()
+        vals = (feedback_definition_id, feedback_str)
+
+        self._insert_or_replace_vals(table=self.TABLE_FEEDBACK_DEFS, vals=vals)
+
+        print(
+            f"{UNICODE_CHECK} feedback def. {feedback_definition_id} -> {self.filename}"
+        )
+
+        return feedback_definition_id
+
+    def get_feedback_defs(
+        self, feedback_definition_id: Optional[str] = None
+    ) -> pd.DataFrame:
+
+        clause = ""
+        args = ()
+        if feedback_definition_id is not None:
+            clause = "WHERE feedback_id=?"
+            args = (feedback_definition_id,)
+
+        query = f"""
+            SELECT
+                feedback_definition_id, feedback_json
+            FROM {self.TABLE_FEEDBACK_DEFS}
+            {clause}
+        """
 
-        print(f"{UNICODE_CHECK} app {app_id} -> {self.filename}")
+        with self._transaction() as c:
+            c.execute(query, args)
+            rows = c.fetchall()
+            columns = [description[0] for description in c.description]
 
-        return app_id
+        df = pd.DataFrame(rows, columns=columns)
 
-    def insert_feedback_definition(
-        self, feedback: FeedbackDefinition
-    ) -> FeedbackDefinitionID:
+        return df
+
+    def _insert_or_replace_vals(self, table, vals):
+        self._write(
+            lambda c: self._insert_or_replace_many(c, table=table, rows=[vals])
+        )
+
+    def _insert_or_replace_many(
+        self, c: sqlite3.Cursor, table: str, rows: Iterable[tuple]
+    ) -> None:
+        rows = list(rows)
+        if len(rows) == 0:
+            return
+
+        c.executemany(
+            f"""INSERT OR REPLACE INTO {table}
+                VALUES ({','.join('?' for _ in rows[0])})""", rows
+        )
+
+    def _upsert_feedbacks(
+        self, c: sqlite3.Cursor, feedback_results: Iterable[FeedbackResult]
+    ) -> None:
+        # Unlike INSERT OR REPLACE, this leaves the columns not written here,
+        # like the lease of a claimed result, as they are.
+
+        rows = list(map(self._feedback_vals, feedback_results))
+        if len(rows) == 0:
+            return
+
+        columns = self.FEEDBACK_COLUMNS
+        updates = ", ".join(f"{col}=excluded.{col}" for col in columns[1:-1])
+
+        # The due time of an existing row depends on its attempts and lease so
+        # it is computed from them.
+        next_retry = self._next_retry_sql(
+            "excluded.status", "excluded.last_ts", "attempts"
+        )
+
+        c.executemany(
+            f"""INSERT INTO {self.TABLE_FEEDBACKS} ({', '.join(columns)})
+                VALUES ({','.join('?' for _ in columns)})
+                ON CONFLICT (feedback_result_id) DO UPDATE SET {updates},
+                    next_retry_ts={next_retry}""", rows
+        )
+
+    def insert_feedback(
+        self, feedback_result: FeedbackResult
+    ) -> FeedbackResultID:
         """
-        Insert a feedback definition into the database.
+        Insert a record-feedback link to db or update an existing one.
         """
 
-        feedback_definition_id = feedback.feedback_definition_id
-        feedback_str = feedback.json()
-        vals = (feedback_definition_id, feedback_str)
+        self._write(lambda c: self._upsert_feedbacks(c, [feedback_result]))
 
-        self._insert_or_replace_vals(table=self.TABLE_FEEDBACK_DEFS, vals=vals)
+        if feedback_result.status == FeedbackResultStatus.DONE:
+            print(
+                f"{UNICODE_CHECK} feedback {feedback_result.feedback_result_id} on {feedback_result.record_id} -> {self.filename}"
+            )
+        else:
+            print(
+                f"{UNCIODE_YIELD} feedback {feedback_result.feedback_result_id} on {feedback_result.record_id} -> {self.filename}"
+            )
+
+        return feedback_result.feedback_result_id
+
+    def insert_feedbacks(
+        self, feedback_results: Sequence[FeedbackResult]
+    ) -> List[FeedbackResultID]:
+        """
+        Insert or update multiple record-feedback links in one transaction.
+        """
+
+        self._write(lambda c: self._upsert_feedbacks(c, feedback_results))
+
+        print(
+            f"{UNICODE_CHECK} {len(feedback_results)} feedback(s) -> {self.filename}"
+        )
+
+        return [
+            feedback_result.feedback_result_id
+            for feedback_result in feedback_results
+        ]
+
+    def insert_record_with_pending_feedbacks(
+        self, record: Record, feedback_results: Sequence[FeedbackResult]
+    ) -> RecordID:
+        """
+        Insert `record` and its not yet computed feedback results in one
+        transaction.
+        """
+
+        def write(c: sqlite3.Cursor) -> None:
+            self._insert_records(c, [record])
+            self._upsert_feedbacks(c, feedback_results)
+
+        self._write(write)
+
+        print(
+            f"{UNCIODE_YIELD} record {record.record_id} from {record.app_id} with {len(feedback_results)} pending feedback(s) -> {self.filename}"
+        )
+
+        return record.record_id
+
+    def get_feedback(
+        self,
+        record_id: Optional[RecordID] = None,
+        feedback_result_id: Optional[Union[FeedbackResultID,
+                                           Sequence[FeedbackResultID]]] = None,
+        feedback_definition_id: Optional[FeedbackDefinitionID] = None,
+        status: Optional[FeedbackResultStatus] = None,
+        last_ts_before: Optional[datetime] = None,
+        include_json: bool = True
+    ) -> pd.DataFrame:
+        """
+        Get feedback results matching the given filters. If not
+        `include_json`, the (large) `feedback_json`, `record_json` and
+        `app_json` columns are left out.
+        """
+
+        clauses = []
+        vars = []
+
+        if record_id is not None:
+            clauses.append("f.record_id=?")
+            vars.append(record_id)
+
+        if feedback_result_id is not None:
+            if isinstance(feedback_result_id, str):
+                clauses.append("f.feedback_result_id=?")
+                vars.append(feedback_result_id)
+            else:
+                clauses.append(
+                    "f.feedback_result_id in (" +
+                    (",".join(["?"] * len(feedback_result_id))) + ")"
+                )
+                vars.extend(feedback_result_id)
+
+        if feedback_definition_id is not None:
+            clauses.append("f.feedback_definition_id=?")
+            vars.append(feedback_definition_id)
+
+        if status is not None:
+            if isinstance(status, Sequence):
+                clauses.append(
+                    "f.status in (" + (",".join(["?"] * len(status))) + ")"
+                )
+                for v in status:
+                    vars.append(v.value)
+            else:
+                clauses.append("f.status=?")
+                vars.append(status)
+
+        if last_ts_before is not None:
+            clauses.append("f.last_ts<=?")
+            vars.append(last_ts_before.timestamp())
+
+        where_clause = " AND ".join(clauses)
+        if len(where_clause) > 0:
+            where_clause = " AND " + where_clause
+
+        json_columns = ""
+        if include_json:
+            json_columns = """,
+                fd.feedback_json, 
+                r.record_json"""
+
+        query = f"""
+            SELECT
+                f.record_id, f.feedback_result_id, f.feedback_definition_id, 
+                f.last_ts,
+                f.status,
+                f.attempts,
+                f.error,
+                f.name,
+                f.result, 
+                f.cost_json,
+                r.perf_json,
+                f.calls_json,
+                r.app_id{json_columns}
+            FROM {self.TABLE_RECORDS} r
+                JOIN {self.TABLE_FEEDBACKS} f 
+                JOIN {self.TABLE_FEEDBACK_DEFS} fd
+                JOIN {self.TABLE_APPS} c
+            WHERE f.feedback_definition_id=fd.feedback_definition_id
+                AND r.record_id=f.record_id
+                AND r.app_id=c.app_id
+                {where_clause}
+        """
+
+        with self._transaction() as c:
+            c.execute(query, vars)
+            rows = c.fetchall()
+            columns = [description[0] for description in c.description]
+
+            if include_json:
+                record_jsons = self._load_records(
+                    c, [row[columns.index('record_json')] for row in rows]
+                )
+
+        df = pd.DataFrame(rows, columns=columns)
+
+        apps = self._get_apps(df['app_id'].unique())
+        if include_json:
+            df['record_json'] = pd.Series(
+                record_jsons, index=df.index, dtype=object
+            )
+            # Parsed once per app; rows of the same app share it.
+            app_jsons = {
+                app_id: json.loads(app_str)
+                for app_id, (app_str, _) in apps.items()
+            }
+
+        def map_row(row):
+            # NOTE: pandas dataframe will take in the various classes below but the
+            # agg table used in UI will not like it. Sending it JSON/dicts instead.
+
+            row.calls_json = json.loads(
+                Codec.decode(row.calls_json)
+            )['calls']  # calls_json (sequence of FeedbackCall)
+            row.cost_json = json.loads(row.cost_json)  # cost_json (Cost)
+            row.perf_json = json.loads(row.perf_json)  # perf_json (Perf)
+
+            if include_json:
+                row.feedback_json = json.loads(
+                    row.feedback_json
+                )  # feedback_json (FeedbackDefinition)
+                row['app_json'] = app_jsons[row.app_id]  # app_json (App)
+
+            row.status = FeedbackResultStatus(row.status)
+
+            row['latency'] = Perf(**row.perf_json).latency
+            row['total_tokens'] = row.cost_json['n_tokens']
+            row['total_cost'] = row.cost_json['cost']
+
+            return row
+
+        df = df.apply(map_row, axis=1)
+
+        df['type'] = df['app_id'].map(
+            {
+                app_id: app.root_class for app_id, (_, app) in apps.items()
+            }
+        )
+
+        return pd.DataFrame(df)
+
+    # TruDB requirement
+    def get_data_version(self) -> Optional[int]:
+        # Per connection, so always read through the calling thread's one.
+        _, c = self._connect()
+        try:
+            c.execute("PRAGMA data_version")
+            return c.fetchone()[0]
+        finally:
+            c.close()
+
+    # TruDB requirement
+    def get_data_stamp(self) -> Optional[Hashable]:
+        # The data version of a connection changes with every commit of any
+        # other connection, so of every commit when read through one that is
+        # never written to.
+        with self._stamp_lock:
+            if self._stamp_conn is None or self._stamp_conn[0] != os.getpid():
+                self._stamp_conn = (os.getpid(), self._open())
+
+            _, conn = self._stamp_conn
+            return conn.execute("PRAGMA data_version").fetchone()[0]
+
+    # TruDB requirement
+    def claim_pending_feedback(
+        self,
+        limit: int = 64,
+        worker_id: Optional[str] = None,
+        lease_seconds: float = 60.0
+    ) -> pd.DataFrame:
+        worker_id = worker_id or f"{os.getpid()}"
+        now = datetime.now().timestamp()
+
+        # Results can only be computed, and are only returned by
+        # `get_feedback`, once their record, its app and their definition are
+        # written.
+        claimable = f"""EXISTS (
+                SELECT 1 FROM {self.TABLE_RECORDS} r
+                JOIN {self.TABLE_APPS} a ON a.app_id=r.app_id
+                WHERE r.record_id={self.TABLE_FEEDBACKS}.record_id
+            ) AND EXISTS (
+                SELECT 1 FROM {self.TABLE_FEEDBACK_DEFS} d
+                WHERE d.feedback_definition_id=
+                    {self.TABLE_FEEDBACKS}.feedback_definition_id
+            )"""
+
+        def claim(c: sqlite3.Cursor) -> List[FeedbackResultID]:
+            # Take the write lock before looking so that two workers cannot
+            # claim the same rows.
+            c.execute("BEGIN IMMEDIATE")
+
+            # Only due rows are visited, through the index on next_retry_ts.
+            # Those claimed MAX_ATTEMPTS times without being computed, such as
+            # by workers that crashed on them, are given up on.
+            c.execute(
+                f"""UPDATE {self.TABLE_FEEDBACKS}
+                    SET status=?, last_ts=?, worker_id=NULL, lease_until=NULL,
+                        next_retry_ts=NULL,
+                        error=COALESCE(error, 'Not computed after ' || attempts
+                            || ' attempts.')
+                    WHERE next_retry_ts <= ? AND attempts >= ?""", (
+                    FeedbackResultStatus.FAILED.value, now, now,
+                    self.MAX_ATTEMPTS
+                )
+            )
+
+            # Those that cannot be computed yet are looked at again once a
+            # lease would have run out, without counting as attempts.
+            c.execute(
+                f"""UPDATE {self.TABLE_FEEDBACKS} SET next_retry_ts=?
+                    WHERE next_retry_ts <= ? AND NOT ({claimable})""",
+                (now + lease_seconds, now)
+            )
+
+            c.execute(
+                f"""SELECT feedback_result_id FROM {self.TABLE_FEEDBACKS}
+                    WHERE next_retry_ts <= ? AND {claimable}
+                    ORDER BY next_retry_ts
+                    LIMIT ?""", (now, limit)
+            )
+            feedback_result_ids = [row[0] for row in c.fetchall()]
+
+            # Claimed results are due again once their lease runs out.
+            c.executemany(
+                f"""UPDATE {self.TABLE_FEEDBACKS}
+                    SET status=?, last_ts=?, worker_id=?, lease_until=?,
+                        next_retry_ts=?, attempts=attempts + 1
+                    WHERE feedback_result_id=?""", [
+                    (
+                        FeedbackResultStatus.RUNNING.value, now, worker_id,
+                        now + lease_seconds, now + lease_seconds,
+                        feedback_result_id
+                    ) for feedback_result_id in feedback_result_ids
+                ]
+            )
+
+            return feedback_result_ids
+
+        # Idle workers look often; only take the write lock if there is
+        # something to claim.
+        due = self.next_claim_ts()
+        if due is None or due > now:
+            return pd.DataFrame()
+
+        feedback_result_ids = self._write(claim)
+
+        if len(feedback_result_ids) == 0:
+            return pd.DataFrame()
+
+        return self.get_feedback(feedback_result_id=feedback_result_ids)
+
+    def next_claim_ts(self) -> Optional[float]:
+        """
+        When the next feedback result is due to be claimed by
+        `claim_pending_feedback`, in seconds since the epoch and possibly in
+        the past, or None if there are none that will ever be.
+        """
+
+        with self._transaction() as c:
+            c.execute(f"SELECT MIN(next_retry_ts) FROM {self.TABLE_FEEDBACKS}")
+            return c.fetchone()[0]
+
+    def get_app(self, app_id: str) -> Optional[JSON]:
+        with self._transaction() as c:
+            c.execute(
+                f"SELECT app_json FROM {self.TABLE_APPS} WHERE app_id=?",
+                (app_id,)
+            )
+            result = c.fetchone()
+
+        if result is None:
+            return None
+
+        return json.loads(result[0])
+
+    def _parse_app(self, app_id: AppID, app_str: str) -> App:
+        """
+        Parse the json of an app, reusing the result of an earlier parse of the
+        same json if it is still cached.
+        """
+
+        key = (app_id, hashlib.md5(app_str.encode()).hexdigest())
+
+        with self._app_cache_lock:
+            app = self._app_cache.get(key)
+            if app is not None:
+                self._app_cache.move_to_end(key)
+                return app
+
+        app = App.parse_raw(app_str)
+
+        with self._app_cache_lock:
+            self._app_cache[key] = app
+            while len(self._app_cache) > self.app_cache_size:
+                self._app_cache.popitem(last=False)
+
+        return app
+
+    def _invalidate_app(self, app_id: AppID) -> None:
+        with self._app_cache_lock:
+            for key in [key for key in self._app_cache if key[0] == app_id]:
+                del self._app_cache[key]
+
+    def _get_apps(self,
+                  app_ids: Iterable[AppID]) -> Dict[AppID, Tuple[str, App]]:
+        """
+        Get the json and parsed app of each of the given apps.
+        """
+
+        app_ids = list(app_ids)
+        if len(app_ids) == 0:
+            return {}
+
+        with self._transaction() as c:
+            c.execute(
+                f"""SELECT app_id, app_json FROM {self.TABLE_APPS}
+                    WHERE app_id IN ({', '.join('?' * len(app_ids))})""",
+                app_ids
+            )
+            rows = c.fetchall()
+
+        return {
+            app_id: (app_str, self._parse_app(app_id, app_str))
+            for app_id, app_str in rows
+        }
+
+    # TruDB requirement
+    def get_record_json(self, record_id: RecordID) -> Optional[JSON]:
+        with self._transaction() as c:
+            c.execute(
+                f"SELECT record_json FROM {self.TABLE_RECORDS} WHERE record_id=?",
+                (record_id,)
+            )
+            result = c.fetchone()
+
+            if result is None:
+                return None
+
+            return self._load_records(c, [result[0]])[0]
+
+    def get_records_and_feedback(
+        self,
+        app_ids: Optional[List[str]] = None,
+        include_json: bool = True
+    ) -> Tuple[pd.DataFrame, Sequence[str]]:
+        # This returns all apps if the list of app_ids is empty.
+        return self.query_records(app_ids=app_ids, include_json=include_json)
+
+    # TruDB requirement
+    def query_records(
+        self,
+        app_ids: Optional[List[AppID]] = None,
+        record_ids: Optional[List[RecordID]] = None,
+        ts_range: Optional[Tuple[Optional[datetime],
+                                 Optional[datetime]]] = None,
+        tags: Optional[List[str]] = None,
+        feedback_filters: Optional[Dict[str, Tuple[str, float]]] = None,
+        order_by: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+        include_json: bool = True
+    ) -> Tuple[pd.DataFrame, Sequence[str]]:
+        query = RecordsQuery(
+            app_ids=app_ids,
+            record_ids=record_ids,
+            ts_range=ts_range,
+            tags=tags,
+            feedback_filters=feedback_filters or dict(),
+            order_by=order_by,
+            limit=limit,
+            offset=offset
+        )
+
+        where_clause, where_vars = query.where_sql(self.TABLE_FEEDBACKS)
+        order_clause, order_vars = query.order_sql(
+            {
+                "record_id": "r.record_id",
+                "app_id": "r.app_id",
+                "ts": "r.ts",
+                "latency": self._latency_sql("r.perf_json"),
+                "total_cost": "json_extract(r.cost_json, '$.cost')",
+                "total_tokens": "json_extract(r.cost_json, '$.n_tokens')"
+            }, self.TABLE_FEEDBACKS
+        )
+        paged = query.limit is not None or query.offset > 0
+
+        # Apps are fetched separately below, once per app rather than per row.
+        if include_json:
+            columns = "r.*"
+        else:
+            columns = """r.record_id, r.app_id, r.input, r.output, r.tags,
+                r.ts, r.cost_json, r.perf_json"""
+
+        with self._transaction() as c:
+            c.execute(
+                f"""SELECT {columns}
+                    FROM {self.TABLE_RECORDS} r
+                    {where_clause}
+                    {order_clause}""", where_vars + order_vars
+            )
+            rows = c.fetchall()
+            columns = [description[0] for description in c.description]
+
+            if include_json:
+                # Only records with blobs need to be parsed here.
+                i = columns.index('record_json')
+                texts = [Codec.decode(row[i]) for row in rows]
+                blobbed = [
+                    j for j, text in enumerate(texts) if self.BLOB_KEY in text
+                ]
+                for j, obj in zip(blobbed, self._load_records(
+                        c, [texts[j] for j in blobbed])):
+                    texts[j] = json.dumps(obj)
+
+                rows = [
+                    row[:i] + (text,) + row[i + 1:]
+                    for row, text in zip(rows, texts)
+                ]
+
+        df_records = pd.DataFrame(rows, columns=columns)
+
+        if len(df_records) == 0:
+            return df_records, []
+
+        apps = self._get_apps(df_records['app_id'].unique())
+
+        # Records of apps that are not in the db are left out as with a join.
+        has_app = df_records['app_id'].isin(apps.keys())
+        if not has_app.all():
+            df_records = df_records[has_app].reset_index(drop=True)
+
+        if include_json:
+            df_records['app_json'] = df_records['app_id'].map(
+                {
+                    app_id: app_str for app_id, (app_str, _) in apps.items()
+                }
+            )
+
+        df_records['type'] = df_records['app_id'].map(
+            {
+                app_id: str(app.root_class) for app_id, (_, app) in apps.items()
+            }
+        )
+
+        cost = df_records['cost_json'].map(Cost.parse_raw)
+        df_records['total_tokens'] = cost.map(lambda v: v.n_tokens)
+        df_records['total_cost'] = cost.map(lambda v: v.cost)
+
+        perf = df_records['perf_json'].apply(Perf.parse_raw)
+        df_records['latency'] = perf.apply(lambda p: p.latency)
 
-        print(
-            f"{UNICODE_CHECK} feedback def. {feedback_definition_id} -> {self.filename}"
+        # Results of a page of records are looked up by their ids, others by
+        # the same filters as the records.
+        result_columns = "f.record_id, f.name, f.result" + (
+            ", f.calls_json" if include_json else ""
         )
 
-        return feedback_definition_id
+        with self._transaction() as c:
+            rows = []
+
+            if paged:
+                record_ids = list(df_records['record_id'])
+                for start in range(0, len(record_ids), 500):
+                    chunk = record_ids[start:start + 500]
+                    c.execute(
+                        f"""SELECT {result_columns}
+                            FROM {self.TABLE_FEEDBACKS} f
+                            WHERE f.record_id IN ({', '.join('?' * len(chunk))})""",
+                        chunk
+                    )
+                    rows.extend(c.fetchall())
 
-    def get_feedback_defs(
-        self, feedback_definition_id: Optional[str] = None
-    ) -> pd.DataFrame:
+            else:
+                c.execute(
+                    f"""SELECT {result_columns}
+                        FROM {self.TABLE_RECORDS} r
+                        JOIN {self.TABLE_FEEDBACKS} f
+                            ON r.record_id = f.record_id
+                        {where_clause}""", where_vars
+                )
+                rows = c.fetchall()
 
-        clause = ""
-        args = ()
-        if feedback_definition_id is not None:
-            clause = "WHERE feedback_id=?"
-            args = (feedback_definition_id,)
+        df_results = pd.DataFrame(
+            rows,
+            columns=["record_id", "name", "result"] +
+            (["calls_json"] if include_json else [])
+        )
 
-        query = f"""
-            SELECT
-                feedback_definition_id, feedback_json
-            FROM {self.TABLE_FEEDBACK_DEFS}
-            {clause}
-        """
+        if len(df_results) == 0:
+            return df_records, []
 
-        conn, c = self._connect()
-        c.execute(query, args)
-        rows = c.fetchall()
-        self._close(conn)
+        # Pivot to one row per record with a column for each feedback name and
+        # another with its calls. If a record has more than one result for the
+        # same name, the first that is not null is taken.
+        by_name = df_results.groupby(["record_id", "name"], sort=False)
+        df_feedbacks = by_name['result'].first().unstack()
 
-        df = pd.DataFrame(
-            rows, columns=[description[0] for description in c.description]
-        )
+        result_cols = list(df_feedbacks.columns)
 
-        return df
+        if include_json:
+            df_results['calls'] = df_results['calls_json'].map(
+                lambda calls_json: json.loads(Codec.decode(calls_json))['calls']
+            )
+            calls = df_results.groupby(["record_id", "name"],
+                                       sort=False)['calls'].first().unstack()
 
-    def _insert_or_replace_vals(self, table, vals):
-        conn, c = self._connect()
-        c.execute(
-            f"""INSERT OR REPLACE INTO {table}
-                VALUES ({','.join('?' for _ in vals)})""", vals
+            df_feedbacks = df_feedbacks.join(
+                calls, rsuffix="_calls"
+            )[[col for name in result_cols for col in [name, name + "_calls"]]]
+
+        df_feedbacks.columns.name = None
+
+        combined_df = df_records.merge(
+            df_feedbacks, how="left", left_on="record_id", right_index=True
         )
-        self._close(conn)
 
-    def insert_feedback(
-        self, feedback_result: FeedbackResult
-    ) -> FeedbackResultID:
-        """
-        Insert a record-feedback link to db or update an existing one.
-        """
+        return combined_df, result_cols
 
-        vals = (
-            feedback_result.feedback_result_id,
-            feedback_result.record_id,
-            feedback_result.feedback_definition_id,
-            feedback_result.last_ts.timestamp(),
-            feedback_result.status.value,
-            feedback_result.error,
-            json_str_of_obj(dict(calls=feedback_result.calls)
-                           ),  # extra dict is needed json's root must be a dict
-            feedback_result.result,
-            feedback_result.name,
-            json_str_of_obj(feedback_result.cost)
+    # TruDB requirement
+    def count_records(
+        self,
+        app_ids: Optional[List[AppID]] = None,
+        record_ids: Optional[List[RecordID]] = None,
+        ts_range: Optional[Tuple[Optional[datetime],
+                                 Optional[datetime]]] = None,
+        tags: Optional[List[str]] = None,
+        feedback_filters: Optional[Dict[str, Tuple[str, float]]] = None
+    ) -> int:
+        query = RecordsQuery(
+            app_ids=app_ids,
+            record_ids=record_ids,
+            ts_range=ts_range,
+            tags=tags,
+            feedback_filters=feedback_filters or dict()
+        )
+        where_clause, where_vars = query.where_sql(self.TABLE_FEEDBACKS)
+
+        # Records of apps that are not in the db are not counted, as they are
+        # left out by `query_records`. Without filters other than apps, the
+        # counts are those of the app summaries.
+        only_apps = (
+            record_ids is None and ts_range is None and not tags and
+            not feedback_filters
         )
 
-        self._insert_or_replace_vals(table=self.TABLE_FEEDBACKS, vals=vals)
+        with self._transaction() as c:
+            if only_apps:
+                c.execute(
+                    f"""SELECT COALESCE(SUM(r.records), 0)
+                        FROM {self.TABLE_APP_SUMMARY} r
+                        JOIN {self.TABLE_APPS} a ON a.app_id=r.app_id
+                        {where_clause}""", where_vars
+                )
+                return c.fetchone()[0]
 
-        if feedback_result.status == FeedbackResultStatus.DONE:
-            print(
-                f"{UNICODE_CHECK} feedback {feedback_result.feedback_result_id} on {feedback_result.record_id} -> {self.filename}"
-            )
-        else:
-            print(
-                f"{UNCIODE_YIELD} feedback {feedback_result.feedback_result_id} on {feedback_result.record_id} -> {self.filename}"
+            c.execute(
+                f"""SELECT COUNT(*)
+                    FROM {self.TABLE_RECORDS} r
+                    JOIN {self.TABLE_APPS} a ON a.app_id=r.app_id
+                    {where_clause}""", where_vars
             )
+            return c.fetchone()[0]
 
-    def get_feedback(
+    # TruDB requirement
+    def get_feedback_histograms(
         self,
-        record_id: Optional[RecordID] = None,
-        feedback_result_id: Optional[FeedbackResultID] = None,
-        feedback_definition_id: Optional[FeedbackDefinitionID] = None,
-        status: Optional[FeedbackResultStatus] = None,
-        last_ts_before: Optional[datetime] = None
+        app_ids: Optional[List[AppID]] = None,
+        bins: Sequence[float] = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
     ) -> pd.DataFrame:
+        app_ids = app_ids or []
 
-        clauses = []
-        vars = []
+        if len(app_ids) > 0:
+            join = f"""JOIN {self.TABLE_RECORDS} r ON r.record_id=f.record_id
+                WHERE r.app_id IN ({', '.join('?' * len(app_ids))})"""
+        else:
+            join = ""
 
-        if record_id is not None:
-            clauses.append("record_id=?")
-            vars.append(record_id)
+        with self._transaction() as c:
+            c.execute(
+                f"""SELECT name, bin, COUNT(*) FROM (
+                        SELECT f.name, {self._bin_sql("f.result", bins)} AS bin
+                        FROM {self.TABLE_FEEDBACKS} f
+                        {join}
+                    )
+                    WHERE bin IS NOT NULL
+                    GROUP BY name, bin""", app_ids
+            )
+            rows = c.fetchall()
 
-        if feedback_result_id is not None:
-            clauses.append("f.feedback_result_id=?")
-            vars.append(feedback_result_id)
+        return self._histograms_of_counts(
+            pd.DataFrame(rows, columns=["name", "bin", "count"]), bins
+        )
 
-        if feedback_definition_id is not None:
-            clauses.append("f.feedback_definition_id=?")
-            vars.append(feedback_definition_id)
+    # TruDB requirement
+    def search_records(
+        self,
+        text: str,
+        app_ids: Optional[List[AppID]] = None,
+        limit: int = 50,
+        include_json: bool = True
+    ) -> Tuple[pd.DataFrame, Sequence[str]]:
+        terms = text.split()
+        if len(terms) == 0:
+            return self.query_records(
+                app_ids=app_ids,
+                order_by="-ts",
+                limit=limit,
+                include_json=include_json
+            )
 
-        if status is not None:
-            if isinstance(status, Sequence):
-                clauses.append(
-                    "f.status in (" + (",".join(["?"] * len(status))) + ")"
+        app_clause = ""
+        app_vars = []
+        if app_ids:
+            app_clause = f"AND r.app_id IN ({', '.join('?' * len(app_ids))})"
+            app_vars = list(app_ids)
+
+        with self._transaction() as c:
+            if self._has_fts(c):
+                # Each word is quoted so that none is taken for FTS5 query
+                # syntax; all of them have to match.
+                match = " ".join(
+                    '"' + term.replace('"', '""') + '"' for term in terms
                 )
-                for v in status:
-                    vars.append(v.value)
+                c.execute(
+                    f"""SELECT r.record_id
+                        FROM {self.TABLE_RECORDS_FTS}
+                        JOIN {self.TABLE_RECORDS} r
+                            ON r.rowid = {self.TABLE_RECORDS_FTS}.rowid
+                        WHERE {self.TABLE_RECORDS_FTS} MATCH ? {app_clause}
+                        ORDER BY {self.TABLE_RECORDS_FTS}.rank
+                        LIMIT ?""", [match] + app_vars + [limit]
+                )
+
             else:
-                clauses.append("f.status=?")
-                vars.append(status)
+                # Without the index, the records are scanned and the latest
+                # matches come first.
+                like = "(r.input LIKE ? ESCAPE '\\' OR r.output LIKE ? ESCAPE '\\')"
+                likes = []
+                for term in terms:
+                    pattern = "%" + re.sub(r"([\\%_])", r"\\\1", term) + "%"
+                    likes.extend([pattern, pattern])
+                c.execute(
+                    f"""SELECT r.record_id
+                        FROM {self.TABLE_RECORDS} r
+                        WHERE {" AND ".join([like] * len(terms))} {app_clause}
+                        ORDER BY r.ts DESC
+                        LIMIT ?""", likes + app_vars + [limit]
+                )
 
-        if last_ts_before is not None:
-            clauses.append("f.last_ts<=?")
-            vars.append(last_ts_before.timestamp())
+            record_ids = [row[0] for row in c.fetchall()]
 
-        where_clause = " AND ".join(clauses)
-        if len(where_clause) > 0:
-            where_clause = " AND " + where_clause
+        df, feedback_cols = self.query_records(
+            record_ids=record_ids, include_json=include_json
+        )
+        if len(df) == 0:
+            return df, feedback_cols
 
-        query = f"""
-            SELECT
-                f.record_id, f.feedback_result_id, f.feedback_definition_id, 
-                f.last_ts,
-                f.status,
-                f.error,
-                f.name,
-                f.result, 
-                f.cost_json,
-                r.perf_json,
-                f.calls_json,
-                fd.feedback_json, 
-                r.record_json, 
-                c.app_json
-            FROM {self.TABLE_RECORDS} r
-                JOIN {self.TABLE_FEEDBACKS} f 
-                JOIN {self.TABLE_FEEDBACK_DEFS} fd
-                JOIN {self.TABLE_APPS} c
-            WHERE f.feedback_definition_id=fd.feedback_definition_id
-                AND r.record_id=f.record_id
-                AND r.app_id=c.app_id
-                {where_clause}
-        """
+        rank = df['record_id'].map(
+            {
+                record_id: i for i, record_id in enumerate(record_ids)
+            }
+        )
 
-        conn, c = self._connect()
-        c.execute(query, vars)
-        rows = c.fetchall()
-        self._close(conn)
+        return df.iloc[rank.argsort()].reset_index(drop=True), feedback_cols
 
-        df = pd.DataFrame(
-            rows, columns=[description[0] for description in c.description]
-        )
+    # TruDB requirement
+    def get_app_summaries(
+        self,
+        app_ids: Optional[List[str]] = None
+    ) -> Tuple[pd.DataFrame, Sequence[str]]:
+        # Read from the summary tables, so this does not depend on the number
+        # of records. Latency percentiles are exact: the counts of records per
+        # latency bin tell which bin each lies in, and it is then looked up
+        # from the start of that bin in the index of the records by latency.
 
-        def map_row(row):
-            # NOTE: pandas dataframe will take in the various classes below but the
-            # agg table used in UI will not like it. Sending it JSON/dicts instead.
+        app_ids = app_ids or []
 
-            row.calls_json = json.loads(
-                row.calls_json
-            )['calls']  # calls_json (sequence of FeedbackCall)
-            row.cost_json = json.loads(row.cost_json)  # cost_json (Cost)
-            row.perf_json = json.loads(row.perf_json)  # perf_json (Perf)
-            row.feedback_json = json.loads(
-                row.feedback_json
-            )  # feedback_json (FeedbackDefinition)
-            row.record_json = json.loads(
-                row.record_json
-            )  # record_json (Record)
-            row.app_json = json.loads(row.app_json)  # app_json (App)
-            app = App(**row.app_json)
+        where_clause = ""
+        if len(app_ids) > 0:
+            where_clause = f"WHERE app_id IN ({', '.join('?' * len(app_ids))})"
 
-            row.status = FeedbackResultStatus(row.status)
+        with self._transaction() as c:
+            c.execute(
+                f"""SELECT app_id, records,
+                        latency_sum / records AS latency,
+                        cost_sum AS total_cost,
+                        tokens_sum AS total_tokens
+                    FROM {self.TABLE_APP_SUMMARY}
+                    {where_clause}
+                    {"AND" if where_clause else "WHERE"} records > 0
+                    ORDER BY app_id""", app_ids
+            )
+            df = pd.DataFrame(
+                c.fetchall(),
+                columns=[description[0] for description in c.description]
+            )
 
-            row['latency'] = Perf(**row.perf_json).latency
-            row['total_tokens'] = row.cost_json['n_tokens']
-            row['total_cost'] = row.cost_json['cost']
+            c.execute(
+                f"""SELECT app_id, bin, records
+                    FROM {self.TABLE_APP_LATENCY_BINS}
+                    {where_clause}
+                    {"AND" if where_clause else "WHERE"} records > 0
+                    ORDER BY app_id, bin""", app_ids
+            )
+            bins = defaultdict(list)
+            for app_id, bin, records in c.fetchall():
+                bins[app_id].append((bin, records))
 
-            row['type'] = app.root_class
+            for q in [50, 95, 99]:
+                df[f"latency_p{q}"] = [
+                    self._latency_quantile(
+                        c, app_id, records, bins[app_id], q / 100
+                    ) for app_id, records in zip(df['app_id'], df['records'])
+                ]
 
-            return row
+            c.execute(
+                f"""SELECT app_id, name, result_sum / result_count AS result
+                    FROM {self.TABLE_APP_FEEDBACK_SUMMARY}
+                    {where_clause}
+                    {"AND" if where_clause else "WHERE"} result_count > 0""",
+                app_ids
+            )
+            df_feedbacks = pd.DataFrame(
+                c.fetchall(), columns=["app_id", "name", "result"]
+            )
 
-        df = df.apply(map_row, axis=1)
+        df = df[self.SUMMARY_COLUMNS]
 
-        return pd.DataFrame(df)
+        if len(df_feedbacks) == 0:
+            return df, []
 
-    def get_app(self, app_id: str) -> JSON:
-        conn, c = self._connect()
-        c.execute(
-            f"SELECT app_json FROM {self.TABLE_APPS} WHERE app_id=?", (app_id,)
+        df_feedbacks = df_feedbacks.pivot(
+            index="app_id", columns="name", values="result"
         )
-        result = c.fetchone()[0]
-        conn.close()
+        df_feedbacks.columns.name = None
 
-        return json.loads(result)
+        df = df.merge(
+            df_feedbacks, how="left", left_on="app_id", right_index=True
+        )
 
-    def get_records_and_feedback(
+        return df, list(df_feedbacks.columns)
+
+    # TruDB requirement
+    def get_timeseries(
         self,
-        app_ids: Optional[List[str]] = None
+        app_ids: Optional[List[str]] = None,
+        granularity: str = "hour",
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None
     ) -> Tuple[pd.DataFrame, Sequence[str]]:
-        # This returns all apps if the list of app_ids is empty.
-        app_ids = app_ids or []
+        # Read from the rollup tables, so this depends on the number of
+        # periods rather than of records. Percentiles are interpolated within
+        # the bins of the latency histograms.
 
-        conn, c = self._connect()
-        query = f"""
-            SELECT r.record_id, f.calls_json, f.result, f.name
-            FROM {self.TABLE_RECORDS} r 
-            LEFT JOIN {self.TABLE_FEEDBACKS} f
-                ON r.record_id = f.record_id
-            """
-        if len(app_ids) > 0:
-            app_id_list = ', '.join('?' * len(app_ids))
-            query = query + f" WHERE r.app_id IN ({app_id_list})"
+        seconds = self._granularity_seconds(granularity)
 
-        c.execute(query)
-        rows = c.fetchall()
-        conn.close()
+        clauses = ["granularity=?"]
+        vars = [seconds]
 
-        df_results = pd.DataFrame(
-            rows, columns=[description[0] for description in c.description]
+        if app_ids:
+            clauses.append(f"app_id IN ({', '.join('?' * len(app_ids))})")
+            vars.extend(app_ids)
+
+        if start is not None:
+            clauses.append("period>?")
+            vars.append(pd.Timestamp(start).timestamp() - seconds)
+
+        if end is not None:
+            clauses.append("period<?")
+            vars.append(pd.Timestamp(end).timestamp())
+
+        where_clause = " AND ".join(clauses)
+        bins = [f"latency_bin_{i}" for i in range(len(self.LATENCY_BINS) + 1)]
+
+        with self._transaction() as c:
+            c.execute(
+                f"""SELECT app_id, period AS ts, records,
+                        latency_sum / records AS latency,
+                        cost_sum AS total_cost,
+                        tokens_sum AS total_tokens,
+                        {", ".join(bins)}
+                    FROM {self.TABLE_APP_ROLLUPS}
+                    WHERE {where_clause} AND records > 0
+                    ORDER BY app_id, period""", vars
+            )
+            df = pd.DataFrame(
+                c.fetchall(),
+                columns=[description[0] for description in c.description]
+            )
+
+            c.execute(
+                f"""SELECT app_id, period AS ts, name,
+                        result_sum / result_count AS result
+                    FROM {self.TABLE_APP_FEEDBACK_ROLLUPS}
+                    WHERE {where_clause} AND result_count > 0""", vars
+            )
+            df_feedbacks = pd.DataFrame(
+                c.fetchall(), columns=["app_id", "ts", "name", "result"]
+            )
+
+        histograms = df[bins].to_numpy(dtype=float)
+        for q in [50, 95, 99]:
+            df[f"latency_p{q}"] = self._histogram_quantile(histograms, q / 100)
+
+        df['ts'] = pd.to_datetime(df['ts'], unit="s")
+        df = df[self.TIMESERIES_COLUMNS]
+
+        if len(df_feedbacks) == 0:
+            return df, []
+
+        df_feedbacks['ts'] = pd.to_datetime(df_feedbacks['ts'], unit="s")
+        df_feedbacks = df_feedbacks.pivot(
+            index=["app_id", "ts"], columns="name", values="result"
         )
+        df_feedbacks.columns.name = None
 
-        if len(df_results) == 0:
-            return df_results, []
+        df = df.merge(
+            df_feedbacks,
+            how="left",
+            left_on=["app_id", "ts"],
+            right_index=True
+        )
+
+        return df, list(df_feedbacks.columns)
+
+    def _latency_quantile(
+        self, c: sqlite3.Cursor, app_id: AppID, records: int,
+        bins: Sequence[Tuple[int, int]], q: float
+    ) -> float:
+        # The `q` quantile of the latencies of the `records` records of
+        # `app_id`, interpolated between the two nearest as by pandas. Those
+        # are read through the latency index, skipping only the records in
+        # their bin of the non-empty (bin, records) `bins` of the app.
+
+        position = q * (records - 1)
+        offset = int(position)
+
+        latency = self._latency_sql("perf_json")
+
+        # The bound is written as in the bins' triggers so that both compare
+        # latencies to the same number.
+        start = ""
+        skip = offset
+        for bin, count in bins:
+            if skip < count:
+                if bin > 0:
+                    bound = self.LATENCY_SUMMARY_BINS[bin - 1]
+                    start = f"AND {latency} >= {bound!r}"
+                    offset = skip
+                break
+            skip -= count
+
+        c.execute(
+            f"""SELECT {latency} AS latency FROM {self.TABLE_RECORDS}
+                WHERE app_id=? {start}
+                ORDER BY latency
+                LIMIT 2 OFFSET ?""", (app_id, offset)
+        )
+        latencies = [row[0] for row in c.fetchall()]
+
+        if len(latencies) == 0:
+            return np.nan
+        if len(latencies) == 1:
+            return latencies[0]
+
+        return latencies[0] + (position - int(position)) * (
+            latencies[1] - latencies[0]
+        )
 
+    def _histogram_quantile(
+        self, histograms: np.ndarray, q: float
+    ) -> np.ndarray:
+        # Estimate of the `q` quantile of the latencies counted in each row of
+        # `histograms`, assuming they are spread evenly within each bin. The
+        # first bin starts at 0 and latencies in the last are taken to be at
+        # its lower bound.
+
+        if len(histograms) == 0:
+            return np.zeros(0)
+
+        lowers = np.array([0.0] + self.LATENCY_BINS)
+        uppers = np.array(self.LATENCY_BINS + [self.LATENCY_BINS[-1]])
+
+        cumulative = histograms.cumsum(axis=1)
+        target = q * cumulative[:, -1:]
+
+        # First bin reaching the target and the fraction of it needed.
+        i = (cumulative < target).sum(axis=1)
+        rows = np.arange(len(histograms))
+        before = np.where(i > 0, cumulative[rows, np.maximum(i - 1, 0)], 0.0)
+        fraction = (target[:, 0] - before) / histograms[rows, i]
+
+        return lowers[i] + fraction * (uppers[i] - lowers[i])
+
+
+class InMemoryDB(LocalSQLite):
+    """
+    SQLite database kept in memory, for tests, notebooks and benchmarks that
+    should not touch the disk. All threads share one connection.
+
+    If `snapshot_file` is given, the database starts from its contents if it
+    exists and can be copied back to it with `snapshot`, which is also done
+    every `snapshot_interval` seconds if given and when the database is
+    closed. Other processes, such as the dashboard or forked evaluators, only
+    see what was last written to the snapshot file.
+    """
+
+    filename: Path = Path(":memory:")
+
+    snapshot_file: Optional[Path] = None
+    snapshot_interval: Optional[float] = None
+
+    _conn: Optional[sqlite3.Connection] = pydantic.PrivateAttr(None)
+    _lock: threading.RLock = pydantic.PrivateAttr(
+        default_factory=threading.RLock
+    )
+    _snapshot_stop: threading.Event = pydantic.PrivateAttr(
+        default_factory=threading.Event
+    )
+    _snapshot_thread: Optional[threading.Thread] = pydantic.PrivateAttr(None)
+
+    def __init__(self, **kwargs):
+        kwargs['filename'] = Path(":memory:")
+
+        super().__init__(**kwargs)
+
+        if self.snapshot_interval is not None:
+            if self.snapshot_file is None:
+                raise ValueError("snapshot_interval requires a snapshot_file.")
+
+            self._snapshot_thread = threading.Thread(
+                target=self._snapshot_loop, daemon=True
+            )
+            self._snapshot_thread.start()
+
+    def __str__(self) -> str:
+        return "SQLite(:memory:)"
+
+    def _connect(self) -> Tuple[sqlite3.Connection, sqlite3.Cursor]:
+        with self._lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(
+                    ":memory:", check_same_thread=False
+                )
+                self._configure(self._conn)
+
+                if self.snapshot_file is not None and Path(self.snapshot_file
+                                                          ).exists():
+                    source = sqlite3.connect(self.snapshot_file)
+                    source.backup(self._conn)
+                    source.close()
+
+            return self._conn, self._conn.cursor()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        # Transactions of different threads would otherwise interleave on the
+        # shared connection.
+
+        with self._lock:
+            with super()._transaction() as c:
+                yield c
+
+    def get_data_stamp(self) -> Optional[Hashable]:
+        # There is no other connection to tell changes by; the shared one
+        # counts the rows it changed instead.
         conn, c = self._connect()
-        query = f"""
-            SELECT DISTINCT r.*, c.app_json
-            FROM {self.TABLE_RECORDS} r 
-            JOIN {self.TABLE_APPS} c
-                ON r.app_id = c.app_id
-            """
-        if len(app_ids) > 0:
-            app_id_list = ', '.join('?' * len(app_ids))
-            query = query + f" WHERE r.app_id IN ({app_id_list})"
+        c.close()
+        return (id(conn), conn.total_changes)
+
+    def snapshot(self, filename: Optional[Path] = None) -> None:
+        """
+        Write a consistent copy of the database to `filename` or, if not
+        given, to `snapshot_file`. The file is replaced atomically.
+        """
 
-        c.execute(query)
-        rows = c.fetchall()
-        conn.close()
+        with self._lock:
+            super().snapshot(filename or self.snapshot_file)
 
-        df_records = pd.DataFrame(
-            rows, columns=[description[0] for description in c.description]
+    def _snapshot_loop(self) -> None:
+        while not self._snapshot_stop.wait(self.snapshot_interval):
+            try:
+                self.snapshot()
+            except Exception as e:
+                logger.error(f"Could not snapshot {self}: {e}")
+
+    def close(self) -> None:
+        """
+        Stop periodic snapshots and write a final one if there is a
+        snapshot file, then discard the database.
+        """
+
+        self._snapshot_stop.set()
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+            self._snapshot_thread = None
+
+        with self._lock:
+            if self._conn is not None:
+                if self.snapshot_file is not None:
+                    self.snapshot()
+
+                self._conn.close()
+                self._conn = None
+
+
+class SQLiteSnapshot(LocalSQLite):
+    """
+    Read-only view of a copy of a database written by `LocalSQLite.snapshot`,
+    for example the one the dashboard reads while the app and evaluators write
+    to the original. Queries on the copy never wait for those writers nor make
+    them wait. Each thread reopens its connection once the copy has been
+    replaced by a newer one.
+    """
+
+    def __init__(self, filename: Path, **kwargs):
+        # The copy is only read, so its schema is left as it is.
+        super(LocalSQLite, self).__init__(filename=filename, **kwargs)
+
+    def __str__(self) -> str:
+        return f"SQLite({self.filename}, read-only)"
+
+    def _file_version(self) -> Tuple[int, int]:
+        stat = os.stat(self.filename)
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def get_data_stamp(self) -> Optional[Hashable]:
+        # The copy only changes by being replaced.
+        return self._file_version()
+
+    def _connect(self) -> Tuple[sqlite3.Connection, sqlite3.Cursor]:
+        version = self._file_version()
+
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.version != version:
+            with self._conns_lock:
+                if conn in self._conns:
+                    self._conns.remove(conn)
+            conn.close()
+            self._local.conn = None
+
+        self._local.version = version
+
+        return super()._connect()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            f"file:{self.filename}?mode=ro",
+            uri=True,
+            timeout=self.busy_timeout,
+            check_same_thread=False
         )
-        apps = df_records['app_json'].apply(App.parse_raw)
-        df_records['type'] = apps.apply(lambda row: str(row.root_class))
+        self._configure(conn)
 
-        cost = df_records['cost_json'].map(Cost.parse_raw)
-        df_records['total_tokens'] = cost.map(lambda v: v.n_tokens)
-        df_records['total_cost'] = cost.map(lambda v: v.cost)
+        return conn
 
-        perf = df_records['perf_json'].apply(Perf.parse_raw)
-        df_records['latency'] = perf.apply(lambda p: p.latency)
 
-        if len(df_records) == 0:
-            return df_records, []
+def db_of_url(url: str) -> TruDB:
+    """
+    Create the database given by `url`:
+
+    - `sqlite:///path/to/file.sqlite` -- sqlite file at the given path.
 
-        result_cols = set()
+    - `sqlite://` or `sqlite:///:memory:` -- `InMemoryDB`.
 
-        def expand_results(row):
-            if row['name'] is not None:
-                result_cols.add(row['name'])
-                row[row['name']] = row.result
-                row[row['name'] + "_calls"] = json.loads(row.calls_json
-                                                        )['calls']
+    - `duckdb:///path/to/file.duckdb` -- DuckDB file at the given path.
 
-            return pd.Series(row)
+    - `sqlite+writer:///path/to/file.sqlite` -- sqlite file at the given path
+      whose records and feedback results are written by the
+      `db_writer.WriterServer` running next to it.
 
-        df_results = df_results.apply(expand_results, axis=1)
-        df_results = df_results.drop(columns=["name", "result", "calls_json"])
+    - `sqlite+snapshot:///path/to/file.sqlite` -- read-only copy of a sqlite
+      database at the given path, see `SQLiteSnapshot`.
+    """
 
-        def nonempty(val):
-            if isinstance(val, float):
-                return not np.isnan(val)
-            return True
+    scheme, sep, path = url.partition("://")
+    if sep == "":
+        raise ValueError(f"Database url {url} has no scheme.")
 
-        def merge_feedbacks(vals):
-            ress = list(filter(nonempty, vals))
-            if len(ress) > 0:
-                return ress[0]
-            else:
-                return np.nan
+    # Urls are absolute with 4 slashes and relative with 3.
+    path = path[1:] if path.startswith("/") else path
+
+    if scheme == "sqlite":
+        if path in ["", ":memory:"]:
+            return InMemoryDB()
+
+        return LocalSQLite(filename=Path(path))
+
+    elif scheme == "sqlite+snapshot":
+        return SQLiteSnapshot(filename=Path(path))
+
+    elif scheme == "sqlite+writer":
+        from trulens_eval.db_writer import FunneledSQLite
 
-        df_results = df_results.groupby("record_id").agg(merge_feedbacks
-                                                        ).reset_index()
+        return FunneledSQLite(filename=Path(path))
 
-        assert "record_id" in df_results.columns
-        assert "record_id" in df_records.columns
+    elif scheme == "duckdb":
+        from trulens_eval.tru_db_duckdb import LocalDuckDB
 
-        combined_df = df_records.merge(df_results, on=['record_id'])
+        return LocalDuckDB(filename=Path(path))
 
-        return combined_df, list(result_cols)
+    raise ValueError(f"Unsupported database url scheme {scheme}.")
@@ -0,0 +1,1160 @@
+"""
+Columnar database for records and feedback results backed by DuckDB.
+
+`LocalDuckDB` implements the same `TruDB` interface as `LocalSQLite` but keeps
+latency, cost and token counts in typed columns so that summaries over many
+records are computed by the database itself. DuckDB files can only be opened
+for writing by a single process at a time, so this database is meant for
+analysis of large collections of records rather than for sharing with
+deferred feedback evaluators in other processes.
+
+An existing sqlite database can be copied into a new DuckDB one with:
+
+    python -m trulens_eval.tru_db_duckdb --sqlite default.sqlite --duckdb default.duckdb
+"""
+
+import argparse
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import logging
+from pathlib import Path
+import threading
+from typing import (
+    Dict, Hashable, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+)
+
+import pandas as pd
+import pydantic
+
+from trulens_eval import __version__
+from trulens_eval.schema import App
+from trulens_eval.schema import AppID
+from trulens_eval.schema import Cost
+from trulens_eval.schema import FeedbackDefinition
+from trulens_eval.schema import FeedbackDefinitionID
+from trulens_eval.schema import FeedbackResult
+from trulens_eval.schema import FeedbackResultID
+from trulens_eval.schema import FeedbackResultStatus
+from trulens_eval.schema import Record
+from trulens_eval.schema import RecordID
+from trulens_eval.tru_db import Codec
+from trulens_eval.tru_db import JSON
+from trulens_eval.tru_db import LocalSQLite
+from trulens_eval.tru_db import RecordsQuery
+from trulens_eval.tru_db import TruDB
+from trulens_eval.util import json_str_of_obj
+from trulens_eval.util import OptionalImports
+from trulens_eval.util import REQUIREMENT_DUCKDB
+from trulens_eval.util import UNCIODE_YIELD
+from trulens_eval.util import UNICODE_CHECK
+
+with OptionalImports(message=REQUIREMENT_DUCKDB):
+    import duckdb
+
+logger = logging.getLogger(__name__)
+
+
+class LocalDuckDB(TruDB):
+    filename: Path
+
+    # A single connection used by all threads in turn; DuckDB connections are
+    # not safe to use concurrently.
+    _conn: Optional['duckdb.DuckDBPyConnection'] = pydantic.PrivateAttr(None)
+    _lock: threading.RLock = pydantic.PrivateAttr(
+        default_factory=threading.RLock
+    )
+
+    TABLE_META = "meta"
+    TABLE_RECORDS = "records"
+    TABLE_FEEDBACKS = "feedbacks"
+    TABLE_FEEDBACK_DEFS = "feedback_defs"
+    TABLE_APPS = "apps"
+
+    TABLES = [TABLE_RECORDS, TABLE_FEEDBACKS, TABLE_FEEDBACK_DEFS, TABLE_APPS]
+
+    # Columns of the records table. Latency (in seconds), tokens and cost are
+    # also in cost_json and perf_json but kept in their own columns for
+    # aggregation.
+    RECORD_COLUMNS = [
+        "record_id", "app_id", "input", "output", "record_json", "tags", "ts",
+        "cost_json", "perf_json", "latency", "total_tokens", "total_cost"
+    ]
+
+    # Columns of the feedbacks table as in LocalSQLite, followed by those only
+    # written when claiming. The app of each result's record is also kept with
+    # it so that results can be aggregated by app without a join.
+    FEEDBACK_COLUMNS = [
+        "feedback_result_id", "record_id", "feedback_definition_id", "last_ts",
+        "status", "error", "calls_json", "result", "name", "cost_json",
+        "next_retry_ts"
+    ]
+    CLAIM_COLUMNS = ["worker_id", "lease_until", "attempts"]
+
+    # Retry policy, as in LocalSQLite.
+    RUNNING_TIMEOUT = 30
+    FAILED_RETRY_DELAY = 5 * 60
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, filename: Path, **kwargs):
+        """
+        Database locally hosted using DuckDB.
+
+        Args
+
+        - filename: Optional[Path] -- location of the DuckDB file. It will be
+          created if it does not exist.
+        """
+
+        super().__init__(filename=filename, **kwargs)
+
+        self._conn = duckdb.connect(str(self.filename))
+        self._build_tables()
+
+    def __str__(self) -> str:
+        return f"DuckDB({self.filename})"
+
+    @contextmanager
+    def _transaction(self) -> Iterator['duckdb.DuckDBPyConnection']:
+        """
+        Run the statements issued on the yielded connection in a single
+        transaction, committed on exit or rolled back on error.
+        """
+
+        with self._lock:
+            self._conn.begin()
+
+            try:
+                yield self._conn
+                self._conn.commit()
+
+            except BaseException:
+                self._conn.rollback()
+                raise
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _build_tables(self) -> None:
+        with self._transaction() as conn:
+            conn.execute(
+                f"""CREATE TABLE IF NOT EXISTS {self.TABLE_META} (
+                    key VARCHAR PRIMARY KEY,
+                    value VARCHAR
+                )"""
+            )
+            conn.execute(
+                f"""CREATE TABLE IF NOT EXISTS {self.TABLE_RECORDS} (
+                    record_id VARCHAR PRIMARY KEY,
+                    app_id VARCHAR NOT NULL,
+                    input VARCHAR,
+                    output VARCHAR,
+                    record_json VARCHAR NOT NULL,
+                    tags VARCHAR NOT NULL,
+                    ts TIMESTAMP NOT NULL,
+                    cost_json VARCHAR NOT NULL,
+                    perf_json VARCHAR NOT NULL,
+                    latency DOUBLE,
+                    total_tokens BIGINT,
+                    total_cost DOUBLE
+                )"""
+            )
+            conn.execute(
+                f"""CREATE TABLE IF NOT EXISTS {self.TABLE_FEEDBACKS} (
+                    feedback_result_id VARCHAR PRIMARY KEY,
+                    record_id VARCHAR NOT NULL,
+                    feedback_definition_id VARCHAR,
+                    last_ts DOUBLE NOT NULL,
+                    status VARCHAR NOT NULL,
+                    error VARCHAR,
+                    calls_json VARCHAR NOT NULL,
+                    result DOUBLE,
+                    name VARCHAR NOT NULL,
+                    cost_json VARCHAR NOT NULL,
+                    next_retry_ts DOUBLE,
+                    worker_id VARCHAR,
+                    lease_until DOUBLE,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    app_id VARCHAR
+                )"""
+            )
+            conn.execute(
+                f"""CREATE TABLE IF NOT EXISTS {self.TABLE_FEEDBACK_DEFS} (
+                    feedback_definition_id VARCHAR PRIMARY KEY,
+                    feedback_json VARCHAR NOT NULL
+                )"""
+            )
+            conn.execute(
+                f"""CREATE TABLE IF NOT EXISTS {self.TABLE_APPS} (
+                    app_id VARCHAR PRIMARY KEY,
+                    app_json VARCHAR NOT NULL
+                )"""
+            )
+            conn.execute(
+                f"""INSERT OR REPLACE INTO {self.TABLE_META}
+                    VALUES ('trulens_version', ?)""", [__version__]
+            )
+
+    # TruDB requirement
+    def reset_database(self) -> None:
+        with self._transaction() as conn:
+            for table in self.TABLES + [self.TABLE_META]:
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
+
+        self._build_tables()
+
+    def _insert_df(
+        self,
+        conn: 'duckdb.DuckDBPyConnection',
+        table: str,
+        df: pd.DataFrame,
+        key: str,
+        on_conflict: Optional[str] = None
+    ) -> None:
+        # Rows are inserted from a dataframe, which is much faster in DuckDB
+        # than inserting them one at a time. Only the last of rows with the same
+        # key is kept as DuckDB does not allow a key to conflict twice in one
+        # statement.
+
+        if len(df) == 0:
+            return
+
+        df = df.drop_duplicates(subset=[key], keep="last")
+
+        conn.register("rows_df", df)
+        try:
+            columns = ", ".join(df.columns)
+            if on_conflict is None:
+                conn.execute(
+                    f"""INSERT OR REPLACE INTO {table} ({columns})
+                        SELECT {columns} FROM rows_df"""
+                )
+            else:
+                conn.execute(
+                    f"""INSERT INTO {table} ({columns})
+                        SELECT {columns} FROM rows_df
+                        ON CONFLICT ({key}) DO UPDATE SET {on_conflict}"""
+                )
+        finally:
+            conn.unregister("rows_df")
+
+    def _record_vals(self, record: Record) -> tuple:
+        latency = None
+        if record.perf is not None:
+            latency = record.perf.latency.total_seconds()
+
+        cost = record.cost or Cost()
+
+        return (
+            record.record_id, record.app_id, record.main_input,
+            record.main_output, json_str_of_obj(record), record.tags, record.ts,
+            json_str_of_obj(record.cost), json_str_of_obj(record.perf), latency,
+            cost.n_tokens, cost.cost
+        )
+
+    def _insert_records(
+        self, conn: 'duckdb.DuckDBPyConnection', records: Iterable[Record]
+    ) -> None:
+        # Results written before their records get the app of those here.
+
+        df = pd.DataFrame(
+            map(self._record_vals, records), columns=self.RECORD_COLUMNS
+        )
+        self._insert_df(conn, self.TABLE_RECORDS, df, key="record_id")
+
+        if len(df) == 0:
+            return
+
+        conn.execute(
+            f"""UPDATE {self.TABLE_FEEDBACKS} SET app_id=r.app_id
+                FROM {self.TABLE_RECORDS} r
+                WHERE {self.TABLE_FEEDBACKS}.record_id=r.record_id
+                    AND list_contains(?, r.record_id)
+                    AND {self.TABLE_FEEDBACKS}.app_id IS DISTINCT FROM r.app_id""",
+            [list(df['record_id'].unique())]
+        )
+
+    def _feedback_vals(self, feedback_result: FeedbackResult) -> tuple:
+        # next_retry_ts is filled in by `_upsert_feedbacks`.
+        calls_json = json_str_of_obj(dict(calls=feedback_result.calls))
+
+        return (
+            feedback_result.feedback_result_id, feedback_result.record_id,
+            feedback_result.feedback_definition_id,
+            feedback_result.last_ts.timestamp(), feedback_result.status.value,
+            feedback_result.error, calls_json, feedback_result.result,
+            feedback_result.name, json_str_of_obj(feedback_result.cost), None
+        )
+
+    def _next_retry_sql(self, status: str, last_ts: str, attempts: str) -> str:
+        # As LocalSQLite._next_retry_sql.
+
+        return f"""CASE {status}
+            WHEN '{FeedbackResultStatus.NONE.value}' THEN {last_ts}
+            WHEN '{FeedbackResultStatus.RUNNING.value}'
+                THEN COALESCE(lease_until, {last_ts} + {self.RUNNING_TIMEOUT})
+            WHEN '{FeedbackResultStatus.FAILED.value}' THEN CASE
+                WHEN {attempts} < {self.MAX_ATTEMPTS}
+                THEN {last_ts} + {self.FAILED_RETRY_DELAY}
+                    * (1 << GREATEST({attempts} - 1, 0))
+                END
+            END"""
+
+    def _upsert_feedbacks(
+        self, conn: 'duckdb.DuckDBPyConnection',
+        feedback_results: Iterable[FeedbackResult]
+    ) -> None:
+        # Claim columns are left as they were for results already in the db.
+
+        next_retry_sql = self._next_retry_sql(
+            "excluded.status", "excluded.last_ts", "attempts"
+        )
+        updates = [
+            f"{column}=excluded.{column}"
+            for column in self.FEEDBACK_COLUMNS[1:-1]
+        ] + [
+            f"next_retry_ts={next_retry_sql}",
+            "app_id=COALESCE(CAST(excluded.app_id AS VARCHAR), app_id)"
+        ]
+
+        df = pd.DataFrame(
+            map(self._feedback_vals, feedback_results),
+            columns=self.FEEDBACK_COLUMNS
+        )
+        if len(df) == 0:
+            return
+
+        record_ids = list(df['record_id'].unique())
+        app_ids = dict(
+            conn.execute(
+                f"""SELECT record_id, app_id FROM {self.TABLE_RECORDS}
+                    WHERE record_id IN ({', '.join('?' * len(record_ids))})""",
+                record_ids
+            ).fetchall()
+        )
+        # Strings even if none of the records exist yet, which would
+        # otherwise make a column of floats.
+        df['app_id'] = df['record_id'].map(app_ids).astype(object)
+
+        # For new rows, as with no attempts and no lease.
+        df['next_retry_ts'] = [
+            {
+                FeedbackResultStatus.NONE.value:
+                    last_ts,
+                FeedbackResultStatus.RUNNING.value:
+                    last_ts + self.RUNNING_TIMEOUT,
+                FeedbackResultStatus.FAILED.value:
+                    last_ts + self.FAILED_RETRY_DELAY
+            }.get(status) for status, last_ts in zip(df.status, df.last_ts)
+        ]
+
+        self._insert_df(
+            conn,
+            self.TABLE_FEEDBACKS,
+            df,
+            key="feedback_result_id",
+            on_conflict=", ".join(updates)
+        )
+
+    # TruDB requirement
+    def insert_record(self, record: Record) -> RecordID:
+        with self._transaction() as conn:
+            self._insert_records(conn, [record])
+
+        print(
+            f"{UNICODE_CHECK} record {record.record_id} from {record.app_id} -> {self}"
+        )
+
+        return record.record_id
+
+    def insert_records(self, records: Sequence[Record]) -> List[RecordID]:
+        with self._transaction() as conn:
+            self._insert_records(conn, records)
+
+        print(f"{UNICODE_CHECK} {len(records)} record(s) -> {self}")
+
+        return [record.record_id for record in records]
+
+    # TruDB requirement
+    def insert_app(self, app: App) -> AppID:
+        with self._transaction() as conn:
+            self._insert_df(
+                conn,
+                self.TABLE_APPS,
+                pd.DataFrame(
+                    [(app.app_id, app.json())], columns=["app_id", "app_json"]
+                ),
+                key="app_id"
+            )
+
+        print(f"{UNICODE_CHECK} app {app.app_id} -> {self}")
+
+        return app.app_id
+
+    # TruDB requirement
+    def insert_feedback_definition(
+        self, feedback_definition: FeedbackDefinition
+    ) -> FeedbackDefinitionID:
+        with self._transaction() as conn:
+            self._insert_df(
+                conn,
+                self.TABLE_FEEDBACK_DEFS,
+                pd.DataFrame(
+                    [
+                        (
+                            feedback_definition.feedback_definition_id,
+                            feedback_definition.json()
+                        )
+                    ],
+                    columns=["feedback_definition_id", "feedback_json"]
+                ),
+                key="feedback_definition_id"
+            )
+
+        print(
+            f"{UNICODE_CHECK} feedback def. {feedback_definition.feedback_definition_id} -> {self}"
+        )
+
+        return feedback_definition.feedback_definition_id
+
+    # TruDB requirement
+    def insert_feedback(
+        self, feedback_result: FeedbackResult
+    ) -> FeedbackResultID:
+        with self._transaction() as conn:
+            self._upsert_feedbacks(conn, [feedback_result])
+
+        if feedback_result.status != FeedbackResultStatus.DONE:
+            print(
+                f"{UNCIODE_YIELD} feedback {feedback_result.feedback_result_id} on {feedback_result.record_id} -> {self}"
+            )
+        else:
+            print(
+                f"{UNICODE_CHECK} feedback {feedback_result.feedback_result_id} on {feedback_result.record_id} -> {self}"
+            )
+
+        return feedback_result.feedback_result_id
+
+    def insert_feedbacks(
+        self, feedback_results: Sequence[FeedbackResult]
+    ) -> List[FeedbackResultID]:
+        with self._transaction() as conn:
+            self._upsert_feedbacks(conn, feedback_results)
+
+        print(
+            f"{UNICODE_CHECK} {len(feedback_results)} feedback result(s) -> {self}"
+        )
+
+        return [
+            feedback_result.feedback_result_id
+            for feedback_result in feedback_results
+        ]
+
+    def insert_record_with_pending_feedbacks(
+        self, record: Record, feedback_results: Sequence[FeedbackResult]
+    ) -> RecordID:
+        with self._transaction() as conn:
+            self._insert_records(conn, [record])
+            self._upsert_feedbacks(conn, feedback_results)
+
+        print(
+            f"{UNCIODE_YIELD} record {record.record_id} from {record.app_id} with {len(feedback_results)} pending feedback(s) -> {self}"
+        )
+
+        return record.record_id
+
+    # TruDB requirement
+    def claim_pending_feedback(
+        self,
+        limit: int = 64,
+        worker_id: Optional[str] = None,
+        lease_seconds: float = 60.0
+    ) -> pd.DataFrame:
+        # As LocalSQLite.claim_pending_feedback.
+        now = datetime.now().timestamp()
+
+        claimable = f"""EXISTS (
+                SELECT 1 FROM {self.TABLE_RECORDS} r
+                JOIN {self.TABLE_APPS} a ON a.app_id=r.app_id
+                WHERE r.record_id={self.TABLE_FEEDBACKS}.record_id
+            ) AND EXISTS (
+                SELECT 1 FROM {self.TABLE_FEEDBACK_DEFS} d
+                WHERE d.feedback_definition_id=
+                    {self.TABLE_FEEDBACKS}.feedback_definition_id
+            )"""
+
+        with self._transaction() as conn:
+            conn.execute(
+                f"""UPDATE {self.TABLE_FEEDBACKS}
+                    SET status=?, last_ts=?, worker_id=NULL, lease_until=NULL,
+                        next_retry_ts=NULL,
+                        error=COALESCE(error, 'Not computed after '
+                            || CAST(attempts AS VARCHAR) || ' attempts.')
+                    WHERE next_retry_ts <= ? AND attempts >= ?""", [
+                    FeedbackResultStatus.FAILED.value, now, now,
+                    self.MAX_ATTEMPTS
+                ]
+            )
+            conn.execute(
+                f"""UPDATE {self.TABLE_FEEDBACKS} SET next_retry_ts=?
+                    WHERE next_retry_ts <= ? AND NOT ({claimable})""",
+                [now + lease_seconds, now]
+            )
+
+            ids = [
+                row[0] for row in conn.execute(
+                    f"""SELECT feedback_result_id FROM {self.TABLE_FEEDBACKS}
+                        WHERE next_retry_ts <= ? AND {claimable}
+                        ORDER BY next_retry_ts
+                        LIMIT ?""", [now, limit]
+                ).fetchall()
+            ]
+
+            if len(ids) > 0:
+                conn.execute(
+                    f"""UPDATE {self.TABLE_FEEDBACKS}
+                        SET status=?, last_ts=?, worker_id=?, lease_until=?,
+                            next_retry_ts=?, attempts=attempts + 1
+                        WHERE feedback_result_id IN ({', '.join('?' * len(ids))})""",
+                    [
+                        FeedbackResultStatus.RUNNING.value, now, worker_id,
+                        now + lease_seconds, now + lease_seconds
+                    ] + ids
+                )
+
+        if len(ids) == 0:
+            return pd.DataFrame()
+
+        return self.get_feedback(feedback_result_id=ids)
+
+    def get_app(self, app_id: str) -> Optional[JSON]:
+        with self._transaction() as conn:
+            result = conn.execute(
+                f"SELECT app_json FROM {self.TABLE_APPS} WHERE app_id=?",
+                [app_id]
+            ).fetchone()
+
+        if result is None:
+            return None
+
+        return json.loads(result[0])
+
+    def _get_apps(self,
+                  app_ids: Iterable[AppID]) -> Dict[AppID, Tuple[str, App]]:
+        app_ids = list(app_ids)
+        if len(app_ids) == 0:
+            return {}
+
+        with self._transaction() as conn:
+            rows = conn.execute(
+                f"""SELECT app_id, app_json FROM {self.TABLE_APPS}
+                    WHERE app_id IN ({', '.join('?' * len(app_ids))})""",
+                app_ids
+            ).fetchall()
+
+        return {
+            app_id: (app_str, App.parse_raw(app_str)) for app_id, app_str in rows
+        }
+
+    def get_feedback_defs(
+        self, feedback_definition_id: Optional[str] = None
+    ) -> pd.DataFrame:
+        clause = ""
+        args = []
+        if feedback_definition_id is not None:
+            clause = "WHERE feedback_definition_id=?"
+            args = [feedback_definition_id]
+
+        with self._transaction() as conn:
+            return conn.execute(
+                f"""SELECT feedback_definition_id, feedback_json
+                    FROM {self.TABLE_FEEDBACK_DEFS} {clause}""", args
+            ).df()
+
+    # TruDB requirement
+    def get_record_json(self, record_id: RecordID) -> Optional[JSON]:
+        with self._transaction() as conn:
+            result = conn.execute(
+                f"SELECT record_json FROM {self.TABLE_RECORDS} WHERE record_id=?",
+                [record_id]
+            ).fetchone()
+
+        if result is None:
+            return None
+
+        return json.loads(result[0])
+
+    def get_feedback(
+        self,
+        record_id: Optional[RecordID] = None,
+        feedback_result_id: Optional[Union[FeedbackResultID,
+                                           Sequence[FeedbackResultID]]] = None,
+        feedback_definition_id: Optional[FeedbackDefinitionID] = None,
+        status: Optional[FeedbackResultStatus] = None,
+        last_ts_before: Optional[datetime] = None,
+        include_json: bool = True
+    ) -> pd.DataFrame:
+        """
+        Get feedback results matching the given filters, as in
+        `LocalSQLite.get_feedback`.
+        """
+
+        clauses = []
+        vars = []
+
+        if record_id is not None:
+            clauses.append("f.record_id=?")
+            vars.append(record_id)
+
+        if feedback_result_id is not None:
+            if isinstance(feedback_result_id, str):
+                feedback_result_id = [feedback_result_id]
+            clauses.append(
+                f"f.feedback_result_id IN ({', '.join('?' * len(feedback_result_id))})"
+            )
+            vars.extend(feedback_result_id)
+
+        if feedback_definition_id is not None:
+            clauses.append("f.feedback_definition_id=?")
+            vars.append(feedback_definition_id)
+
+        if status is not None:
+            if not isinstance(status, Sequence):
+                status = [status]
+            clauses.append(f"f.status IN ({', '.join('?' * len(status))})")
+            vars.extend(FeedbackResultStatus(s).value for s in status)
+
+        if last_ts_before is not None:
+            clauses.append("f.last_ts<=?")
+            vars.append(last_ts_before.timestamp())
+
+        where_clause = " AND ".join(clauses)
+        if len(where_clause) > 0:
+            where_clause = "WHERE " + where_clause
+
+        json_columns = ""
+        if include_json:
+            json_columns = ", fd.feedback_json, r.record_json"
+
+        query = f"""
+            SELECT
+                f.record_id, f.feedback_result_id, f.feedback_definition_id,
+                f.last_ts, f.status, f.attempts, f.error, f.name, f.result,
+                f.cost_json, r.perf_json, f.calls_json, r.app_id,
+                r.latency{json_columns}
+            FROM {self.TABLE_FEEDBACKS} f
+                JOIN {self.TABLE_RECORDS} r ON r.record_id=f.record_id
+                JOIN {self.TABLE_FEEDBACK_DEFS} fd
+                    ON fd.feedback_definition_id=f.feedback_definition_id
+                JOIN {self.TABLE_APPS} a ON a.app_id=r.app_id
+            {where_clause}
+        """
+
+        with self._transaction() as conn:
+            df = conn.execute(query, vars).df()
+
+        apps = self._get_apps(df['app_id'].unique())
+
+        df['calls_json'] = df['calls_json'].map(
+            lambda calls_json: json.loads(calls_json)['calls']
+        )
+        df['cost_json'] = df['cost_json'].map(json.loads)
+        df['perf_json'] = df['perf_json'].map(json.loads)
+
+        if include_json:
+            df['feedback_json'] = df['feedback_json'].map(json.loads)
+            df['record_json'] = df['record_json'].map(json.loads)
+            app_jsons = {
+                app_id: json.loads(app_str)
+                for app_id, (app_str, _) in apps.items()
+            }
+            df['app_json'] = df['app_id'].map(app_jsons)
+
+        df['status'] = df['status'].map(FeedbackResultStatus)
+        df['latency'] = pd.to_timedelta(df['latency'], unit="s")
+        df['total_tokens'] = df['cost_json'].map(lambda c: c['n_tokens'])
+        df['total_cost'] = df['cost_json'].map(lambda c: c['cost'])
+
+        df['type'] = df['app_id'].map(
+            {
+                app_id: app.root_class for app_id, (_, app) in apps.items()
+            }
+        )
+
+        return df
+
+    # TruDB requirement
+    def get_data_stamp(self) -> Optional[Hashable]:
+        # DuckDB has no change counter. Adding or deleting rows and updating
+        # feedback results, which sets a newer last_ts, show in these counts
+        # and maxima; rewriting a record or app in place does not.
+        with self._transaction() as conn:
+            return conn.execute(
+                f"""SELECT
+                        (SELECT COUNT(*) FROM {self.TABLE_APPS}),
+                        (SELECT COUNT(*) FROM {self.TABLE_RECORDS}),
+                        (SELECT MAX(ts) FROM {self.TABLE_RECORDS}),
+                        (SELECT COUNT(*) FROM {self.TABLE_FEEDBACKS}),
+                        (SELECT MAX(last_ts) FROM {self.TABLE_FEEDBACKS})"""
+            ).fetchone()
+
+    # TruDB requirement
+    def get_records_and_feedback(
+        self,
+        app_ids: Optional[List[str]] = None,
+        include_json: bool = True
+    ) -> Tuple[pd.DataFrame, Sequence[str]]:
+        # This returns all apps if the list of app_ids is empty.
+        return self.query_records(
+            app_ids=app_ids, order_by="ts", include_json=include_json
+        )
+
+    # TruDB requirement
+    def query_records(
+        self,
+        app_ids: Optional[List[AppID]] = None,
+        record_ids: Optional[List[RecordID]] = None,
+        ts_range: Optional[Tuple[Optional[datetime],
+                                 Optional[datetime]]] = None,
+        tags: Optional[List[str]] = None,
+        feedback_filters: Optional[Dict[str, Tuple[str, float]]] = None,
+        order_by: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+        include_json: bool = True
+    ) -> Tuple[pd.DataFrame, Sequence[str]]:
+        query = RecordsQuery(
+            app_ids=app_ids,
+            record_ids=record_ids,
+            ts_range=ts_range,
+            tags=tags,
+            feedback_filters=feedback_filters or dict(),
+            order_by=order_by,
+            limit=limit,
+            offset=offset
+        )
+
+        where_clause, where_vars = query.where_sql(self.TABLE_FEEDBACKS)
+        order_clause, order_vars = query.order_sql(
+            {
+                column: f"r.{column}" for column in [
+                    "record_id", "app_id", "ts", "latency", "total_cost",
+                    "total_tokens"
+                ]
+            }, self.TABLE_FEEDBACKS
+        )
+        paged = query.limit is not None or query.offset > 0
+
+        record_columns = [
+            "record_id", "app_id", "input", "output", "tags", "ts", "cost_json",
+            "perf_json", "latency", "total_tokens", "total_cost"
+        ]
+        if include_json:
+            record_columns.insert(4, "record_json")
+
+        with self._transaction() as conn:
+            df_records = conn.execute(
+                f"""SELECT {', '.join('r.' + col for col in record_columns)}
+                    FROM {self.TABLE_RECORDS} r
+                    JOIN {self.TABLE_APPS} a ON a.app_id=r.app_id
+                    {where_clause}
+                    {order_clause}""", where_vars + order_vars
+            ).df()
+
+            # Results of a page of records are looked up by their ids, others
+            # by the same filters as the records.
+            result_columns = "f.record_id, f.name, f.result" + (
+                ", f.calls_json" if include_json else ""
+            )
+            if paged:
+                df_results = conn.execute(
+                    f"""SELECT {result_columns}
+                        FROM {self.TABLE_FEEDBACKS} f
+                        WHERE list_contains(?, f.record_id)""",
+                    [list(df_records['record_id'])]
+                ).df()
+            else:
+                df_results = conn.execute(
+                    f"""SELECT {result_columns}
+                        FROM {self.TABLE_FEEDBACKS} f
+                        JOIN {self.TABLE_RECORDS} r ON r.record_id=f.record_id
+                        {where_clause}""", where_vars
+                ).df()
+
+        if len(df_records) == 0:
+            return df_records, []
+
+        apps = self._get_apps(df_records['app_id'].unique())
+
+        if include_json:
+            df_records['app_json'] = df_records['app_id'].map(
+                {
+                    app_id: app_str for app_id, (app_str, _) in apps.items()
+                }
+            )
+
+        df_records['type'] = df_records['app_id'].map(
+            {
+                app_id: str(app.root_class) for app_id, (_, app) in apps.items()
+            }
+        )
+        df_records['latency'] = pd.to_timedelta(df_records['latency'], unit="s")
+
+        if len(df_results) == 0:
+            return df_records, []
+
+        by_name = df_results.groupby(["record_id", "name"], sort=False)
+        df_feedbacks = by_name['result'].first().unstack()
+
+        result_cols = list(df_feedbacks.columns)
+
+        if include_json:
+            df_results['calls'] = df_results['calls_json'].map(
+                lambda calls_json: json.loads(calls_json)['calls']
+            )
+            calls = df_results.groupby(["record_id", "name"],
+                                       sort=False)['calls'].first().unstack()
+
+            df_feedbacks = df_feedbacks.join(
+                calls, rsuffix="_calls"
+            )[[col for name in result_cols for col in [name, name + "_calls"]]]
+
+        df_feedbacks.columns.name = None
+
+        combined_df = df_records.merge(
+            df_feedbacks, how="left", left_on="record_id", right_index=True
+        )
+
+        return combined_df, result_cols
+
+    # TruDB requirement
+    def count_records(
+        self,
+        app_ids: Optional[List[AppID]] = None,
+        record_ids: Optional[List[RecordID]] = None,
+        ts_range: Optional[Tuple[Optional[datetime],
+                                 Optional[datetime]]] = None,
+        tags: Optional[List[str]] = None,
+        feedback_filters: Optional[Dict[str, Tuple[str, float]]] = None
+    ) -> int:
+        query = RecordsQuery(
+            app_ids=app_ids,
+            record_ids=record_ids,
+            ts_range=ts_range,
+            tags=tags,
+            feedback_filters=feedback_filters or dict()
+        )
+        where_clause, where_vars = query.where_sql(self.TABLE_FEEDBACKS)
+
+        with self._transaction() as conn:
+            return conn.execute(
+                f"""SELECT COUNT(*)
+                    FROM {self.TABLE_RECORDS} r
+                    JOIN {self.TABLE_APPS} a ON a.app_id=r.app_id
+                    {where_clause}""", where_vars
+            ).fetchone()[0]
+
+    # TruDB requirement
+    def get_feedback_histograms(
+        self,
+        app_ids: Optional[List[AppID]] = None,
+        bins: Sequence[float] = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+    ) -> pd.DataFrame:
+        # Results are kept with the app of their record, so no join is needed.
+        app_ids = app_ids or []
+        where_clause = "WHERE list_contains(?, app_id)" if len(
+            app_ids
+        ) > 0 else ""
+
+        with self._transaction() as conn:
+            df_counts = conn.execute(
+                f"""SELECT name, bin, COUNT(*) AS count FROM (
+                        SELECT name, {self._bin_sql("result", bins)} AS bin
+                        FROM {self.TABLE_FEEDBACKS}
+                        {where_clause}
+                    )
+                    WHERE bin IS NOT NULL
+                    GROUP BY name, bin""", [app_ids] if len(app_ids) > 0 else []
+            ).df()
+
+        return self._histograms_of_counts(df_counts, bins)
+
+    # TruDB requirement
+    def search_records(
+        self,
+        text: str,
+        app_ids: Optional[List[AppID]] = None,
+        limit: int = 50,
+        include_json: bool = True
+    ) -> Tuple[pd.DataFrame, Sequence[str]]:
+        # Matches are found by scanning the input and output columns, which
+        # DuckDB does quickly; the latest come first.
+
+        terms = text.lower().split()
+
+        clauses = [
+            "contains(lower(concat_ws(' ', r.input, r.output)), ?)"
+            for _ in terms
+        ]
+        vars = list(terms)
+        if app_ids:
+            clauses.append(f"r.app_id IN ({', '.join('?' * len(app_ids))})")
+            vars.extend(app_ids)
+        where_clause = "WHERE " + " AND ".join(clauses) if clauses else ""
+
+        with self._transaction() as conn:
+            record_ids = [
+                row[0] for row in conn.execute(
+                    f"""SELECT r.record_id
+                        FROM {self.TABLE_RECORDS} r
+                        {where_clause}
+                        ORDER BY r.ts DESC
+                        LIMIT ?""", vars + [limit]
+                ).fetchall()
+            ]
+
+        return self.query_records(
+            record_ids=record_ids, order_by="-ts", include_json=include_json
+        )
+
+    # TruDB requirement
+    def get_app_summaries(
+        self,
+        app_ids: Optional[List[str]] = None
+    ) -> Tuple[pd.DataFrame, Sequence[str]]:
+        # Aggregated by DuckDB over the typed columns, with exact percentiles
+        # interpolated between records as by pandas.
+
+        app_ids = app_ids or []
+
+        where_clause = ""
+        if len(app_ids) > 0:
+            where_clause = f"WHERE app_id IN ({', '.join('?' * len(app_ids))})"
+
+        with self._transaction() as conn:
+            df = conn.execute(
+                f"""SELECT app_id, COUNT(*) AS records,
+                        AVG(latency) AS latency,
+                        QUANTILE_CONT(latency, 0.5) AS latency_p50,
+                        QUANTILE_CONT(latency, 0.95) AS latency_p95,
+                        QUANTILE_CONT(latency, 0.99) AS latency_p99,
+                        SUM(total_cost) AS total_cost,
+                        SUM(total_tokens) AS total_tokens
+                    FROM {self.TABLE_RECORDS}
+                    {where_clause}
+                    GROUP BY app_id
+                    ORDER BY app_id""", app_ids
+            ).df()
+
+            df_feedbacks = conn.execute(
+                f"""SELECT app_id, name, AVG(result) AS result
+                    FROM {self.TABLE_FEEDBACKS}
+                    {where_clause}
+                    GROUP BY app_id, name""", app_ids
+            ).df()
+
+        if len(df_feedbacks) == 0:
+            return df, []
+
+        df_feedbacks = df_feedbacks.pivot(
+            index="app_id", columns="name", values="result"
+        )
+        df_feedbacks.columns.name = None
+
+        df = df.merge(
+            df_feedbacks, how="left", left_on="app_id", right_index=True
+        )
+
+        return df, list(df_feedbacks.columns)
+
+    # TruDB requirement
+    def get_timeseries(
+        self,
+        app_ids: Optional[List[str]] = None,
+        granularity: str = "hour",
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None
+    ) -> Tuple[pd.DataFrame, Sequence[str]]:
+        # Aggregated by DuckDB over the typed columns, with exact percentiles.
+
+        seconds = self._granularity_seconds(granularity)
+        period = f"time_bucket(INTERVAL {seconds} SECOND, r.ts, TIMESTAMP '1970-01-01')"
+
+        clauses = []
+        vars = []
+
+        if app_ids:
+            clauses.append(f"r.app_id IN ({', '.join('?' * len(app_ids))})")
+            vars.extend(app_ids)
+
+        if start is not None:
+            clauses.append(f"{period} > ?")
+            vars.append(pd.Timestamp(start) - pd.Timedelta(seconds=seconds))
+
+        if end is not None:
+            clauses.append(f"{period} < ?")
+            vars.append(pd.Timestamp(end))
+
+        where_clause = ""
+        if len(clauses) > 0:
+            where_clause = "WHERE " + " AND ".join(clauses)
+
+        with self._transaction() as conn:
+            df = conn.execute(
+                f"""SELECT r.app_id, {period} AS ts, COUNT(*) AS records,
+                        AVG(latency) AS latency,
+                        quantile_cont(latency, 0.5) AS latency_p50,
+                        quantile_cont(latency, 0.95) AS latency_p95,
+                        quantile_cont(latency, 0.99) AS latency_p99,
+                        SUM(total_cost) AS total_cost,
+                        SUM(total_tokens) AS total_tokens
+                    FROM {self.TABLE_RECORDS} r
+                    {where_clause}
+                    GROUP BY ALL
+                    ORDER BY app_id, ts""", vars
+            ).df()
+
+            df_feedbacks = conn.execute(
+                f"""SELECT r.app_id, {period} AS ts, f.name,
+                        AVG(f.result) AS result
+                    FROM {self.TABLE_FEEDBACKS} f
+                    JOIN {self.TABLE_RECORDS} r ON r.record_id=f.record_id
+                    {where_clause}
+                    GROUP BY ALL
+                    HAVING COUNT(f.result) > 0""", vars
+            ).df()
+
+        if len(df_feedbacks) == 0:
+            return df, []
+
+        df_feedbacks = df_feedbacks.pivot(
+            index=["app_id", "ts"], columns="name", values="result"
+        )
+        df_feedbacks.columns.name = None
+
+        df = df.merge(
+            df_feedbacks,
+            how="left",
+            left_on=["app_id", "ts"],
+            right_index=True
+        )
+
+        return df, list(df_feedbacks.columns)
+
+
+def migrate_from_sqlite(
+    sqlite_db: LocalSQLite,
+    duckdb_db: LocalDuckDB,
+    chunk_size: int = 10000
+) -> None:
+    """
+    Copy all apps, feedback definitions, records and feedback results in
+    `sqlite_db` into `duckdb_db`, replacing those with the same ids. Records
+    are copied `chunk_size` at a time.
+    """
+
+    conn, c = sqlite_db._connect()
+
+    def copy(query: str, table: str, key: str, convert) -> int:
+        n = 0
+
+        c.execute(query)
+        columns = [description[0] for description in c.description]
+
+        while True:
+            rows = c.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+
+            df = convert(pd.DataFrame(rows, columns=columns))
+            with duckdb_db._transaction() as duck_conn:
+                duckdb_db._insert_df(duck_conn, table, df, key=key)
+
+            n += len(rows)
+
+        return n
+
+    copy(
+        f"SELECT app_id, app_json FROM {sqlite_db.TABLE_APPS}",
+        duckdb_db.TABLE_APPS, "app_id", lambda df: df
+    )
+    copy(
+        f"SELECT feedback_definition_id, feedback_json FROM {sqlite_db.TABLE_FEEDBACK_DEFS}",
+        duckdb_db.TABLE_FEEDBACK_DEFS, "feedback_definition_id", lambda df: df
+    )
+
+    def convert_records(df: pd.DataFrame) -> pd.DataFrame:
+        df['ts'] = pd.to_datetime(df['ts'])
+
+        df['record_json'] = [
+            json.dumps(obj) for obj in
+            sqlite_db._load_records(conn.cursor(), list(df['record_json']))
+        ]
+
+        cost = df['cost_json'].map(json.loads)
+        df['total_tokens'] = cost.map(lambda c: (c or {}).get('n_tokens'))
+        df['total_cost'] = cost.map(lambda c: (c or {}).get('cost'))
+
+        perf = df['perf_json'].map(json.loads)
+        df['latency'] = perf.map(
+            lambda p: None if p is None else
+            (pd.Timestamp(p['end_time']) - pd.Timestamp(p['start_time'])
+            ).total_seconds()
+        )
+
+        return df[duckdb_db.RECORD_COLUMNS]
+
+    n_records = copy(
+        f"SELECT * FROM {sqlite_db.TABLE_RECORDS}", duckdb_db.TABLE_RECORDS,
+        "record_id", convert_records
+    )
+
+    def convert_feedbacks(df: pd.DataFrame) -> pd.DataFrame:
+        df['calls_json'] = df['calls_json'].map(Codec.decode)
+
+        return df
+
+    columns = duckdb_db.FEEDBACK_COLUMNS + duckdb_db.CLAIM_COLUMNS
+    n_feedbacks = copy(
+        f"""SELECT {', '.join('f.' + column for column in columns)}, r.app_id
+            FROM {sqlite_db.TABLE_FEEDBACKS} f
+            LEFT JOIN {sqlite_db.TABLE_RECORDS} r ON r.record_id=f.record_id""",
+        duckdb_db.TABLE_FEEDBACKS, "feedback_result_id", convert_feedbacks
+    )
+
+    c.close()
+
+    print(
+        f"{UNICODE_CHECK} {n_records} record(s) and {n_feedbacks} feedback result(s) {sqlite_db} -> {duckdb_db}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Copy a sqlite trulens_eval database into a DuckDB one."
+    )
+    parser.add_argument(
+        "--sqlite", default="default.sqlite", help="sqlite database to copy"
+    )
+    parser.add_argument(
+        "--duckdb",
+        default="default.duckdb",
+        help="DuckDB database to copy into, created if it does not exist"
+    )
+    args = parser.parse_args()
+
+    sqlite_db = LocalSQLite(filename=Path(args.sqlite))
+    duckdb_db = LocalDuckDB(filename=Path(args.duckdb))
+
+    try:
+        migrate_from_sqlite(sqlite_db, duckdb_db)
+    finally:
+        duckdb_db.close()
+        sqlite_db.close()
+
+
+if __name__ == "__main__":
+    main()
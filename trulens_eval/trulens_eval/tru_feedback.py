@@ -8,7 +8,9 @@ from inspect import signature
 import itertools
 import logging
 from multiprocessing.pool import AsyncResult
+import os
 import re
+from socket import gethostname
 from time import sleep
 from typing import (
     Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Type, Union
@@ -32,6 +34,7 @@ from trulens_eval.schema import App
 from trulens_eval.schema import Query
 from trulens_eval.tru_db import JSON
 from trulens_eval.tru_db import Record
+from trulens_eval.tru_db import TruDB
 from trulens_eval.util import FunctionOrMethod
 from trulens_eval.util import jsonify
 from trulens_eval.util import OptionalImports
@@ -127,7 +130,13 @@ class Feedback(FeedbackDefinition):
                 )
 
     @staticmethod
-    def evaluate_deferred(tru: 'Tru'):
+    def evaluate_deferred(tru: 'Tru', limit: int = 256) -> int:
+        """
+        Start computing up to `limit` of the feedback results that were
+        deferred, have been running for too long or failed a while ago. Returns
+        the number started.
+        """
+
         db = tru.db
 
         def prepare_feedback(row):
@@ -144,42 +153,19 @@ class Feedback(FeedbackDefinition):
                 feedback_result_id=row.feedback_result_id
             )
 
-        feedbacks = db.get_feedback()
-
-        for i, row in feedbacks.iterrows():
-            if row.status == FeedbackResultStatus.NONE:
-                tqdm.write(f"Starting run for row {i}.")
-
-                TP().runlater(prepare_feedback, row)
-
-            elif row.status in [FeedbackResultStatus.RUNNING]:
-                now = datetime.now().timestamp()
-                if now - row.last_ts > 30:
-                    tqdm.write(
-                        f"Incomplete row {i} last made progress over 30 seconds ago. Retrying."
-                    )
-                    TP().runlater(prepare_feedback, row)
-
-                else:
-                    tqdm.write(
-                        f"Incomplete row {i} last made progress less than 30 seconds ago. Giving it more time."
-                    )
-
-            elif row.status in [FeedbackResultStatus.FAILED]:
-                now = datetime.now().timestamp()
-                if now - row.last_ts > 60 * 5:
-                    tqdm.write(
-                        f"Failed row {i} last made progress over 5 minutes ago. Retrying."
-                    )
-                    TP().runlater(prepare_feedback, row)
-
-                else:
-                    tqdm.write(
-                        f"Failed row {i} last made progress less than 5 minutes ago. Not touching it for now."
-                    )
-
-            elif row.status == FeedbackResultStatus.DONE:
-                pass
+        # Only the results that need computing are fetched, and they are marked
+        # as running under this process so that other evaluators skip them.
+        feedbacks = db.claim_pending_feedback(
+            limit=limit, worker_id=f"{gethostname()}:{os.getpid()}"
+        )
+
+        if len(feedbacks) > 0:
+            tqdm.write(f"Starting {len(feedbacks)} deferred feedback run(s).")
+
+        for _, row in feedbacks.iterrows():
+            TP().runlater(prepare_feedback, row)
+
+        return len(feedbacks)
 
     def __call__(self, *args, **kwargs) -> Any:
         assert self.imp is not None, "Feedback definition needs an implementation to call."
@@ -289,14 +275,20 @@ class Feedback(FeedbackDefinition):
     def run_and_log(
         self,
         record: Record,
-        tru: 'Tru',
+        tru: Optional['Tru'] = None,
         app: Union[App, JSON] = None,
-        feedback_result_id: Optional[FeedbackResultID] = None
+        feedback_result_id: Optional[FeedbackResultID] = None,
+        db: Optional[TruDB] = None
     ) -> FeedbackResult:
+        """
+        Run the feedback function on `record` and log its result, or the
+        failure to produce one, to `db` (by default that of `tru`).
+        """
+
         record_id = record.record_id
         app_id = record.app_id
 
-        db = tru.db
+        db = db or tru.db
 
         # Placeholder result to indicate a run.
         feedback_result = FeedbackResult(
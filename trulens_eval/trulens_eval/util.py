@@ -52,6 +52,10 @@ REQUIREMENT_LANGCHAIN = (
     "langchain 0.0.170 or above is required for instrumenting langchain apps. "
     "Please install it before use: `pip install langchain>=0.0.170`."
 )
+REQUIREMENT_DUCKDB = (
+    "duckdb 0.8.0 or above is required for the DuckDB database. "
+    "Please install it before use: `pip install duckdb>=0.8.0`."
+)
 
 
 class Dummy(object):
@@ -0,0 +1,185 @@
+"""
+Dashboard data loaders cached across reruns and sessions until the database
+changes, as told by `TruDB.get_data_stamp`. Selecting a row or switching pages
+then reuses what was already read instead of querying the database again.
+"""
+
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+from uuid import uuid4
+
+import pandas as pd
+import streamlit as st
+
+from trulens_eval.schema import AppID
+from trulens_eval.schema import FeedbackResultStatus
+from trulens_eval.schema import RecordID
+from trulens_eval.tru_db import TruDB
+
+
+def data_stamp(db: TruDB) -> Hashable:
+    """
+    Cache key of the current contents of `db`. Databases without data stamps
+    get a new key each time, so nothing read from them is reused.
+    """
+
+    stamp = db.get_data_stamp()
+    if stamp is None:
+        stamp = uuid4().hex
+
+    return (str(db), stamp)
+
+
+# Arguments starting with an underscore are not part of the cache keys; the
+# stamps stand in for the contents of the database.
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _get_app_summaries(_db: TruDB, stamp: Hashable, app_ids: Tuple[AppID, ...]):
+    return _db.get_app_summaries(list(app_ids))
+
+
+def get_app_summaries(
+    db: TruDB,
+    app_ids: Optional[List[AppID]] = None
+) -> Tuple[pd.DataFrame, Sequence[str]]:
+    return _get_app_summaries(db, data_stamp(db), tuple(app_ids or []))
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _search_records(
+    _db: TruDB, stamp: Hashable, text: str, app_ids: Tuple[AppID, ...],
+    limit: int, include_json: bool
+):
+    return _db.search_records(
+        text, app_ids=list(app_ids), limit=limit, include_json=include_json
+    )
+
+
+def search_records(
+    db: TruDB,
+    text: str,
+    app_ids: Optional[List[AppID]] = None,
+    limit: int = 50,
+    include_json: bool = False
+) -> Tuple[pd.DataFrame, Sequence[str]]:
+    return _search_records(
+        db, data_stamp(db), text, tuple(app_ids or []), limit, include_json
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _get_feedback(
+    _db: TruDB, stamp: Hashable, status: Tuple[str, ...], include_json: bool
+):
+    return _db.get_feedback(
+        status=[FeedbackResultStatus(s) for s in status],
+        include_json=include_json
+    )
+
+
+def get_feedback(
+    db: TruDB,
+    status: List[FeedbackResultStatus],
+    include_json: bool = False
+) -> pd.DataFrame:
+    return _get_feedback(
+        db, data_stamp(db), tuple(s.value for s in status), include_json
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _query_records(
+    _db: TruDB, stamp: Hashable, app_ids: Tuple[AppID, ...],
+    record_ids: Optional[Tuple[RecordID, ...]],
+    feedback_filters: Tuple[Tuple[str, str, float], ...],
+    order_by: Optional[str], limit: Optional[int], offset: int
+):
+    return _db.query_records(
+        app_ids=list(app_ids),
+        record_ids=None if record_ids is None else list(record_ids),
+        feedback_filters={
+            name: (op, value) for name, op, value in feedback_filters
+        },
+        order_by=order_by,
+        limit=limit,
+        offset=offset,
+        include_json=False
+    )
+
+
+def query_records(
+    db: TruDB,
+    app_ids: Optional[List[AppID]] = None,
+    record_ids: Optional[List[RecordID]] = None,
+    feedback_filters: Optional[Dict[str, Tuple[str, float]]] = None,
+    order_by: Optional[str] = None,
+    limit: Optional[int] = None,
+    offset: int = 0
+) -> Tuple[pd.DataFrame, Sequence[str]]:
+    """
+    As `db.query_records` without json, meant for a page of records at a time.
+    Pages already read are reused until the database changes.
+    """
+
+    return _query_records(
+        db, data_stamp(db), tuple(app_ids or []),
+        None if record_ids is None else tuple(record_ids),
+        _filters_key(feedback_filters), order_by, limit, offset
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _count_records(
+    _db: TruDB, stamp: Hashable, app_ids: Tuple[AppID, ...],
+    record_ids: Optional[Tuple[RecordID, ...]],
+    feedback_filters: Tuple[Tuple[str, str, float], ...]
+):
+    return _db.count_records(
+        app_ids=list(app_ids),
+        record_ids=None if record_ids is None else list(record_ids),
+        feedback_filters={
+            name: (op, value) for name, op, value in feedback_filters
+        }
+    )
+
+
+def count_records(
+    db: TruDB,
+    app_ids: Optional[List[AppID]] = None,
+    record_ids: Optional[List[RecordID]] = None,
+    feedback_filters: Optional[Dict[str, Tuple[str, float]]] = None
+) -> int:
+    return _count_records(
+        db, data_stamp(db), tuple(app_ids or []),
+        None if record_ids is None else tuple(record_ids),
+        _filters_key(feedback_filters)
+    )
+
+
+def _filters_key(
+    feedback_filters: Optional[Dict[str, Tuple[str, float]]]
+) -> Tuple[Tuple[str, str, float], ...]:
+    return tuple(
+        sorted(
+            (name, op, value)
+            for name, (op, value) in (feedback_filters or dict()).items()
+        )
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _get_feedback_histograms(
+    _db: TruDB, stamp: Hashable, app_ids: Tuple[AppID, ...], bins: Tuple[float,
+                                                                         ...]
+):
+    return _db.get_feedback_histograms(list(app_ids), bins=bins)
+
+
+def get_feedback_histograms(
+    db: TruDB,
+    app_ids: Optional[List[AppID]] = None,
+    bins: Sequence[float] = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+) -> pd.DataFrame:
+    return _get_feedback_histograms(
+        db, data_stamp(db), tuple(app_ids or []), tuple(bins)
+    )